@@ -124,6 +124,8 @@ class PicoDHT22:
             self.powerPin.init(Pin.OUT)
             self.powerPin.value(0)
         self.sm= rp2.StateMachine(self.smID)
+        self.start_at = 0
+        self.started = False
         
 
 
@@ -153,7 +155,53 @@ class PicoDHT22:
         return value
  
     def read(self):
-        value = self.read_array()
+        return self.decode(self.read_array())
+
+    # Non blocking read: start_read(), then read_ready() until it is True, then read_result().
+    # The other sensors can be read while the pin settles and the state machine samples
+    def start_read(self):
+        settle_ms = 200
+        if self.powerPin is not None:
+            self.powerPin.value(1)
+            settle_ms += 800
+        self.start_at = utime.ticks_add(utime.ticks_ms(), settle_ms)
+        self.started = False
+
+    def read_ready(self):
+        if not self.started:
+            if utime.ticks_diff(utime.ticks_ms(), self.start_at) < 0:
+                return False
+            # joined fifo holds all 5 bytes, so the state machine never stalls waiting for get()
+            self.sm.init(DHT22_PIO,freq=500000,
+                         set_base=self.dataPin,
+                         in_base=self.dataPin,
+                         jmp_pin=self.dataPin,
+                         fifo_join=PIO.JOIN_RX)
+            if self.dht11:
+                self.sm.put(10000)
+            else:
+                self.sm.put(1000)
+            self.sm.active(1)
+            self.started = True
+        return self.sm.rx_fifo() >= 5
+
+    def read_result(self):
+        value = []
+        for i in range(5):
+            value.append(self.sm.get())
+        self.sm.active(0)
+        if self.powerPin is not None:
+            self.powerPin.value(0)
+        return self.decode(value)
+
+    # Gives up on a read started by start_read, e.g. when the sensor never answers
+    def stop_read(self):
+        self.sm.active(0)
+        self.started = False
+        if self.powerPin is not None:
+            self.powerPin.value(0)
+
+    def decode(self, value):
         sumV = 0
         for i in range(4):
             sumV += value[i]
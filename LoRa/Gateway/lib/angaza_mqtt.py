@@ -8,8 +8,37 @@ import ubinascii
 from device_handler import device_details
 
 client_list = []
+der_cache = {}  # pem file name -> (der bytes, sha256 digest), so the files are read only once
+mqtt_breaker = CircuitBreaker('mqtt broker')   # opens while publishing keeps failing
+# time in ms each bridge request may wait for the esp before giving up, None waits forever
+timeout_dict = {}
 w_led = Pin(12, Pin.OUT)    # led pin object for connection status updates
 
+# Session state. Each layer of the link to the broker is tracked as its own flag, so a
+# reconnect only redoes the layers that were lost. The tls layer is the keys, certificate
+# and mqtt client set up on the esp by mqtt_init: it survives wifi and broker outages and
+# is only lost when the esp resets
+SESSION_WIFI = 1
+SESSION_TLS = 2
+SESSION_MQTT = 4
+SESSION_SUBSCRIBED = 8
+# layers that can no longer be valid once a layer is lost
+session_dependents = {
+    SESSION_WIFI: SESSION_MQTT | SESSION_SUBSCRIBED,
+    SESSION_TLS: SESSION_MQTT | SESSION_SUBSCRIBED,
+    SESSION_MQTT: SESSION_SUBSCRIBED,
+    SESSION_SUBSCRIBED: 0,
+}
+
+## publish_statuses - one publish status per message from the esp's reply to a batch
+# status_list - the list the esp sent, None if it only sent its overall status
+# Return: a list of len count, messages the esp did not report on count as failed
+def publish_statuses(status_list, status, count):
+    if status_list is None:
+        return [bool(status)] * count
+    return [entry is True for entry in status_list[:count]] + [False] * (count - len(status_list))
+
+
 class MQTTException(Exception):
     pass
 
@@ -25,6 +54,7 @@ class MQTTClient:
         ssl=False,
         ssl_params={},
         publish_feedback=True,
+        clean_session=True,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -41,7 +71,62 @@ class MQTTClient:
         client_list.append(self)
         self.ref = client_list.index(self)
         self.publish_feedback = publish_feedback
-        self.mqtt_connect_success = False
+        self.clean_session = clean_session  # False asks the broker to keep subscriptions across reconnects
+        self.session = 0    # SESSION_* flags of the layers currently up
+        self.session_present = False    # broker kept the session on the last connect
+        self.file_dict = None
+        self.wifi_credentials = None    # (ssid, password) of the last connect_to_wifi, for resume()
+        self.subscriptions = {}     # topic -> qos, subscribed again by resume()
+        self.push_wanted = False
+        self.push_msgs = False  # True once the esp pushes subscribed messages as they arrive
+
+
+    @property
+    def mqtt_connect_success(self):
+        return self.session & SESSION_MQTT != 0
+
+
+    # Marks layers as lost along with every layer that depends on them
+    def lost(self, layers):
+        for layer, dependents in session_dependents.items():
+            if layers & layer:
+                layers |= dependents
+        self.session &= ~layers
+        if layers & SESSION_TLS:
+            # the esp forgot the mqtt client and which messages to push
+            self.target_ref = None
+            self.push_msgs = False
+
+
+    # Brings the session back up, starting from the highest layers still valid after losing
+    # the given ones: wifi is only reconnected if it was lost, keys and certificates only
+    # sent again if the esp reset, and subscriptions only renewed if the broker dropped them
+    # Return: True once connected and subscribed again
+    def resume(self, layers=0):
+        self.lost(layers)
+        if not self.session & SESSION_WIFI:
+            assert self.wifi_credentials is not None, 'Connect to wifi before resuming'
+            if connect_to_wifi(self.uart_obj, *self.wifi_credentials) != True:
+                return False
+        if not self.session & SESSION_MQTT:
+            assert self.file_dict is not None, 'Connect to the mqtt broker before resuming'
+            if not self.connect(self.file_dict):
+                return False
+        if not self.session & SESSION_SUBSCRIBED:
+            return self.restore_subscriptions()
+        return True
+
+
+    # Subscribes to every stored topic again and turns pushing back on
+    # Return: True if all of them succeeded
+    def restore_subscriptions(self):
+        for topic, qos in self.subscriptions.items():
+            if not self.subscribe(topic, qos):
+                return False
+        if self.push_wanted and not self.push_msgs:
+            self.enable_push()
+        self.session |= SESSION_SUBSCRIBED
+        return True
 
 
     @property
@@ -57,93 +142,175 @@ class MQTTClient:
 
     def set_callback(self, topic, f):
         self.cb[topic] = f
+
+
+    # Hands a subscribed message pushed by the esp to its topic callback
+    # Return: the message dict or None if rxData is not a pushed message
+    def deliver_msg(self, rxData):
+        if rxData[-1] != 'j':
+            return None
+        msg = ujson.loads(rxData[0])
+        if 'topic' not in msg or 'req_id' in msg:
+            return None
+        f = self.cb.get(msg.get('topic', None), None)
+        if f is not None:
+            f(msg.get('message', None))
+        return msg
+
+
+    # Responses to a request, with messages the esp pushes in the meantime delivered on the way
+    def responses(self, timeout_ms):
+        for rxData in receive_responses(self.uart_obj, timeout_ms):
+            if self.deliver_msg(rxData) is None:
+                yield rxData
+
+
+    # Waits up to timeout_ms for messages pushed by the esp and delivers them to their callbacks
+    # Return: number of messages delivered
+    def poll_msgs(self, timeout_ms=0):
+        count = 0
+        rxData = receive_data(self.uart_obj, wait_ms=timeout_ms)
+        while rxData is not None:
+            if self.deliver_msg(rxData) is not None:
+                count += 1
+            elif rxData[-1] == 'c':
+                process_command(self.uart_obj, rxData[0])
+            elif rxData[-1] == 'o':
+                print(rxData[0])
+            rxData = receive_data(self.uart_obj) if data_waiting(self.uart_obj) else None
+        return count
     
 
-    def read_pem(self, filename):        
+    def read_pem(self, filename):
+        return self.load_pem(filename)[0]
+
+
+    # Decoded key or certificate and its digest, read from the file system on first use only
+    def load_pem(self, filename):
+        cached = der_cache.get(filename, None)
+        if cached is not None:
+            return cached
+        assert filename in os.listdir(), f'{filename} not in file system'
         with open(filename, 'r') as f:
             text = f.read().strip()
             split_text = text.split('\n')
             base64_text = ''.join(split_text[1:-1])
             # Decode base64-encoded data, ignoring invalid characters in the input. Conforms to RFC 2045 s.6.8. Returns a bytes object.
-            return ubinascii.a2b_base64(base64_text)
+            der = ubinascii.a2b_base64(base64_text)
+        der_cache[filename] = (der, sha256_hex(der))
+        return der_cache[filename]
+
+
+    timeout_dict['have_key_cert'] = 5000
+    # Asks the esp whether it already keeps the blob with this digest in flash
+    # Return: True if the esp loaded it, so there is no need to send it
+    def have_key_cert(self, specifier, digest):
+        send_command(self.uart_obj, 'mqtt_have_key_cert', self.ref, specifier, digest)
+
+        for rxData in self.responses(timeout_dict['have_key_cert']):
+            if rxData[-1] == 'd':
+                rxjson = ujson.loads(rxData[0])
+                return rxjson.get('status')
+            elif rxData[-1] == 'o':
+                print(rxData[0])
     
 
+    timeout_dict['send_key_cert'] = 10000
     @func_handler
     def send_key_cert(self, specifier, filename):
-        assert filename in os.listdir(), f'{filename} not in file system'
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'receive_key_cert', 'receive_key_cert': {'arg_available': True, 'argument': [self.ref, specifier]}}]}}
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')       
-
-        while True:
-            rxData = receive_data(self.uart_obj)            
-
-            if rxData is not None and rxData[0] == f'receive {specifier} ready':
-                sleep(0.01)
-                send_data(self.uart_obj, self.read_pem(filename))
-            elif rxData is not None and rxData[-1] == 'd':
+        der, digest = self.load_pem(filename)
+        if self.have_key_cert(specifier, digest):
+            return True
+
+        pace()
+        send_command(self.uart_obj, 'receive_key_cert', self.ref, specifier)
+
+        for rxData in self.responses(timeout_dict['send_key_cert']):
+            if rxData[0] == f'receive {specifier} ready':
+                pace(0.01)
+                send_data(self.uart_obj, der)
+            elif rxData[-1] == 'd':
                 rxjson = ujson.loads(rxData[0])                
                 return rxjson.get('status')
-            elif rxData is not None and rxData[-1] == 'o':
+            elif rxData[-1] == 'o':
                 print(rxData[0])
     
     
+    timeout_dict['mqtt_init'] = 20000
     @func_handler
     def mqtt_init(self, file_dict, **kwargs):
         # send certificates to esp
         for specifier, filename in file_dict.items():
-            sleep(0.1)
+            pace()
             if not self.send_key_cert(specifier, filename, debug_func=True):
                 raise Exception('Error in sending keys')
         
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'mqtt_init', 'mqtt_init': {'arg_available': True, 'argument': [[self.client_id, self.server, self.port, self.keepalive, self.ssl, self.ref]]}}]}}
         # send mqtt_init command to esp
         # print(f'sending init command to esp')
-        sleep(0.1)
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')
+        pace()
+        send_command(self.uart_obj, 'mqtt_init', [self.client_id, self.server, self.port, self.keepalive, self.ssl, self.ref])
 
-        while True:
-            rxData = receive_data(self.uart_obj)
-            
-            if rxData is not None and rxData[-1] == 'c':            
+        for rxData in self.responses(timeout_dict['mqtt_init']):
+            if rxData[-1] == 'c':            
                 process_command(self.uart_obj, rxData[0])
-            elif rxData is not None and rxData[-1] == 'd':
+            elif rxData[-1] == 'd':
                 rxjson = ujson.loads(rxData[0])
                 return rxjson.get('status')
-            elif rxData is not None and rxData[-1] == 'o':                
+            elif rxData[-1] == 'o':                
                 print(rxData[0])
 
 
-    retry_dict['connect'] = {'retries': 3, 'other_args': {'jump_mqtt_init': False}}
+    # Connects to the broker. The mqtt object on the esp is only initialized again if the
+    # esp lost it or jump_mqtt_init=False is given
+    timeout_dict['connect'] = 30000
+    retry_dict['connect'] = {'retries': 3}
     @func_handler
     def connect(self, file_dict, **kwargs):
-        jump_mqtt_init = kwargs.get('jump_mqtt_init', False)
+        jump_mqtt_init = kwargs.get('jump_mqtt_init', True)
+        self.file_dict = file_dict
+        self.lost(SESSION_MQTT if jump_mqtt_init else SESSION_TLS)
         # initialize mqtt object on esp side and obtain target ref value
-        if not jump_mqtt_init or self.target_ref is None:           
+        tls_kept = self.session & SESSION_TLS and self.target_ref is not None
+        if not tls_kept:
             if not self.mqtt_init(file_dict, debug_func=True):
                 raise Exception('mqtt init failed')
-            retry_dict['connect']['other_args']['jump_mqtt_init'] = True
+            self.session |= SESSION_TLS
 
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'mqtt_connect', 'mqtt_connect': {'arg_available': True, 'argument': [self.target_ref]}}]}}
         # send connect command to esp
-        sleep(0.1)
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')
+        pace()
+        if self.clean_session:
+            send_command(self.uart_obj, 'mqtt_connect', self.target_ref)
+        else:
+            send_command(self.uart_obj, 'mqtt_connect', self.target_ref, False)
+        self.session_present = False
         timer_x = Timer()
 
-        while True:
-            rxData = receive_data(self.uart_obj)
-
-            if rxData is not None and rxData[-1] == 'd':
-                rxjson = ujson.loads(rxData[0])
-                timer_x.deinit()
-                print('\n', end='')
-                self.mqtt_connect_success = rxjson.get('status')
-                return self.mqtt_connect_success
-            elif rxData is not None and rxData[-1] == 'o':                
-                if rxData[0] == 'Connecting to MQTT broker...':
-                    print(rxData[0], end='')
-                    timer_x.init(mode=Timer.PERIODIC, freq=1, callback=progress_bar)
-                else:
-                    print(f'\n{rxData[0]}')
+        try:
+            for rxData in self.responses(timeout_dict['connect']):
+                if rxData[-1] == 'd':
+                    rxjson = ujson.loads(rxData[0])
+                    timer_x.deinit()
+                    print('\n', end='')
+                    if not rxjson.get('status'):
+                        return False
+                    self.session |= SESSION_MQTT
+                    if tls_kept and self.session_present and not self.clean_session:
+                        # the broker kept the subscriptions and the esp still routes them
+                        self.session |= SESSION_SUBSCRIBED
+                    return True
+                elif rxData[-1] == 'j':
+                    # esp firmware that reports the session present flag of the connack
+                    self.session_present = bool(ujson.loads(rxData[0]).get('session_present', False))
+                elif rxData[-1] == 'o':                
+                    if rxData[0] == 'Connecting to MQTT broker...':
+                        print(rxData[0], end='')
+                        timer_x.init(mode=Timer.PERIODIC, freq=1, callback=progress_bar)
+                    else:
+                        print(f'\n{rxData[0]}')
+        except Exception:
+            # stop the progress bar before func_handler retries
+            timer_x.deinit()
+            raise
 
 
     def disconnect(self):
@@ -151,41 +318,81 @@ class MQTTClient:
         pass
     
 
+    timeout_dict['publish'] = 10000
     exempt_function_dict['publish'] = ['on_success', 'on_failure']
+    breaker_dict['publish'] = mqtt_breaker
     @func_handler
     def publish(self, topic, msg):
         assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
-        sleep(0.1)
+        pace()
         # send publish command to esp
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'mqtt_publish', 'mqtt_publish': {'arg_available': True, 'argument': [self.target_ref, topic, msg, self.__publish_feedback]}}]}}
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')
-        while True:
-            rxData = receive_data(self.uart_obj)
-
-            if rxData is not None and rxData[-1] == 'd':
+        send_command(self.uart_obj, 'mqtt_publish', self.target_ref, topic, msg, self.__publish_feedback)
+        for rxData in self.responses(timeout_dict['publish']):
+            if rxData[-1] == 'd':
                 rxjson = ujson.loads(rxData[0])
                 execution_status = rxjson.get('status')
                 return rxjson.get('status')
-            elif rxData is not None and rxData[-1] == 'o':
+            elif rxData[-1] == 'o':
+                print(rxData[0])
+
+
+    # Publishes a list of messages to topic in one bridge round trip.
+    # Returns a list with the publish status of each message
+    timeout_dict['publish_many'] = 30000
+    exempt_function_dict['publish_many'] = ['on_success', 'on_failure']
+    breaker_dict['publish_many'] = mqtt_breaker
+    @func_handler
+    def publish_many(self, topic, messages):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        pace()
+        # send publish batch command to esp
+        send_command(self.uart_obj, 'mqtt_publish_batch', self.target_ref, topic, messages, self.__publish_feedback)
+        status_list = None
+        for rxData in self.responses(timeout_dict['publish_many']):
+            if rxData[-1] == 'd':
+                rxjson = ujson.loads(rxData[0])
+                return publish_statuses(status_list, rxjson.get('status'), len(messages))
+            elif rxData[-1] == 'j':
+                status_list = ujson.loads(rxData[0]).get('status_list', status_list)
+            elif rxData[-1] == 'o':
                 print(rxData[0])
 
 
+    timeout_dict['subscribe'] = 10000
     @func_handler
     def subscribe(self, topic, qos=0):
         assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
-        sleep(0.1)
+        pace()
         # check if callback for specific topic is set
         assert self.cb.get(topic, None) is not None, f'Callback for {topic} is not set'
         # send subscribe command to esp
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'mqtt_subscribe', 'mqtt_subscribe': {'arg_available': True, 'argument': [self.target_ref, topic]}}]}}
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')
-        while True:
-            rxData = receive_data(self.uart_obj)
+        send_command(self.uart_obj, 'mqtt_subscribe', self.target_ref, topic)
+        for rxData in self.responses(timeout_dict['subscribe']):
+            if rxData[-1] == 'd':
+                rxjson = ujson.loads(rxData[0])
+                if rxjson.get('status'):
+                    self.subscriptions[topic] = qos
+                return rxjson.get('status')
+            elif rxData[-1] == 'o':
+                print(rxData[0])
+
 
-            if rxData is not None and rxData[-1] == 'd':
+    # Asks the esp to push subscribed messages as they arrive instead of waiting for
+    # check_msg. Messages are then delivered by poll_msgs or while waiting on any request
+    # Return: True if the esp firmware supports pushing
+    timeout_dict['enable_push'] = 10000
+    @timed
+    def enable_push(self, enable=True):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        pace()
+        send_command(self.uart_obj, 'mqtt_push_msgs', self.target_ref, enable)
+        self.push_wanted = enable
+        for rxData in self.responses(timeout_dict['enable_push']):
+            if rxData[-1] == 'd':
                 rxjson = ujson.loads(rxData[0])
+                self.push_msgs = enable and bool(rxjson.get('status'))
                 return rxjson.get('status')
-            elif rxData is not None and rxData[-1] == 'o':
+            elif rxData[-1] == 'o':
                 print(rxData[0])
 
 
@@ -193,32 +400,31 @@ class MQTTClient:
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method
     # If not, returns immediately with None
+    timeout_dict['check_msg'] = 10000
     exempt_function_dict['check_msg'] = ['on_success', 'on_failure']
+    @timed
     def check_msg(self):
         assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
-        sleep(0.1)
+        pace()
         # send message wait_msg command to esp
         # calls corresponding callback for a subscribed topic
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'mqtt_check_msg', 'mqtt_check_msg': {'arg_available': True, 'argument': [self.target_ref]}}]}}
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')
+        send_command(self.uart_obj, 'mqtt_check_msg', self.target_ref)
         msg = None
-        while True:
-            rxData = receive_data(self.uart_obj)
-
-            if rxData is not None and rxData[-1] == 'd':
+        for rxData in receive_responses(self.uart_obj, timeout_dict['check_msg']):
+            if rxData[-1] == 'd':
                 rxjson = ujson.loads(rxData[0])
                 execution_status = rxjson.get('status')                
 
                 if not execution_status:
-                    # print(f'{self.check_msg.__name__} failed')
-                    raise Exception(f'{self.check_msg.__name__} failed')
+                    # print('check_msg failed')
+                    raise Exception('check_msg failed')
                 elif execution_status:
-                    print(f'{self.check_msg.__name__} succeeded')
+                    print('check_msg succeeded')
                 
                 break
-            elif rxData is not None and rxData[-1] == 'o':
+            elif rxData[-1] == 'o':
                 print(rxData[0])
-            elif rxData is not None and rxData[-1] == 'j':
+            elif rxData[-1] == 'j':
                 msg = rxData[0]
         
         if msg is None:
@@ -236,30 +442,29 @@ class MQTTClient:
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method
     # If not, returns immediately with None
+    timeout_dict['wait_msg'] = None
     exempt_function_dict['wait_msg'] = ['on_success', 'on_failure']
+    @timed
     def wait_msg(self):
-        sleep(0.1)
+        pace()
         # send message wait_msg command to esp
         # calls corresponding callback for a subscribed topic
-        txjson = {'action': ['mqtt_operation'], 'mqtt_operation': {'arg_available': True, 'argument': [{'operation': 'mqtt_wait_msg', 'mqtt_wait_msg': {'arg_available': True, 'argument': [self.target_ref]}}]}}
-        send_data(self.uart_obj, ujson.dumps(txjson), end_format='command')
+        send_command(self.uart_obj, 'mqtt_wait_msg', self.target_ref)
         msg = None
-        while True:
-            rxData = receive_data(self.uart_obj)
-
-            if rxData is not None and rxData[-1] == 'd':
+        for rxData in receive_responses(self.uart_obj, timeout_dict['wait_msg']):
+            if rxData[-1] == 'd':
                 rxjson = ujson.loads(rxData[0])
                 execution_status = rxjson.get('status')                
 
                 if not execution_status:
-                    raise Exception(f'{self.wait_msg.__name__} failed')
+                    raise Exception('wait_msg failed')
                 elif execution_status:
-                    print(f'{self.wait_msg.__name__} succeeded')
+                    print('wait_msg succeeded')
                 
                 break
-            elif rxData is not None and rxData[-1] == 'o':
+            elif rxData[-1] == 'o':
                 print(rxData[0])
-            elif rxData is not None and rxData[-1] == 'j':
+            elif rxData[-1] == 'j':
                 msg = rxData[0]
         
         if msg is None:
@@ -304,30 +509,29 @@ def standby():
 handler_dict['standby'] = standby
 
 
+timeout_dict['connect_to_wifi'] = 5000    # on top of the timeout_ms given to the esp
 retry_dict['connect_to_wifi'] = {'retries': 2}
 @func_handler
 def connect_to_wifi(uart_obj, ssid, password, **kwargs):
-    sleep(0.1)
+    pace()
     timeout_ms = kwargs.get('timeout_ms', 5000)
     execution_status = None
     
-    txjson = {
-        'action': ['connect_to_wifi'],
-        'connect_to_wifi':{
-            'arg_available': True,
-            'argument': [ssid, password, timeout_ms]
-        }
-    }
+    send_command(uart_obj, 'connect_to_wifi', ssid, password, timeout_ms)
 
-    send_data(uart_obj, ujson.dumps(txjson), end_format='command')
-
-    while True:
-        rxData = receive_data(uart_obj)
-
-        if rxData is not None and rxData[-1] == 'd':
+    for rxData in receive_responses(uart_obj, timeout_ms + timeout_dict['connect_to_wifi']):
+        if rxData[-1] == 'd':
             rxjson = ujson.loads(rxData[0])
+            # keep the session state of the clients bridged over this uart up to date
+            for client in client_list:
+                if client.uart_obj is uart_obj:
+                    client.wifi_credentials = (ssid, password)
+                    if rxjson.get('status'):
+                        client.session |= SESSION_WIFI
+                    else:
+                        client.lost(SESSION_WIFI)
             return rxjson.get('status')
-        elif rxData is not None and rxData[-1] == 'o':
+        elif rxData[-1] == 'o':
             print(rxData[0])
 
 
@@ -340,32 +544,24 @@ def target_ref(uart_obj, ref, target_ref):
     return True
 
 
+timeout_dict['set_time'] = 10000
 retry_dict['set_time'] = {'retries': 2}
 @func_handler
 def set_time(uart_obj, rtc, utc_offset=3, **kwargs):
-    sleep(0.1)
+    pace()
     utc_epoch = utc_offset * 60 * 60
     timeout_ms = kwargs.get('timeout_ms', 5000)
     execution_status = None
     
-    txjson = {
-        'action': ['get_ntp_time'],
-        'get_ntp_time':{
-            'arg_available': False,
-        }
-    }
-
-    send_data(uart_obj, ujson.dumps(txjson), end_format='command')
-
-    while True:
-        rxData = receive_data(uart_obj)
+    send_command(uart_obj, 'get_ntp_time')
 
-        if rxData is not None and rxData[-1] == 'd':
+    for rxData in receive_responses(uart_obj, timeout_dict['set_time']):
+        if rxData[-1] == 'd':
             rxjson = ujson.loads(rxData[0])
             return rxjson.get('status')
-        elif rxData is not None and rxData[-1] == 'o':
+        elif rxData[-1] == 'o':
             print(rxData[0])
-        elif rxData is not None and 'epoch' in rxData[0]:
+        elif 'epoch' in rxData[0]:
             time_l = list(map(int, rxData[0].split(': ')[-1][1:-1].split(', ')))
             time_l[4] = (time_l[4] + utc_offset) % 24   # (year, month, day, weekday, h, m, s, sub_s)            
             rtc.datetime(tuple(time_l))
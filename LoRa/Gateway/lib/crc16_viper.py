@@ -0,0 +1,20 @@
+# This script holds the viper loop of crc16. It is kept apart from crc16 so ports without
+# the viper emitter fail to import this module only, and crc16 falls back to its Python loop
+import micropython
+
+
+@micropython.viper
+def crc16_viper(data, crc: int, hi_table, lo_table) -> int:
+    buf = ptr8(data)
+    table_hi = ptr8(hi_table)
+    table_lo = ptr8(lo_table)
+    length = int(len(data))
+    lo = crc & 0xFF
+    hi = (crc >> 8) & 0xFF
+    i = 0
+    while i < length:
+        index = lo ^ buf[i]
+        lo = hi ^ table_lo[index]
+        hi = table_hi[index]
+        i += 1
+    return (hi << 8) | lo
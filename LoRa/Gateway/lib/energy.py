@@ -0,0 +1,60 @@
+# This script holds energy accounting for battery powered nodes. Each cycle the time spent
+# transmitting, receiving, awake with the radio quiet (idle) and hibernating is added up
+# and turned into charge using the current drawn in each state
+from ulora import MODE_TX, MODE_RXCONTINUOUS, MODE_CAD
+
+STATES = ('tx', 'rx', 'idle', 'hibernate')
+# Board current in mA for each state. Estimates for the rp2040 board with an ra-02 at
+# 18 dBm and the esp off, measure your own board and pass them in for better figures
+CURRENT_MA = {'tx': 120.0, 'rx': 36.0, 'idle': 25.0, 'hibernate': 1.2}
+
+
+class EnergyMeter():
+    # lora is the LoRa object whose radio time is counted, None for a node without one
+    def __init__(self, lora=None, current_ma=CURRENT_MA):
+        self.lora = lora
+        self.current_ma = current_ma
+        self.cycle_ms = dict((state, 0) for state in STATES)    # last completed cycle
+        self.total_ms = dict((state, 0) for state in STATES)
+        self.cycles = 0
+        self._radio_ms = None if lora is None else lora.mode_ms[:]  # at the end of the last cycle
+
+    # Closes a cycle. awake_ms is the time the mcu was running and hibernate_ms the time it
+    # slept. Radio time comes from lora.mode_ms and the rest of awake_ms counts as idle
+    # Return: charge used in the cycle in mAh
+    def end_cycle(self, awake_ms, hibernate_ms):
+        tx_ms = rx_ms = 0
+        if self.lora is not None:
+            radio_ms = self.lora.mode_ms[:]
+            tx_ms = radio_ms[MODE_TX] - self._radio_ms[MODE_TX]
+            rx_ms = radio_ms[MODE_RXCONTINUOUS] + radio_ms[MODE_CAD] - self._radio_ms[MODE_RXCONTINUOUS] - self._radio_ms[MODE_CAD]
+            self._radio_ms = radio_ms
+
+        self.cycle_ms['tx'] = tx_ms
+        self.cycle_ms['rx'] = rx_ms
+        self.cycle_ms['idle'] = max(awake_ms - tx_ms - rx_ms, 0)
+        self.cycle_ms['hibernate'] = hibernate_ms
+        for state in STATES:
+            self.total_ms[state] += self.cycle_ms[state]
+        self.cycles += 1
+        return self.charge_mah(self.cycle_ms)
+
+    def charge_mah(self, state_ms):
+        return sum(self.current_ma[state] * ms for state, ms in state_ms.items()) / 3600000
+
+    # Average current over every cycle so far, 0 before the first
+    def average_ma(self):
+        total_ms = sum(self.total_ms.values())
+        if not total_ms:
+            return 0
+        return self.charge_mah(self.total_ms) * 3600000 / total_ms
+
+    # Days a battery of capacity_mah lasts at the average current so far
+    def battery_life_days(self, capacity_mah):
+        average_ma = self.average_ma()
+        if not average_ma:
+            return None
+        return capacity_mah / average_ma / 24
+
+    def stats(self):
+        return {'cycles': self.cycles, 'cycle_ms': self.cycle_ms, 'average_ma': round(self.average_ma(), 3)}
@@ -0,0 +1,137 @@
+# This script holds a poller for several Modbus RTU slaves on one RS485 bus. Jobs are
+# (slave, function, start, quantity, period) reads. Each poll() reads the jobs that are due,
+# with register ranges of one slave that touch or nearly touch merged into a single read,
+# and keeps the latest value of every job with the time it was read. Times are ticks_ms
+from time import ticks_ms, ticks_diff
+from umodbus import const as Const
+
+MAX_GAP = 4             # unwanted registers read to join two ranges, cheaper than another request
+MAX_READ_QTY = 125      # registers in one read request
+STALE_PERIODS = 2       # a value is stale once it is older than this many periods
+
+# only register reads are merged, read_coils and read_discrete_inputs return their bits
+# reordered within each byte so a merged range can not be sliced back into its jobs
+REGISTER_FUNCTIONS = (Const.READ_HOLDING_REGISTERS, Const.READ_INPUT_REGISTER)
+READ_FUNCTIONS = {
+    Const.READ_COILS: 'read_coils',
+    Const.READ_DISCRETE_INPUTS: 'read_discrete_inputs',
+    Const.READ_HOLDING_REGISTERS: 'read_holding_registers',
+    Const.READ_INPUT_REGISTER: 'read_input_registers',
+}
+
+
+class ModbusPoller():
+    # host is a umodbus.serial.Serial
+    def __init__(self, host, max_gap=MAX_GAP):
+        self.host = host
+        self.max_gap = max_gap
+        self.jobs = {}          # name -> job dict
+        self.slave_ms = {}      # slave address -> average ms a read from it takes
+        self.transactions = 0
+        self.failures = 0
+
+    # Adds a read job. period is in seconds, 0 reads it on every poll()
+    def add(self, name, slave_addr, function, start, qty, period=0, signed=True):
+        if function not in READ_FUNCTIONS:
+            raise Exception(f'Function {function} is not a read function')
+        self.jobs[name] = {'slave': slave_addr, 'function': function, 'start': start, 'qty': qty,
+                           'period': period, 'signed': signed, 'value': None, 'read_at': None, 'error': None}
+
+    def _due(self, job, now):
+        return job['read_at'] is None or job['error'] is not None or ticks_diff(now, job['read_at']) >= job['period'] * 1000
+
+    # Groups the jobs due into reads: [slave, function, signed, start, qty, [job names]]
+    # A read also refreshes jobs not yet due that lie inside its range, at no extra cost
+    def schedule(self, now=None):
+        if now is None:
+            now = ticks_ms()
+        due = sorted((job['slave'], job['function'], job['signed'], job['start'], job['qty'], name)
+                     for name, job in self.jobs.items() if self._due(job, now))
+        reads = []
+        for slave, function, signed, start, qty, name in due:
+            last = reads[-1] if reads else None
+            if (last is not None and function in REGISTER_FUNCTIONS and last[:3] == [slave, function, signed]
+                    and start <= last[3] + last[4] + self.max_gap
+                    and max(last[3] + last[4], start + qty) - last[3] <= MAX_READ_QTY):
+                last[4] = max(last[3] + last[4], start + qty) - last[3]
+                last[5].append(name)
+            else:
+                reads.append([slave, function, signed, start, qty, [name]])
+
+        for read in reads:
+            for name, job in self.jobs.items():
+                if (name not in read[5] and read[:3] == [job['slave'], job['function'], job['signed']]
+                        and read[1] in REGISTER_FUNCTIONS
+                        and read[3] <= job['start'] and job['start'] + job['qty'] <= read[3] + read[4]):
+                    read[5].append(name)
+
+        # reads of one slave stay together and the quickest slaves go first, so a slow or
+        # missing slave only delays itself
+        reads.sort(key=lambda read: (self.slave_ms.get(read[0], 0), read[0]))
+        return reads
+
+    # Reads every job that is due. A slave that fails a read is skipped for the rest of the
+    # poll, so a missing slave costs one response timeout rather than one per job
+    # Return: number of read requests sent
+    def poll(self, now=None):
+        if now is None:
+            now = ticks_ms()
+        failed = []
+        sent = 0
+        for slave, function, signed, start, qty, names in self.schedule(now):
+            if slave in failed:
+                continue
+            t = ticks_ms()
+            try:
+                read = getattr(self.host, READ_FUNCTIONS[function])
+                if function in REGISTER_FUNCTIONS:
+                    values = read(slave, start, qty, signed)
+                else:
+                    values = read(slave, start, qty)
+                error = None
+            except (OSError, ValueError) as e:
+                failed.append(slave)
+                error = str(e)
+                self.failures += 1
+            sent += 1
+            self.transactions += 1
+            done = ticks_ms()
+            read_ms = ticks_diff(done, t)
+            self.slave_ms[slave] = (self.slave_ms.get(slave, read_ms) + read_ms) / 2
+
+            for name in names:
+                job = self.jobs[name]
+                job['error'] = error
+                if error is None:
+                    offset = job['start'] - start
+                    job['value'] = values[offset:offset + job['qty']]
+                    job['read_at'] = done   # when the value arrived, not when the poll began
+                else:
+                    print(f'Modbus read of {name} failed with error: {error}')
+        return sent
+
+    # Latest value read for a job, None if it has never been read
+    def value(self, name):
+        return self.jobs[name]['value']
+
+    # ms since a job was last read, None if it has never been read
+    def age_ms(self, name, now=None):
+        job = self.jobs[name]
+        if job['read_at'] is None:
+            return None
+        if now is None:
+            now = ticks_ms()
+        return ticks_diff(now, job['read_at'])
+
+    # True if a job has never been read or its last read failed. A job with a period is also
+    # stale once its value is older than STALE_PERIODS periods, one read on every poll() only
+    # goes stale by failing
+    def stale(self, name, now=None):
+        job = self.jobs[name]
+        age_ms = self.age_ms(name, now)
+        if age_ms is None or job['error'] is not None:
+            return True
+        return job['period'] > 0 and age_ms > STALE_PERIODS * job['period'] * 1000
+
+    def stats(self):
+        return {'transactions': self.transactions, 'failures': self.failures, 'slave_ms': self.slave_ms}
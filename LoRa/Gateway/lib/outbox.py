@@ -0,0 +1,281 @@
+# This script holds a flash backed outbox. Readings are appended to segment files so they
+# survive resets and broker outages, and are read back in order from a cursor that only
+# moves on once they are published. It has the same interface as ReadingQueue
+#
+# Records are buffered in ram and written in batches, so while the broker is up readings
+# are usually published before they ever reach flash. A record is
+#   length (2 bytes), sequence number (4 bytes), json payload, CRC16 of the rest (2 bytes)
+# all little endian. A record cut short by a reset fails its CRC and ends its segment.
+# The cursor file holds the segment and offset of the next record to publish and the sequence
+# numbers reserved so far, and is replaced by renaming so it is never half written. Sequence
+# numbers are reserved SEQ_BLOCK at a time so they never repeat after a reset, even for
+# records that were still in ram. put() runs from the lora callback and only touches ram;
+# the reservation and the cursor are saved by flush(), peek() and pop() on the main loop
+#
+# A power cut loses the records still buffered in ram, at most flush_bytes or flush_ms
+# worth. Records that reached flash are never lost, and are only repeated, with their
+# sequence number, after a cut between publishing them and saving the cursor
+import os
+import ujson
+import ustruct
+from time import ticks_ms, ticks_diff
+from crc16 import crc16
+
+OUTBOX_DIR = 'outbox'
+SEGMENT_BYTES = 4096    # a segment is closed once it reaches this size, one flash block
+FLUSH_BYTES = 512       # buffered records are written once they reach this size
+FLUSH_MS = 60000        # or once the oldest of them is this old
+MAX_BYTES = 262144      # oldest segments are dropped once the outbox holds more than this
+RECORD_HEADER = '<HI'   # payload length, sequence number
+HEADER_LEN = 6
+CURSOR_FORMAT = '<III'  # segment, offset, first sequence number not reserved
+SEQ_BLOCK = 256
+CURSOR_LEN = 12
+
+
+class Outbox():
+    def __init__(self, path=OUTBOX_DIR, max_bytes=MAX_BYTES, flush_bytes=FLUSH_BYTES, flush_ms=FLUSH_MS, seq_key=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_bytes = flush_bytes
+        self.flush_ms = flush_ms
+        self.seq_key = seq_key  # if set, each item is handed out with its sequence number under this key
+        self._pending = []  # (sequence number, record) not yet in flash
+        self._pending_bytes = 0
+        self._pending_since = 0
+        self.received = 0
+        self.dropped = 0
+        self.published = 0
+        self.bytes_written = 0  # to flash, records and cursor
+        self.flushes = 0
+
+        if path not in os.listdir():
+            os.mkdir(path)
+        self._segments = sorted(int(f[:-4]) for f in os.listdir(path) if f.endswith('.seg'))
+        self._sizes = {}
+        for seg in self._segments:
+            self._sizes[seg] = os.stat(self._segment_file(seg))[6]
+        self._cursor, self._seq = self._read_cursor()
+        self._seq_reserved = self._seq
+
+        # count what is left to publish and find the last sequence number used. Records are
+        # only counted, not kept, so a full outbox fits in ram
+        self._count = 0
+        for seg, offset, seq, item in self._records(parse=False):
+            self._count += 1
+            self._seq = max(self._seq, seq + 1)
+        # never append after a record a reset may have cut short
+        self._write_seg = self._segments[-1] + 1 if self._segments else self._cursor[0]
+
+    def __len__(self):
+        return self._count + len(self._pending)
+
+    def _segment_file(self, seg):
+        return f'{self.path}/{seg:08d}.seg'
+
+    def _read_cursor(self):
+        try:
+            with open(f'{self.path}/cursor', 'rb') as f:
+                data = f.read()
+            if len(data) == CURSOR_LEN + 2 and crc16(data[:CURSOR_LEN]) == ustruct.unpack('<H', data[CURSOR_LEN:])[0]:
+                seg, offset, seq = ustruct.unpack(CURSOR_FORMAT, data[:CURSOR_LEN])
+                return (seg, offset), seq
+        except OSError:
+            pass
+        # no cursor or a damaged one: start from the oldest segment, repeating rather than losing
+        return (self._segments[0] if self._segments else 0, 0), 0
+
+    def _write_cursor(self):
+        data = ustruct.pack(CURSOR_FORMAT, self._cursor[0], self._cursor[1], self._seq_reserved)
+        data += ustruct.pack('<H', crc16(data))
+        with open(f'{self.path}/cursor.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(f'{self.path}/cursor.tmp', f'{self.path}/cursor')
+        self.bytes_written += len(data)
+
+    # (segment, end offset, sequence number, item) of each record in flash from the cursor on.
+    # item is None if parse is False
+    def _records(self, parse=True):
+        for seg in self._segments:
+            if seg < self._cursor[0]:
+                continue
+            offset = self._cursor[1] if seg == self._cursor[0] else 0
+            with open(self._segment_file(seg), 'rb') as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(HEADER_LEN)
+                    if len(header) < HEADER_LEN:
+                        break
+                    length, seq = ustruct.unpack(RECORD_HEADER, header)
+                    body = f.read(length + 2)
+                    if len(body) < length + 2 or crc16(body[:length], crc16(header)) != ustruct.unpack('<H', body[length:])[0]:
+                        break   # cut short by a reset, the rest of the segment is unusable
+                    offset += HEADER_LEN + length + 2
+                    yield seg, offset, seq, ujson.loads(body[:length]) if parse else None
+
+    # The first n records of _records() (all if n is None), with the segment file closed after
+    def _read(self, n=None):
+        records = []
+        if n == 0:
+            return records
+        gen = self._records()
+        for record in gen:
+            records.append(record)
+            if len(records) == n:
+                break
+        gen.close()
+        return records
+
+    # Records from the cursor on that are in segment seg, counted without keeping them
+    def _count_in(self, seg):
+        count = 0
+        gen = self._records(parse=False)
+        for record in gen:
+            if record[0] > seg:
+                break
+            if record[0] == seg:
+                count += 1
+        gen.close()
+        return count
+
+    # Queue an item. It is only buffered in ram until flush() writes it, with no flash access,
+    # so it is safe from a lora callback. Returns True
+    def put(self, item):
+        record = ujson.dumps(item).encode()
+        record = ustruct.pack(RECORD_HEADER, len(record), self._seq) + record
+        record += ustruct.pack('<H', crc16(record))
+        if not self._pending:
+            self._pending_since = ticks_ms()
+        self._pending.append((self._seq, record))
+        self._pending_bytes += len(record)
+        self._seq += 1
+        self.received += 1
+        return True
+
+    # Writes buffered records to flash once enough of them have built up or the oldest is
+    # old enough, or straight away if force is True. Call it from the main loop only, not
+    # from an interrupt or a lora callback
+    # Return: number of records written
+    def flush(self, force=False):
+        self._reserve()
+        if not self._pending:
+            return 0
+        if not force and self._pending_bytes < self.flush_bytes and ticks_diff(ticks_ms(), self._pending_since) < self.flush_ms:
+            return 0
+
+        pending = self._pending[:]
+        i = 0
+        while i < len(pending):
+            seg = self._write_seg
+            size = self._sizes.get(seg, 0)
+            if size and size + len(pending[i][1]) > SEGMENT_BYTES:
+                self._write_seg += 1
+                continue
+            # records of one write call all go to the same segment
+            batch = bytearray()
+            while i < len(pending) and (not batch or size + len(batch) + len(pending[i][1]) <= SEGMENT_BYTES):
+                batch += pending[i][1]
+                i += 1
+            with open(self._segment_file(seg), 'ab') as f:
+                f.write(batch)
+            if seg not in self._sizes:
+                self._segments.append(seg)
+            self._sizes[seg] = size + len(batch)
+            self.bytes_written += len(batch)
+            if self._sizes[seg] >= SEGMENT_BYTES:
+                self._write_seg += 1
+        self.flushes += 1
+
+        # records put while writing stay pending
+        del self._pending[:len(pending)]
+        self._pending_bytes = sum(len(record) for seq, record in self._pending)
+        self._pending_since = ticks_ms()
+        self._count += len(pending)
+        self._drop_over_capacity()
+        return len(pending)
+
+    # Saves the next block of sequence numbers once half the current one is used, or once
+    # put() has gone past it. Numbers past the saved block only ever reach ram, and are
+    # covered here before peek() hands them out or flush() writes them
+    def _reserve(self):
+        if self._seq + SEQ_BLOCK // 2 > self._seq_reserved:
+            self._seq_reserved = self._seq + SEQ_BLOCK
+            self._write_cursor()
+
+    def _drop_over_capacity(self):
+        while len(self._segments) > 1 and sum(self._sizes.values()) > self.max_bytes:
+            seg = self._segments[0]
+            if seg >= self._cursor[0]:
+                lost = self._count_in(seg)
+                self.dropped += lost
+                self._count -= lost
+                self._cursor = (self._segments[1], 0)
+                self._write_cursor()
+            self._remove_segment(seg)
+
+    def _remove_segment(self, seg):
+        os.remove(self._segment_file(seg))
+        self._segments.remove(seg)
+        del self._sizes[seg]
+
+    # Oldest n items (all if n is None) without removing them, so a failed publish loses nothing
+    def peek(self, n=None):
+        self._reserve()
+        items = [self._item(seq, item) for seg, offset, seq, item in self._read(n)]
+        for seq, record in self._pending:
+            if n is not None and len(items) >= n:
+                break
+            items.append(self._item(seq, ujson.loads(record[HEADER_LEN:-2])))
+        return items
+
+    def _item(self, seq, item):
+        if self.seq_key is not None:
+            item[self.seq_key] = seq
+        return item
+
+    # Remove the oldest n items once they have been handled. The cursor is saved once per
+    # call, so a reset before it is saved repeats these items rather than losing them
+    def pop(self, n=1):
+        records = self._read(n) if self._count else []
+        popped = len(records)
+        if popped:
+            self._count -= popped
+            self._cursor = records[-1][:2]
+            if self._count == 0:
+                # everything in flash is published, start afresh in a new segment
+                self._write_seg = self._segments[-1] + 1
+                for seg in self._segments[:]:
+                    self._remove_segment(seg)
+                self._cursor = (self._write_seg, 0)
+            else:
+                for seg in self._segments[:]:
+                    if seg < self._cursor[0]:
+                        self._remove_segment(seg)
+            self._write_cursor()
+
+        pending = min(n - popped, len(self._pending))
+        if pending > 0:
+            del self._pending[:pending]
+            self._pending_bytes = sum(len(record) for seq, record in self._pending)
+        self.published += popped + pending
+
+    # Remove the oldest items up to the first whose publish status is False. That item and
+    # everything after it stay queued so the order is kept
+    def pop_published(self, status_list):
+        n = 0
+        for status in status_list:
+            if not status:
+                break
+            n += 1
+        if n:
+            self.pop(n)
+
+    # Age in ms of the oldest record buffered in ram, 0 if none
+    def oldest_age_ms(self):
+        if not self._pending:
+            return 0
+        return ticks_diff(ticks_ms(), self._pending_since)
+
+    def stats(self):
+        return {'queued': len(self), 'received': self.received, 'dropped': self.dropped, 'published': self.published,
+                'flash_bytes': sum(self._sizes.values()), 'bytes_written': self.bytes_written}
@@ -0,0 +1,62 @@
+# This script holds a bounded queue used to buffer readings between the lora receive
+# callback and the mqtt publish loop
+from time import ticks_ms, ticks_diff
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class ReadingQueue():
+    def __init__(self, maxlen=50, drop_policy=DROP_OLDEST):
+        assert drop_policy in (DROP_OLDEST, DROP_NEWEST), 'Drop policy should be oldest or newest'
+        self.maxlen = maxlen
+        self.drop_policy = drop_policy
+        self._items = []
+        self._times = []    # ticks_ms each item was queued at
+        self.received = 0
+        self.dropped = 0
+        self.published = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    # Queue an item. Returns False if the item had to be dropped
+    def put(self, item):
+        self.received += 1
+        if len(self._items) >= self.maxlen:
+            self.dropped += 1
+            if self.drop_policy == DROP_NEWEST:
+                return False
+            del self._items[0]
+            del self._times[0]
+        self._items.append(item)
+        self._times.append(ticks_ms())
+        return True
+
+    # Oldest n items (all if n is None) without removing them, so a failed publish loses nothing
+    def peek(self, n=None):
+        return self._items[:n]
+
+    # Remove the oldest n items once they have been handled
+    def pop(self, n=1):
+        del self._items[:n]
+        del self._times[:n]
+        self.published += n
+
+    # Remove the oldest items whose publish status is True. Items that failed stay queued in order
+    def pop_published(self, status_list):
+        n = len(status_list)
+        failed = [item for item, status in zip(self._items, status_list) if not status]
+        failed_times = [t for t, status in zip(self._times, status_list) if not status]
+        self._items = failed + self._items[n:]
+        self._times = failed_times + self._times[n:]
+        self.published += n - len(failed)
+
+    # Age in ms of the oldest queued item, 0 if empty
+    def oldest_age_ms(self):
+        if not self._times:
+            return 0
+        return ticks_diff(ticks_ms(), self._times[0])
+
+    def stats(self):
+        return {'queued': len(self._items), 'received': self.received, 'dropped': self.dropped, 'published': self.published}
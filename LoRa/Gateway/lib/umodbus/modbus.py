@@ -19,9 +19,10 @@ import time
 from . import functions
 from . import const as Const
 from .common import Request
+from .register_bank import RegisterBank
 
 # typing not natively supported on MicroPython
-from .typing import Callable, dict_keys, List, Optional, Union
+from .typing import Callable, List, Optional, Union
 
 
 class Modbus(object):
@@ -41,7 +42,8 @@ class Modbus(object):
         self._available_register_types = ['COILS', 'HREGS', 'IREGS', 'ISTS']
         self._register_dict = dict()
         for reg_type in self._available_register_types:
-            self._register_dict[reg_type] = dict()
+            self._register_dict[reg_type] = RegisterBank(
+                bits=reg_type in ['COILS', 'ISTS'])
         self._default_vals = dict(zip(self._available_register_types,
                                       [False, 0, 0, False]))
 
@@ -113,7 +115,8 @@ class Modbus(object):
 
     def _create_response(self,
                          request: Request,
-                         reg_type: str) -> Union[List[bool], List[int]]:
+                         reg_type: str,
+                         raw: bool = False) -> Union[List[bool], List[int]]:
         """
         Create a response.
 
@@ -121,25 +124,16 @@ class Modbus(object):
         :type       request:   Request
         :param      reg_type:  The register type
         :type       reg_type:  str
+        :param      raw:       Flag whether to return the unsigned 16 bit
+                               content of registers set to a negative value
+        :type       raw:       bool
 
         :returns:   Values of this register
         :rtype:     Union[List[bool], List[int]]
         """
-        data = []
-        default_value = {'val': 0}
-        reg_dict = self._register_dict[reg_type]
-
-        if reg_type in ['COILS', 'ISTS']:
-            default_value = {'val': False}
-
-        for addr in range(request.register_addr,
-                          request.register_addr + request.quantity):
-            value = reg_dict.get(addr, default_value)['val']
-
-            if isinstance(value, (list, tuple)):
-                data.extend(value)
-            else:
-                data.append(value)
+        data = self._register_dict[reg_type].read(request.register_addr,
+                                                  request.quantity,
+                                                  raw=raw)
 
         # caution LSB vs MSB
         # [
@@ -180,17 +174,21 @@ class Modbus(object):
         :type       reg_type:  str
         """
         address = request.register_addr
+        registers = self._register_dict[reg_type]
 
-        if address in self._register_dict[reg_type]:
-
-            if self._register_dict[reg_type][address].get('on_get_cb', 0):
+        if address in registers:
+            _cb = registers.callbacks(address)[1]
+            if _cb:
                 vals = self._create_response(request=request,
                                              reg_type=reg_type)
-                _cb = self._register_dict[reg_type][address]['on_get_cb']
                 _cb(reg_type=reg_type, address=address, val=vals)
 
-            vals = self._create_response(request=request, reg_type=reg_type)
-            request.send_response(vals)
+            # the 16 bit content, the same bytes on the wire as a negative
+            # value packed signed
+            vals = self._create_response(request=request,
+                                         reg_type=reg_type,
+                                         raw=True)
+            request.send_response(vals, signed=False)
         else:
             request.send_exception(Const.ILLEGAL_DATA_ADDRESS)
 
@@ -247,8 +245,8 @@ class Modbus(object):
                 self._set_changed_register(reg_type=reg_type,
                                            address=address,
                                            value=val)
-                if self._register_dict[reg_type][address].get('on_set_cb', 0):
-                    _cb = self._register_dict[reg_type][address]['on_set_cb']
+                _cb = self._register_dict[reg_type].callbacks(address)[0]
+                if _cb:
                     _cb(reg_type=reg_type, address=address, val=val)
         else:
             request.send_exception(Const.ILLEGAL_DATA_ADDRESS)
@@ -325,12 +323,12 @@ class Modbus(object):
                                      address=address)
 
     @property
-    def coils(self) -> dict_keys:
+    def coils(self) -> List[int]:
         """
         Get the configured coils.
 
-        :returns:   The dictionary keys.
-        :rtype:     dict_keys
+        :returns:   The register addresses.
+        :rtype:     List[int]
         """
         return self._get_regs_of_dict(reg_type='COILS')
 
@@ -396,12 +394,12 @@ class Modbus(object):
                                      address=address)
 
     @property
-    def hregs(self) -> dict_keys:
+    def hregs(self) -> List[int]:
         """
         Get the configured holding registers.
 
-        :returns:   The dictionary keys.
-        :rtype:     dict_keys
+        :returns:   The register addresses.
+        :rtype:     List[int]
         """
         return self._get_regs_of_dict(reg_type='HREGS')
 
@@ -467,12 +465,12 @@ class Modbus(object):
                                      address=address)
 
     @property
-    def ists(self) -> dict_keys:
+    def ists(self) -> List[int]:
         """
         Get the configured discrete input registers.
 
-        :returns:   The dictionary keys.
-        :rtype:     dict_keys
+        :returns:   The register addresses.
+        :rtype:     List[int]
         """
         return self._get_regs_of_dict(reg_type='ISTS')
 
@@ -538,12 +536,12 @@ class Modbus(object):
                                      address=address)
 
     @property
-    def iregs(self) -> dict_keys:
+    def iregs(self) -> List[int]:
         """
         Get the configured input registers.
 
-        :returns:   The dictionary keys.
-        :rtype:     dict_keys
+        :returns:   The register addresses.
+        :rtype:     List[int]
         """
         return self._get_regs_of_dict(reg_type='IREGS')
 
@@ -583,75 +581,15 @@ class Modbus(object):
             raise KeyError('{} is not a valid register type of {}'.
                            format(reg_type, self._available_register_types))
 
-        if isinstance(value, (list, tuple)):
-            # flatten the list and add single registers only
-            for idx, val in enumerate(value):
-                this_addr = address + idx
-                self._set_single_reg_in_dict(reg_type=reg_type,
-                                             address=this_addr,
-                                             value=val,
-                                             on_set_cb=on_set_cb,
-                                             on_get_cb=on_get_cb)
-        else:
-            self._set_single_reg_in_dict(reg_type=reg_type,
-                                         address=address,
-                                         value=value,
-                                         on_set_cb=on_set_cb,
-                                         on_get_cb=on_get_cb)
-
-    def _set_single_reg_in_dict(self,
-                                reg_type: str,
-                                address: int,
-                                value: Union[bool, int],
-                                on_set_cb: Callable[
-                                    [str, int, Union[List[bool], List[int]]],
-                                    None
-                                ] = None,
-                                on_get_cb: Callable[
-                                    [str, int, Union[List[bool], List[int]]],
-                                    None
-                                ] = None) -> None:
-        """
-        Set a register value in the dictionary of registers.
-
-        :param      reg_type:   The register type
-        :type       reg_type:   str
-        :param      address:    The address (ID) of the register
-        :type       address:    int
-        :param      value:      The value of the register
-        :type       value:      Union[bool, int]
-        :param      on_set_cb:  Callback on setting the register
-        :type       on_get_cb:  Callable[
-            [str, int, Union[List[bool], List[int]]],
-            None
-            ]
-        :param      on_get_cb:  Callback on getting the register
-        :type       on_get_cb:  Callable[
-            [str, int, Union[List[bool], List[int]]],
-            None
-            ]
-        """
-        data = {'val': value}
-
-        # if the register exists already in the register dict a "set_*"
-        # function might have called this functions
-        if address in self._register_dict[reg_type]:
-            # try to get the (already) registered callback function from the
-            # register dict of this address with the this time call function
-            # parameter callback value as fallback
-            on_set_cb = self._register_dict[reg_type][address].get('on_set_cb',
-                                                                   on_set_cb)
-
-            on_get_cb = self._register_dict[reg_type][address].get('on_get_cb',
-                                                                   on_get_cb)
-
-        if callable(on_set_cb):
-            data['on_set_cb'] = on_set_cb
-
-        if callable(on_get_cb):
-            data['on_get_cb'] = on_get_cb
+        registers = self._register_dict[reg_type]
+        registers.set(address=address, value=value)
 
-        self._register_dict[reg_type][address] = data
+        if callable(on_set_cb) or callable(on_get_cb):
+            quantity = len(value) if isinstance(value, (list, tuple)) else 1
+            for this_addr in range(address, address + quantity):
+                registers.set_callbacks(address=this_addr,
+                                        on_set_cb=on_set_cb,
+                                        on_get_cb=on_get_cb)
 
     def _remove_reg_from_dict(self,
                               reg_type: str,
@@ -672,7 +610,7 @@ class Modbus(object):
             raise KeyError('{} is not a valid register type of {}'.
                            format(reg_type, self._available_register_types))
 
-        return self._register_dict[reg_type].pop(address, None)
+        return self._register_dict[reg_type].remove(address)
 
     def _get_reg_in_dict(self,
                          reg_type: str,
@@ -694,12 +632,12 @@ class Modbus(object):
                            format(reg_type, self._available_register_types))
 
         if address in self._register_dict[reg_type]:
-            return self._register_dict[reg_type][address]['val']
+            return self._register_dict[reg_type].get(address)
         else:
             raise KeyError('No {} available for the register address {}'.
                            format(reg_type, address))
 
-    def _get_regs_of_dict(self, reg_type: str) -> dict_keys:
+    def _get_regs_of_dict(self, reg_type: str) -> List[int]:
         """
         Get all configured registers of specified register type.
 
@@ -708,13 +646,13 @@ class Modbus(object):
 
         :raise      KeyError:  No register at specified address found
         :returns:   The configured registers of the specified register type.
-        :rtype:     dict_keys
+        :rtype:     List[int]
         """
         if not self._check_valid_register(reg_type=reg_type):
             raise KeyError('{} is not a valid register type of {}'.
                            format(reg_type, self._available_register_types))
 
-        return self._register_dict[reg_type].keys()
+        return self._register_dict[reg_type].addresses()
 
     def _check_valid_register(self, reg_type: str) -> bool:
         """
@@ -1,5 +1,5 @@
 from time import sleep
-from ulora import LoRa, ModemConfig, SPIConfig, conex_dict, ex_dict
+from ulora import LoRa, ModemConfig, SPIConfig, conex_dict, ex_dict, is_telemetry_frame, decode_telemetry
 import ujson
 
 uid_to_lora_map = {}   # map of device user_id to lora address
@@ -7,7 +7,10 @@ uid_to_lora_map = {}   # map of device user_id to lora address
 # This is our callback function that runs when a message is received
 def on_recv(payload):
     try:
-        client_message = ujson.loads(payload.message)
+        if is_telemetry_frame(payload.message):
+            client_message = decode_telemetry(payload.message)
+        else:
+            client_message = conex_dict(ujson.loads(payload.message), ex_dict)
     except Exception as e:
         print('Invalid payload message')
         return
@@ -15,13 +18,13 @@ def on_recv(payload):
     # Map new node id to the map list
     try:
         if payload.header_from not in uid_to_lora_map:
-            uid_to_lora_map[client_message['u_id']] = payload.header_from
+            uid_to_lora_map[client_message['user_id']] = payload.header_from
     except:
         print(f'Payload from address {payload.header_from} lacks user_id parameter')
         return
 
-    print(f'From: address {payload.header_from}, user_id: {client_message['u_id']}')
-    print(f'Received: {conex_dict(client_message, ex_dict)}')
+    print(f'From: address {payload.header_from}, user_id: {client_message['user_id']}')
+    print(f'Received: {client_message}')
     print(f'RSSI: {payload.rssi}, SNR: {payload.snr}')
     # RSSI: Received signal strength indicator
     # SNR: Signal to noise ratio
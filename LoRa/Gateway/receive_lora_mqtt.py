@@ -1,9 +1,10 @@
 from time import sleep
-from ulora import LoRa, ModemConfig, SPIConfig, conex_dict, ex_dict
+from ulora import LoRa, ModemConfig, SPIConfig, conex_dict, ex_dict, is_telemetry_frame, decode_telemetry, is_telemetry_batch, decode_telemetry_batch
 import ujson
 import machine
 from angaza_mqtt import *
 from device_handler import *
+from outbox import Outbox
 
 # Create DeviceDetails object to access/store device details on board
 device_details = DeviceDetails()
@@ -30,10 +31,23 @@ RA02_FREQ = 433.0
 RA02_POW = 18
 SERVER_ADDRESS = 1  # Address number of the server. Can be 0-255
 
+# Ingestion parameters
+OUTBOX_MAX_BYTES = 262144   # flash held by readings waiting to be published, oldest dropped beyond it
+PUBLISH_BATCH_LEN = 10  # readings sent to the esp per publish round trip
+LOOP_PERIOD_MIN = 0.2   # seconds between loop iterations while readings are arriving
+LOOP_PERIOD_MAX = 5     # seconds between loop iterations when idle
+DOWNLINK_QUEUE_LEN = 5  # downlinks held per node until it next sends, oldest dropped beyond it
+
 # initialise lora
 lora = LoRa(RA02_SPIBUS, RA02_INT, SERVER_ADDRESS, RA02_CS, reset_pin=RA02_RST, freq=RA02_FREQ, tx_power=RA02_POW, acks=True)
 uid_to_lora_map = {}   # map of device user_id to lora address
-payload_list = []
+# Nodes only listen after sending when the ack flags a downlink for them, so downlinks wait
+# here for the node's next uplink and go out straight after it
+downlink_dict = {}  # lora address -> downlink messages waiting for that node
+downlinks_due = []  # addresses that have just sent and are listening for a downlink
+# readings survive resets and broker outages in flash. Each is published with its outbox
+# sequence number as 'seq', so a reading repeated after a reset can be told apart
+payload_queue = Outbox(max_bytes=OUTBOX_MAX_BYTES, seq_key='seq')
 
 # Wireless specs. Store on device level
 # Make sure all mqtt related parameters are allowed in the policies!!!
@@ -55,26 +69,64 @@ def sub_callback(message):
     client_address = message_json.get('user_id', None)
 
     if client_address:
-        lora.send_to_wait(message, uid_to_lora_map[client_address])
+        address = uid_to_lora_map[client_address]
+        messages = downlink_dict.setdefault(address, [])
+        messages.append(message)
+        if len(messages) > DOWNLINK_QUEUE_LEN:
+            del messages[0]
+        lora.downlink_pending.add(address)  # flag it in the acks to the node's uplinks
+
 
-    sleep(1)
+# Sends the oldest waiting downlink to each node that has just sent. Nodes listen for one
+# downlink per uplink and are told by the ack flag when more are waiting
+def send_downlinks():
+    while downlinks_due:
+        address = downlinks_due.pop(0)
+        messages = downlink_dict.get(address, [])
+        if messages and lora.send_to_wait(messages[0], address):
+            del messages[0]
+        if not messages:
+            downlink_dict.pop(address, None)
+            lora.downlink_pending.discard(address)
     lora.set_mode_rx()
 
 
 # mqtt setup
 uart = machine.UART(0, baudrate=115200, tx=machine.Pin(0), rx=machine.Pin(1))   # Initialize uart on the rp2040
-mqtt = MQTTClient(uart_obj=uart, client_id=mqtt_client_id, server=mqtt_server, port=8883, keepalive=1200, ssl=True)
+mqtt = MQTTClient(uart_obj=uart, client_id=mqtt_client_id, server=mqtt_server, port=8883, keepalive=1200, ssl=True, clean_session=False)
 file_dict = {'key': private_key_file_name, 'cert': certificate_file_name}   # Make sure these files are in the rp2040 fs
 
+def connect_mqtt():
+    if not mqtt.connect(file_dict):   # Connect to mqtt broker
+        return False
+    mqtt.set_callback(subscribe_topic, sub_callback)  # Set callback function. Do this before subscribing
+    mqtt.subscriptions[subscribe_topic] = 0  # Topic to subscribe to. It is renewed by mqtt.resume() from now on
+    # Subscribe through the session, so it is marked subscribed and resume() does not subscribe again
+    if not mqtt.session & SESSION_SUBSCRIBED and not mqtt.restore_subscriptions():
+        return False
+    if not mqtt.push_msgs and not mqtt.enable_push():  # Have the esp forward messages as they arrive
+        print('ESP does not push messages. Polling with check_msg...')
+    return True
+
+# Recovery stages, cheapest first. mqtt.resume() only redoes the layers it is told are lost
+def reconnect_mqtt():
+    return mqtt.resume(SESSION_MQTT)
+
+def reconnect_wifi():
+    return mqtt.resume(SESSION_WIFI)
+
+def reset_esp():
+    uart_config(uart)   # Ensure graceful esp12-f startup
+    mqtt.lost(SESSION_WIFI | SESSION_TLS)
+    assert connect_to_wifi(uart, wifi_ssid, wifi_password) == True, 'Failed to connect to wifi'
+    return connect_mqtt()
+
+recovery = StagedRecovery([('mqtt', reconnect_mqtt), ('wifi', reconnect_wifi), ('esp', reset_esp)], breakers=[mqtt_breaker])
+
 def wireless_setup():
     while True:
         try:
-            uart_config(uart)   # Ensure graceful esp12-f startup
-            global wifi_ssid, wifi_password
-            assert connect_to_wifi(uart, wifi_ssid, wifi_password) == True, 'Failed to connect to wifi'
-            mqtt.connect(file_dict)   # Connect to mqtt broker
-            mqtt.set_callback(subscribe_topic, sub_callback)  # Set callback function. Do this before subscribing
-            mqtt.subscribe(subscribe_topic)  # Subscribe to a topic
+            assert reset_esp(), 'Failed to connect to mqtt broker'
             break
         except KeyboardInterrupt:
             raise KeyboardInterrupt
@@ -87,20 +139,12 @@ def wireless_setup():
 wireless_setup()
 
 
-# Define lora callback
-# This is our callback function that runs when a message is received from a lora client
-def on_recv(payload):
-    # Confirm payload is of good format
+# Queues a reading from a lora client for publishing
+def queue_reading(payload, push_dict):
     payload_user_id = None
     try:
-        client_message = ujson.loads(payload.message)
-    except Exception as e:
-        print('Invalid payload message. Ignoring mqtt publish...')
-        return
-
-    try:
+        payload_user_id = push_dict['user_id']
         if payload.header_from not in uid_to_lora_map:
-            payload_user_id = client_message['u_id']
             uid_to_lora_map[payload_user_id] = payload.header_from
     except:
         print(f'Payload from address {payload.header_from} lacks user_id parameter')
@@ -108,18 +152,42 @@ def on_recv(payload):
 
     try:
         if int(payload_user_id) == user_id:
-            push_dict = conex_dict(client_message, ex_dict)
             push_dict['client_id'] = mqtt_client_id
-            payload_list.append(push_dict)
-
-            if len(payload_list) > 5:
-                del payload_list[0]
+            if not payload_queue.put(push_dict):
+                print('Reading queue full. Dropping reading...')
         else:
             print(f'Ignoring publish of payload from user_id: {payload_user_id}')
     except:
         print('Failed to publish')
 
 
+# Define lora callback
+# This is our callback function that runs when a message is received from a lora client
+def on_recv(payload):
+    # the node listens for a downlink if the ack told it one is waiting
+    if payload.header_from in downlink_dict and payload.header_from not in downlinks_due:
+        downlinks_due.append(payload.header_from)
+
+    # Confirm payload is of good format
+    try:
+        # nodes send binary telemetry frames, batches of them or constricted json
+        if is_telemetry_batch(payload.message):
+            push_list = []
+            for age, push_dict in decode_telemetry_batch(payload.message):
+                push_dict['age'] = age  # seconds between taking the reading and receiving it
+                push_list.append(push_dict)
+        elif is_telemetry_frame(payload.message):
+            push_list = [decode_telemetry(payload.message)]
+        else:
+            push_list = [conex_dict(ujson.loads(payload.message), ex_dict)]
+    except Exception as e:
+        print('Invalid payload message. Ignoring mqtt publish...')
+        return
+
+    for push_dict in push_list:
+        queue_reading(payload, push_dict)
+
+
 # set lora callback
 lora.on_recv = on_recv
 
@@ -127,27 +195,64 @@ lora.on_recv = on_recv
 lora.set_mode_rx()
 
 # loop and wait for data
+loop_period = LOOP_PERIOD_MIN
+dropped = 0
 while True:
-    # Check for messages.
+    published = 0
+    if downlinks_due:
+        send_downlinks()
+
+    # Check for messages. Pushed messages are delivered while waiting below instead
     try:
-        mqtt.check_msg()
+        # after a failure, bring the link back before using it. Readings stay queued meanwhile
+        if recovery.active:
+            stage = recovery.run()
+            if stage is not None:
+                print(f'Recovered by {stage} stage')
+
+        if not recovery.active:
+            if not mqtt.push_msgs:
+                mqtt.check_msg()
 
-        if len(payload_list) > 0:
-            mqtt.publish(publish_topic, payload_list[0])
-            del payload_list[0]
+            # publish every reading that is ready in batches, removing each only once it is published
+            while len(payload_queue) > 0:
+                status_list = mqtt.publish_many(publish_topic, payload_queue.peek(PUBLISH_BATCH_LEN))
+                payload_queue.pop_published(status_list)
+                published += status_list.count(True)
+                if False in status_list:
+                    raise Exception('Failed to publish some readings')
     except KeyboardInterrupt:
         raise KeyboardInterrupt
     except Exception as e:
         print(f'Failed with error: {e}')
+        recovery.start()
+
+    # readings not published yet are written to flash in batches
+    try:
+        payload_queue.flush()
+    except OSError as e:
+        print(f'Outbox flush failed with error: {e}')
+
+    if payload_queue.dropped != dropped:
+        dropped = payload_queue.dropped
+        print(f'Readings dropped. Queue stats: {payload_queue.stats()}')
 
+    # poll quickly while readings are arriving and back off when idle
+    if published or len(payload_queue) > 0:
+        loop_period = LOOP_PERIOD_MIN
+    else:
+        loop_period = min(loop_period * 2, LOOP_PERIOD_MAX)
+
+    if mqtt.push_msgs and not recovery.active:
+        # wakes as soon as the esp pushes a message, so downlinks go out straight away
         try:
-            wireless_setup()
+            mqtt.poll_msgs(int(loop_period * 1000))
         except KeyboardInterrupt:
-            break
+            raise KeyboardInterrupt
         except Exception as e:
             print(f'Failed with error: {e}')
-
-    sleep(5)
+    else:
+        sleep(loop_period)
 
 
 private.pem.key
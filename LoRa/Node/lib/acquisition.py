@@ -0,0 +1,82 @@
+# This script holds a scheduler for reading a node's sensors. Sensors that take a while to
+# answer (a DS18B20 conversion, a DHT22 transaction) are started first and left to run while
+# the quick ones (ADC reads, a Modbus query) are read, and are collected once they are ready.
+# A cycle then takes about as long as its slowest sensor instead of the sum of all of them.
+# A sensor that fails or times out reads as None and the others are still returned
+from time import sleep_ms, ticks_ms, ticks_diff
+
+POLL_MS = 5             # how often sensors still running are checked once nothing else is left
+TIMEOUT_MS = 3000       # a sensor not ready this long after it was started has failed
+
+
+class Acquisition():
+    def __init__(self, timeout_ms=TIMEOUT_MS):
+        self.timeout_ms = timeout_ms
+        self.sensors = []   # (name, read, start, ready, result, stop) in the order they were added
+        self.cycle_ms = 0   # length of the last run()
+        self.sensor_ms = {} # name -> ms from the start of the last run() until its value was read
+        self.failed = []    # names of the sensors that failed or timed out in the last run()
+
+    # A sensor read by calling read(), which blocks until it has the value
+    def add(self, name, read):
+        self.sensors.append((name, read, None, None, None, None))
+
+    # A sensor that runs by itself once start() is called. ready() returns True once its
+    # value can be collected by result(). stop(), if given, powers it down when it times out
+    def add_started(self, name, start, ready, result, stop=None):
+        self.sensors.append((name, None, start, ready, result, stop))
+
+    # Started sensors that are ready are collected into values. Return: names still running
+    def _collect(self, running, values, t):
+        for name in running[:]:
+            sensor = self._sensor(name)
+            if sensor[3]():
+                try:
+                    values[name] = sensor[4]()
+                except Exception:
+                    self._fail(name, values)
+                self.sensor_ms[name] = ticks_diff(ticks_ms(), t)
+                running.remove(name)
+            elif ticks_diff(ticks_ms(), t) > self.timeout_ms:
+                self._fail(name, values)
+                if sensor[5] is not None:
+                    sensor[5]()
+                running.remove(name)
+        return running
+
+    def _fail(self, name, values):
+        values[name] = None
+        self.failed.append(name)
+
+    def _sensor(self, name):
+        for sensor in self.sensors:
+            if sensor[0] == name:
+                return sensor
+
+    # Reads every sensor once
+    # Return: dict of sensor name -> value
+    def run(self):
+        t = ticks_ms()
+        values = {}
+        self.sensor_ms = {}
+        self.failed = []
+        running = []
+        for name, read, start, ready, result, stop in self.sensors:
+            if start is not None:
+                start()
+                running.append(name)
+
+        for name, read, start, ready, result, stop in self.sensors:
+            if read is not None:
+                try:
+                    values[name] = read()
+                except Exception:
+                    self._fail(name, values)
+                self.sensor_ms[name] = ticks_diff(ticks_ms(), t)
+                # collect between blocking reads so a started sensor is not kept waiting
+                self._collect(running, values, t)
+
+        while self._collect(running, values, t):
+            sleep_ms(POLL_MS)
+        self.cycle_ms = ticks_diff(ticks_ms(), t)
+        return values
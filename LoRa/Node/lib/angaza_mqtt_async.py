@@ -0,0 +1,181 @@
+# This script holds an asyncio variant of the mqtt client. Every request sent to the esp
+# carries a request id that the esp echoes in its replies, so several operations can be
+# outstanding at once while a single reader task owns the uart and hands each reply to
+# the operation waiting on it. The reader awaits the uart through uartlib.AsyncLink, so
+# neither receiving nor waiting for acknowledgements blocks the event loop
+import uasyncio as asyncio
+import ujson
+import uartlib
+from angaza_mqtt import *
+from reading_queue import ReadingQueue
+
+MAX_OUTSTANDING = 4    # requests waiting on the esp at the same time
+INBOUND_QUEUE_LEN = 20  # subscribed messages held until they are read
+
+
+class AsyncMQTTClient(MQTTClient):
+    # connect and the certificate transfer stay synchronous and are done before start()
+    def __init__(self, uart_obj, client_id, server, max_outstanding=MAX_OUTSTANDING, **kwargs):
+        super().__init__(uart_obj, client_id, server, **kwargs)
+        self.max_outstanding = max_outstanding
+        self.inbound = ReadingQueue(INBOUND_QUEUE_LEN)
+        self._inbound_event = asyncio.Event()
+        self._requests = {}     # request id -> dict the reader fills in with the reply
+        self._slot_event = asyncio.Event()  # set when a request finishes
+        self._req_id = 0
+        self._reader_task = None
+        self.link = None
+
+
+    # Starts the reader task. Call it once connect() has succeeded. Requests are only told
+    # apart by their request id on the framed link, on the legacy link send_data_basic could
+    # take the reply to another request as the confirmation of its own
+    def start(self):
+        assert uartlib.frame_size is not None, 'Concurrent requests need the framed link, negotiate_frame_size failed'
+        if self._reader_task is None:
+            self.link = AsyncLink(self.uart_obj)
+            self._reader_task = asyncio.create_task(self._reader())
+
+
+    # Stops the reader task, e.g. before calling connect() again
+    def stop(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        for request in self._requests.values():
+            request['event'].set()
+
+
+    async def _reader(self):
+        while True:
+            try:
+                rxData = await self.link.receive()
+                self._dispatch(rxData[0], rxData[-1])
+            except Exception as e:
+                print(f'Reader failed with error: {e}')
+
+
+    def _dispatch(self, data, end_format):
+        if end_format == 'o':
+            print(data)
+            return
+        elif end_format == 'c':
+            # rare, the esp asks the rp2 to run a command. Its status goes out synchronously
+            # while the reader is here, so nothing else reads the uart meanwhile
+            process_command(self.uart_obj, data)
+            return
+        elif end_format != 'd' and end_format != 'j':
+            return
+
+        rxjson = ujson.loads(data)
+        req_id = rxjson.get('req_id', None)
+        if req_id is None and end_format == 'j':
+            # a subscribed message
+            self._deliver(rxjson)
+            return
+
+        request = self._requests.get(req_id, None)
+        if request is None:
+            # the request timed out or was sent by the synchronous client
+            return
+        if end_format == 'j':
+            request['json'] = rxjson
+        elif end_format == 'd':
+            request['status'] = rxjson.get('status')
+            request['event'].set()
+
+
+    def _deliver(self, msg):
+        f = self.cb.get(msg.get('topic', None), None)
+        if f is not None:
+            f(msg.get('message', None))
+        if not self.inbound.put(msg):
+            print('Inbound queue full. Dropping message...')
+        self._inbound_event.set()
+
+
+    # Sends one mqtt operation and waits for the esp to finish it
+    # Return: dict with the 'status' of the operation and any 'json' reply sent before it
+    async def _request(self, operation, argument, timeout_ms):
+        assert self._reader_task is not None, 'Call start() before sending requests'
+        while len(self._requests) >= self.max_outstanding:
+            self._slot_event.clear()
+            await self._slot_event.wait()
+
+        self._req_id = self._req_id % 0xffff + 1   # 0 means no request id
+        req_id = self._req_id
+        request = {'event': asyncio.Event(), 'status': None, 'json': None}
+        self._requests[req_id] = request
+        t = ticks_ms()
+        try:
+            await self.link.send(encode_command(operation, argument, req_id), end_format='command')
+            busy_ms = ticks_diff(ticks_ms(), t)
+            if timeout_ms is None:
+                await request['event'].wait()
+            else:
+                await asyncio.wait_for(request['event'].wait(), timeout_ms / 1000)
+        finally:
+            del self._requests[req_id]
+            self._slot_event.set()
+        report_latency(operation, busy_ms, ticks_diff(ticks_ms(), t) - busy_ms)
+        return request
+
+
+    async def publish(self, topic, msg):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        request = await self._request('mqtt_publish', [self.target_ref, topic, msg, self.publish_feedback], timeout_dict['publish'])
+        return request['status']
+
+
+    # Returns a list with the publish status of each message
+    async def publish_many(self, topic, messages):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        request = await self._request('mqtt_publish_batch', [self.target_ref, topic, messages, self.publish_feedback], timeout_dict['publish_many'])
+        status_list = None if request['json'] is None else request['json'].get('status_list')
+        return publish_statuses(status_list, request['status'], len(messages))
+
+
+    async def subscribe(self, topic, qos=0):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        request = await self._request('mqtt_subscribe', [self.target_ref, topic], timeout_dict['subscribe'])
+        return request['status']
+
+
+    # Asks the esp to push subscribed messages as they arrive, so check_msg is not needed
+    async def enable_push(self, enable=True):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        self.push_wanted = enable
+        request = await self._request('mqtt_push_msgs', [self.target_ref, enable], timeout_dict['enable_push'])
+        self.push_msgs = enable and bool(request['status'])
+        return request['status']
+
+
+    # Asks the esp for a pending message. Messages are delivered to the topic callback
+    # and queued for the async iterator
+    async def check_msg(self):
+        assert self.mqtt_connect_success, 'Device not connected to mqtt broker'
+        request = await self._request('mqtt_check_msg', [self.target_ref], timeout_dict['check_msg'])
+        if not request['status']:
+            raise Exception('check_msg failed')
+        return request['status']
+
+
+    async def wait_msg(self):
+        request = await self._request('mqtt_wait_msg', [self.target_ref], timeout_dict['wait_msg'])
+        if not request['status']:
+            raise Exception('wait_msg failed')
+        return request['status']
+
+
+    # async for msg in client: yields each subscribed message as {'topic': ..., 'message': ...}
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        while len(self.inbound) == 0:
+            self._inbound_event.clear()
+            await self._inbound_event.wait()
+        msg = self.inbound.peek(1)[0]
+        self.inbound.pop(1)
+        return msg
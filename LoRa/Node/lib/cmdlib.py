@@ -1,93 +1,354 @@
 # Author: Donatus
 # This script holds functions that enable execution of any commands called by the sending device
 import ujson
+import ubinascii
+import uhashlib
 from uartlib import *
+import uartlib
 from machine import UART
+from urandom import getrandbits
 
-retry_dict = {} # a dictionary to map function to its number of retries if it fails
+retry_dict = {} # a dictionary to map function to its number of retries if it fails, and optionally backoff_ms and backoff_max_ms
+breaker_dict = {}   # a dictionary to map function to the circuit breaker guarding it
 function_map = {}   # a dictionary to map command received to a function to be executed
 mqtt_operation_map = {} # a dictionary to map mqtt command received to a mqtt function to be executed
 handler_dict = {} # a dictionary to map terms to functions
 exempt_function_dict = {}  # a dict to hold functions exempted from handling on success or failure
+current_req_id = None   # request id of the command being executed, echoed back in its replies
+push_msg_dict = {}  # esp: mqtt target refs whose subscribed messages are pushed to the rp2
+key_cert_dict = {}  # esp: (mqtt ref, specifier) to the der blob of a key or certificate
+sysname = os.uname().sysname
 
+# Compact command envelope. A command is the json array [opcode, req_id, argument, ...]
+# instead of {'action': [name], name: {'arg_available': ..., 'argument': [...]}}. The
+# opcode is the position of the command in command_list, so both devices must share the
+# list: only ever append to it. req_id 0 means the replies need no request id. It is only
+# sent once the esp has advertised it (uartlib.compact_commands), older esp firmware gets
+# the dict envelope
+command_list = (
+    ('connect_to_wifi', function_map),
+    ('get_ntp_time', function_map),
+    ('mqtt_msg', function_map),
+    ('target_ref', mqtt_operation_map),
+    ('receive_key_cert', mqtt_operation_map),
+    ('mqtt_init', mqtt_operation_map),
+    ('mqtt_connect', mqtt_operation_map),
+    ('mqtt_publish', mqtt_operation_map),
+    ('mqtt_publish_batch', mqtt_operation_map),
+    ('mqtt_subscribe', mqtt_operation_map),
+    ('mqtt_check_msg', mqtt_operation_map),
+    ('mqtt_wait_msg', mqtt_operation_map),
+    ('mqtt_push_msgs', mqtt_operation_map),
+    ('mqtt_have_key_cert', mqtt_operation_map),
+)
+opcode_dict = {}    # command name to opcode
+for opcode, (name, f_map) in enumerate(command_list):
+    opcode_dict[name] = opcode
+opcode_handlers = [None] * len(command_list)    # opcode to handler, filled in on first use
+
+BACKOFF_MS = 500    # default delay before the first retry
+BACKOFF_MAX_MS = 30000  # default cap on the delay between retries
+
+
+## backoff_ms - delay before retry number attempt (from 0), doubling each time up to max_ms
+# Description - half the delay is random so devices that failed together retry apart
+def backoff_ms(attempt, base_ms=BACKOFF_MS, max_ms=BACKOFF_MAX_MS):
+    ceiling = min(max_ms, base_ms << min(attempt, 16))
+    return ceiling // 2 + (getrandbits(16) * (ceiling - ceiling // 2)) // 0xffff
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker():
+    # Stops calling operations that depend on something known to be down, e.g. the broker.
+    # After threshold failures in a row the breaker opens and calls are refused for open_ms.
+    # The first call after that is a trial: success closes the breaker, failure opens it again
+    # for twice as long, up to max_open_ms
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half open'
+
+    def __init__(self, name, threshold=3, open_ms=10000, max_open_ms=300000):
+        self.name = name
+        self.threshold = threshold
+        self.base_open_ms = open_ms
+        self.max_open_ms = max_open_ms
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_ms = self.base_open_ms
+        self.opened_at = 0
+
+    # Return: True if a call may go ahead
+    def allow(self):
+        if self.state == self.OPEN and ticks_diff(ticks_ms(), self.opened_at) >= self.open_ms:
+            self.state = self.HALF_OPEN
+        return self.state != self.OPEN
+
+    def success(self):
+        self.reset()
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.open_ms = min(self.open_ms * 2, self.max_open_ms)
+        elif self.failures < self.threshold:
+            return
+        self.state = self.OPEN
+        self.opened_at = ticks_ms()
+
+
+class StagedRecovery():
+    # Brings a link back cheapest stage first. stages is a list of (name, function) pairs,
+    # e.g. reconnect mqtt, then reconnect wifi, then reset the esp. Each failed round moves
+    # one stage up and waits an exponentially growing, jittered delay before the next round
+    def __init__(self, stages, base_ms=2000, max_ms=300000, breakers=()):
+        self.stages = stages
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.breakers = breakers    # closed again once a stage succeeds
+        self.active = False
+        self.level = 0
+        self.rounds = 0
+        self.wait_from = 0
+        self.wait_ms = 0
+
+    # Begins recovering after a failure. Does nothing if already recovering
+    def start(self):
+        if not self.active:
+            self.active = True
+            self.level = 0
+            self.rounds = 0
+            self.wait_ms = 0
+
+    # Runs the current stage once it is due
+    # Return: name of the stage that recovered the link, or None
+    def run(self):
+        if not self.active or ticks_diff(ticks_ms(), self.wait_from) < self.wait_ms:
+            return None
+
+        name, f = self.stages[self.level]
+        try:
+            recovered = f()
+        except CircuitOpen as e:
+            # something the stage needs is known to be down, wait without escalating
+            print(f'Recovery {name} skipped: {e}')
+            recovered = None
+        except Exception as e:
+            print(f'Recovery {name} failed with error: {e}')
+            recovered = False
+
+        if recovered:
+            self.active = False
+            for breaker in self.breakers:
+                breaker.reset()
+            return name
+
+        if recovered is not None:
+            self.level = min(self.level + 1, len(self.stages) - 1)
+        self.wait_from = ticks_ms()
+        self.wait_ms = backoff_ms(self.rounds, self.base_ms, self.max_ms)
+        self.rounds += 1
+        return None
+
+
+# Latency instrumentation. Set handler_dict['latency'] to a function f(name, busy_ms, wait_ms)
+# to be told, after each bridge operation, how long it spent waiting on the other device
+# (wait_ms) and on everything else such as transmitting and parsing (busy_ms)
+def report_latency(name, busy_ms, wait_ms):
+    f = handler_dict.get('latency', None)
+    if f is not None:
+        f(name, busy_ms, wait_ms)
+
+
+## timed - reports the latency of an operation that is not wrapped by func_handler
+def timed(func):
+    name = func.__name__
+
+    def wrapper(*args, **kwargs):
+        t = ticks_ms()
+        wait_ms = link_stats['wait_ms']
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wait_ms = link_stats['wait_ms'] - wait_ms
+            report_latency(name, ticks_diff(ticks_ms(), t) - wait_ms, wait_ms)
+
+    return wrapper
+
+
+## succeeded - tells whether a function's return value means it worked
+# Description - a list, e.g. one publish status per message, only counts as a success
+# when no entry is False
+def succeeded(execution_status):
+    if type(execution_status) is list:
+        return False not in execution_status
+    return bool(execution_status)
+
+
+# Policy from retry_dict and exempt_function_dict is looked up once when a function is
+# decorated, so add a function's entries before its @func_handler line. A function
+# returning a list that is partly False is not retried or failed over, its caller gets the
+# list to act on, but the breaker still counts it as a failure
 def func_handler(func):
+    name = func.__name__
+    func_retry_dict = retry_dict.get(name, None)
+    max_retries = 0 if func_retry_dict is None else func_retry_dict.get('retries', 0)
+    retry_base_ms = BACKOFF_MS if func_retry_dict is None else func_retry_dict.get('backoff_ms', BACKOFF_MS)
+    retry_max_ms = BACKOFF_MAX_MS if func_retry_dict is None else func_retry_dict.get('backoff_max_ms', BACKOFF_MAX_MS)
+    breaker = breaker_dict.get(name, None)
+    exempt = exempt_function_dict.get(name, ())
+    update_on_success = sysname == 'rp2' and 'on_success' not in exempt
+    standby_on_failure = sysname == 'rp2' and 'on_failure' not in exempt
+    raise_on_failure = sysname == 'esp8266' or (sysname == 'rp2' and 'on_failure' in exempt)
+    # only the rp2 backs off. The esp runs functions on behalf of the rp2, which is waiting
+    # for the reply with a timeout of its own and backs off itself when it retries
+    back_off = sysname == 'rp2'
+
     def wrapper(*args, **kwargs):
-        debug_func = kwargs.get('debug_func', False)
-        uart_obj = kwargs.get('uart_obj', None)
+        debug_func = kwargs.pop('debug_func', False)
+        uart_obj = kwargs.pop('uart_obj', None)
         # look to find if there is a uart object in args if it is not in kwargs
         if uart_obj is None:
             for x in args:
                 if type(x) is UART:
                     uart_obj = x
         
-        func_retry_dict = retry_dict.get(f'{func.__name__}', None)
-        retries = 0
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpen(f'{name} skipped while {breaker.name} is down')
 
-        if func_retry_dict is not None:
-            retries = func_retry_dict.get('retries', 0)
-
-        if 'debug_func' in kwargs:
-            del kwargs['debug_func']
-        
-        if 'uart_obj' in kwargs:
-            del kwargs['uart_obj']
+        retries = max_retries
+        t = ticks_ms()
+        wait_ms = link_stats['wait_ms']
         
         try:
             execution_status = func(*args, **kwargs)
-            sleep(0.1)
+            pace()
             if not execution_status:
-                print_s(uart_obj, f'{func.__name__} failed.{' Trying again...' if retries > 0 else ''}')
+                print_s(uart_obj, f'{name} failed.{' Trying again...' if retries > 0 else ''}')
         except Exception as e:
-            print_s(uart_obj, f'{func.__name__} failed with error: {e}.{' Trying again...' if retries > 0 else ''}')
+            print_s(uart_obj, f'{name} failed with error: {e}.{' Trying again...' if retries > 0 else ''}')
             execution_status = False
 
         while not execution_status and retries:
+            if back_off:
+                sleep(backoff_ms(max_retries - retries, retry_base_ms, retry_max_ms) / 1000)
+            # kwargs given by the caller take precedence over other_args instead of clashing
+            retry_kwargs = dict(func_retry_dict.get('other_args', {}))
+            retry_kwargs.update(kwargs)
             try:
-                execution_status = func(*args, **kwargs, **func_retry_dict.get('other_args', {}))
-                sleep(0.1)
+                execution_status = func(*args, **retry_kwargs)
+                pace()
                 if not execution_status:
-                    print_s(uart_obj, f'{func.__name__} failed.{' Trying again...' if retries > 0 else ''}')
+                    print_s(uart_obj, f'{name} failed.{' Trying again...' if retries > 0 else ''}')
 
             except Exception as e:
-                sleep(0.1)
-                print_s(uart_obj, f'{func.__name__} failed with error: {e}.{' Trying again...' if retries > 0 else ''}')
+                pace()
+                print_s(uart_obj, f'{name} failed with error: {e}.{' Trying again...' if retries > 0 else ''}')
                 execution_status = False
 
             retries -= 1
         
-        if execution_status:
+        wait_ms = link_stats['wait_ms'] - wait_ms
+        report_latency(name, ticks_diff(ticks_ms(), t) - wait_ms, wait_ms)
+        success = succeeded(execution_status)
+        if breaker is not None:
+            if success:
+                breaker.success()
+            else:
+                breaker.failure()
+
+        if success:
             if debug_func:
-                print_s(uart_obj, f'{func.__name__} succeeded')
-            if os.uname().sysname == 'rp2':
-                if exempt_function_dict.get(f'{func.__name__}', None) is None:
-                    handler_dict.get('update')()
-                elif exempt_function_dict.get(f'{func.__name__}', None) is not None:
-                    if 'on_success' not in exempt_function_dict.get(f'{func.__name__}'):
-                        handler_dict.get('update')()
-        elif not execution_status:                        
-            if os.uname().sysname == 'esp8266':
-                if debug_func:
-                    print_s(uart_obj, f'{func.__name__} failed')
-                raise Exception(f'{func.__name__} failed')
-            elif os.uname().sysname == 'rp2':
-                if exempt_function_dict.get(f'{func.__name__}', None) is None:
-                    handler_dict.get('standby')()
-                elif exempt_function_dict.get(f'{func.__name__}', None) is not None:
-                    if 'on_failure' not in exempt_function_dict.get(f'{func.__name__}'):
-                        handler_dict.get('standby')()
-                    elif 'on_failure' in exempt_function_dict.get(f'{func.__name__}'):
-                        raise Exception(f'{func.__name__} failed')
-            
+                print_s(uart_obj, f'{name} succeeded')
+            if update_on_success:
+                handler_dict.get('update')()
+        elif execution_status:
+            print_s(uart_obj, f'{name} partly failed: {execution_status}')
+        elif not execution_status:
+            if debug_func and sysname == 'esp8266':
+                print_s(uart_obj, f'{name} failed')
+            if standby_on_failure:
+                handler_dict.get('standby')()
+            elif raise_on_failure:
+                raise Exception(f'{name} failed')
         
         return execution_status
     
     return wrapper
 
 
+## encode_command - builds the envelope of a command in command_list, the compact one if
+# the esp takes it
+def encode_command(name, args, req_id=0):
+    if uartlib.compact_commands:
+        return ujson.dumps([opcode_dict[name], req_id] + list(args))
+
+    args = list(args)
+    if command_list[opcode_dict[name]][1] is mqtt_operation_map:
+        args = [{'operation': name, name: {'arg_available': len(args) > 0, 'argument': args}}]
+        name = 'mqtt_operation'
+    txjson = {'action': [name], name: {'arg_available': len(args) > 0, 'argument': args}}
+    if req_id:
+        txjson['req_id'] = req_id
+    return ujson.dumps(txjson)
+
+
+## send_command - sends a command in the envelope the esp takes
+def send_command(uart_obj, name, *args, req_id=0):
+    send_data(uart_obj, encode_command(name, args, req_id), end_format='command')
+
+
+## run_opcode - runs the handler of a compact command
+# Return: True if the handler succeeded
+def run_opcode(uart_obj, opcode, args):
+    if opcode < 0 or opcode >= len(command_list):
+        print_s(uart_obj, f'{sysname.upper()}: Opcode {opcode} not found')
+        return False
+
+    f_found = opcode_handlers[opcode]
+    if f_found is None:
+        name, f_map = command_list[opcode]
+        f_found = f_map.get(name, None)
+        if f_found is None:
+            print_s(uart_obj, f'{sysname.upper()}: Function {name} not found')
+            return False
+        opcode_handlers[opcode] = f_found
+
+    try:
+        return bool(f_found(uart_obj, *args))
+    except Exception as e:
+        print_s(uart_obj, f'{sysname.upper()} Error: {e}')
+        return False
+
+
+## send_status - reports the outcome of a command to the device that sent it
+def send_status(uart_obj, execution_list):
+    global current_req_id
+    txjson = {'status': False not in execution_list, 'status_list': execution_list}
+    if current_req_id is not None:
+        txjson['req_id'] = current_req_id
+    current_req_id = None
+    # print(ujson.dumps(txjson))
+    pace(0.01)
+    send_data(uart_obj, ujson.dumps(txjson), end_format='command_execution')
+
+
 def process_command(uart_obj, rxData):
-    sleep(0.01)
+    global current_req_id
+    pace(0.01)
     rxjson = ujson.loads(rxData)
+    if type(rxjson) is list:
+        current_req_id = rxjson[1] if rxjson[1] else None
+        send_status(uart_obj, [run_opcode(uart_obj, rxjson[0], rxjson[2:])])
+        return True
+
     f_list = rxjson.get('action', None)
+    current_req_id = rxjson.get('req_id', None)
     execution_list = []
 
     if f_list is None:
@@ -120,12 +381,7 @@ def process_command(uart_obj, rxData):
             print_s(uart_obj, f'{os.uname().sysname.upper()} Error: {e}')
             execution_list.append(False)
     
-    execution_status = False not in execution_list
-    
-    txjson = {'status': execution_status, 'status_list': execution_list}
-    # print(ujson.dumps(txjson))
-    sleep(0.01)
-    send_data(uart_obj, ujson.dumps(txjson), end_format='command_execution')
+    send_status(uart_obj, execution_list)
     return True
 
 
@@ -150,4 +406,93 @@ def mqtt_operation(uart_obj, params):
             return False
 
 
-function_map['mqtt_operation'] =  mqtt_operation
\ No newline at end of file
+# Publishes each message of a batch with the device's mqtt_publish operation and
+# sends the per message status list back as json before the command completes
+def mqtt_publish_batch(uart_obj, target_ref, topic, messages, feedback=True):
+    f_publish = mqtt_operation_map.get('mqtt_publish', None)
+
+    if f_publish is None:
+        return False
+
+    status_list = []
+    for msg in messages:
+        try:
+            status_list.append(bool(f_publish(uart_obj, target_ref, topic, msg, feedback)))
+        except Exception as e:
+            print_s(uart_obj, f'{os.uname().sysname.upper()} Error: {e}')
+            status_list.append(False)
+
+    txjson = {'status_list': status_list}
+    if current_req_id is not None:
+        txjson['req_id'] = current_req_id
+    send_data(uart_obj, ujson.dumps(txjson), end_format='json')
+    return False not in status_list
+
+
+# Turns pushing of subscribed messages for target_ref on or off
+def mqtt_push_msgs(uart_obj, target_ref, enable=True):
+    push_msg_dict[target_ref] = enable
+    return True
+
+
+# Sends a subscribed message to the rp2 unsolicited, the moment it arrives on the esp.
+# Call it from the esp mqtt client's callback. Returns False if pushing is off, in
+# which case the message should be kept for mqtt_check_msg as before
+def push_mqtt_msg(uart_obj, target_ref, topic, msg):
+    if not push_msg_dict.get(target_ref, False):
+        return False
+
+    if type(topic) is bytes:
+        topic = topic.decode('utf-8')
+    if type(msg) is bytes:
+        msg = msg.decode('utf-8')
+    send_data(uart_obj, ujson.dumps({'topic': topic, 'message': msg}), end_format='json')
+    return True
+
+
+## sha256_hex - hex sha256 digest of a key or certificate, used to tell blobs apart
+def sha256_hex(data):
+    return ubinascii.hexlify(uhashlib.sha256(data).digest()).decode()
+
+
+## key_cert_file - flash file a key or certificate blob with the given digest is kept in
+def key_cert_file(specifier, digest):
+    return f'kc_{specifier}_{digest[:16]}.der'
+
+
+# Keeps a key or certificate the esp received in flash, so a later mqtt_init with the same
+# blob can skip the transfer. Call it from the esp's receive_key_cert once the blob is in.
+# Older blobs of the same specifier are removed
+# Return: the digest of the blob
+def store_key_cert(ref, specifier, data):
+    digest = sha256_hex(data)
+    filename = key_cert_file(specifier, digest)
+    for f in os.listdir():
+        if f.startswith(f'kc_{specifier}_') and f != filename:
+            os.remove(f)
+    with open(filename, 'wb') as f:
+        f.write(data)
+    key_cert_dict[(ref, specifier)] = data
+    return digest
+
+
+# Loads the blob with the given digest from flash into key_cert_dict for ref if the esp has it.
+# Returns False if it does not, in which case the rp2 sends it with receive_key_cert
+def mqtt_have_key_cert(uart_obj, ref, specifier, digest):
+    filename = key_cert_file(specifier, digest)
+    if filename not in os.listdir():
+        return False
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if sha256_hex(data) != digest:
+        # corrupted or a clash on the shortened name, have it sent again
+        os.remove(filename)
+        return False
+    key_cert_dict[(ref, specifier)] = data
+    return True
+
+
+function_map['mqtt_operation'] =  mqtt_operation
+mqtt_operation_map['mqtt_publish_batch'] = mqtt_publish_batch
+mqtt_operation_map['mqtt_push_msgs'] = mqtt_push_msgs
+mqtt_operation_map['mqtt_have_key_cert'] = mqtt_have_key_cert
\ No newline at end of file
@@ -1,11 +1,88 @@
 # Author: Donatus
 from time import sleep, ticks_ms, ticks_diff
 from machine import Timer, Pin
+from crc16 import crc16    # modbus CRC16 of data, continuing from crc
+import uselect
 import os
 
 if os.uname().sysname == 'rp2':
     from pcf8574 import *
 
+# Framed transfers. Once both sides agree on a frame size in negotiate_frame_size, all data
+# is sent as frames of
+#   FRAME_SYNC, type, sequence number, payload length, payload, CRC16 (modbus, little endian)
+# with the CRC covering type to payload. Data is split into frames of at most frame_size
+# bytes; the last frame has the format character as its type, earlier ones type 0. Up to
+# window_size frames are in flight. The receiver answers with a FRAME_ACK frame carrying the
+# next expected sequence number after every window_size frames and after the last one, or a
+# FRAME_NAK frame with the next expected sequence number when it spots a gap
+FRAME_SYNC = 0xa5
+FRAME_ACK = ord('a')
+FRAME_NAK = ord('n')
+FRAME_TYPES = b'\x00anbcdjos'    # middle frame, ack, nak, then the last frame of bytes or each end format
+FRAME_HEADER_LEN = 4
+FRAME_OVERHEAD = FRAME_HEADER_LEN + 2
+MAX_FRAME_SIZE = 255
+MAX_WINDOW_SIZE = 4
+MIN_FRAME_SIZE = 12
+window_retries = 3
+# bytes the uart of this device can buffer, set it to the rxbuf given to UART.init. Both
+# ports default to 256: the rp2 uart rxbuf and the esp8266 uart0 ring buffer. A too small
+# value here gives frames smaller than the legacy 12 byte chunks
+rx_buffer_size = 256
+frame_size = None   # None until negotiated, data is then sent in max_char chunks waiting for 'waiting next'
+window_size = 1
+# esp: ticks_ms when it switched to the agreed frame size, None once the rp2 has confirmed
+# the switch with its first frame. Without that confirmation by FRAME_CONFIRM_MS it goes
+# back to the legacy chunking, since the rp2 never got the answer or gave up on it
+frame_unconfirmed_at = None
+FRAME_CONFIRM_MS = 5000
+# True once the esp has said in negotiate_frame_size that it takes the compact command
+# envelope. Until then commands go in the dict envelope every esp firmware understands
+compact_commands = False
+
+format_chars = {'command': 'c', 'command_execution': 'd', 'json': 'j', 'esp_output': 'o', 'string': 's'}
+
+# Waiting for the other side. Instead of spinning on uart.any() the uart is registered
+# with a poller, which parks the core until the uart rx interrupt (or a timer tick)
+# wakes it. This is the same ioctl uasyncio's StreamReader waits on
+rx_pollers = {}
+link_stats = {'wait_ms': 0}     # total time parked in wait_rx, used for latency reporting
+
+
+## wait_rx - sleeps until bytes are waiting on the uart or timeout_ms passes, -1 waits forever
+# Return: True if bytes are waiting
+def wait_rx(uart_obj, timeout_ms):
+    if uart_obj.any() > 0:
+        return True
+
+    poller = rx_pollers.get(id(uart_obj))
+    if poller is None:
+        poller = uselect.poll()
+        poller.register(uart_obj, uselect.POLLIN)
+        rx_pollers[id(uart_obj)] = poller
+
+    t = ticks_ms()
+    poller.poll(timeout_ms)
+    link_stats['wait_ms'] += ticks_diff(ticks_ms(), t)
+    return uart_obj.any() > 0
+
+
+## pace - spaces out messages when the other side may not be reading yet
+# Description - once frame sizes are negotiated every message is acknowledged, so a
+# message is only sent on once the other side has read the one before and no delay is
+# needed. The legacy framing can merge back to back messages into one read, so it keeps
+# a fixed delay
+def pace(seconds=0.1):
+    if frame_size is None:
+        sleep(seconds)
+
+
+## data_waiting - checks for received data that has not been handed to receive_data yet
+# Return: True if receive_data has something to read
+def data_waiting(uart_obj):
+    return len(pending_frames) > 0 or frame_parser.buffered() > 0 or uart_obj.any() > 0
+
 ## process_txData - adds formatting character to raw txData
 # txData - raw txData to be processed
 # Return: processed txData
@@ -46,11 +123,8 @@ def send_data_basic(uart_obj, txData, **kwargs):
         uart_obj.write(bytes(txData, 'utf-8'))
     
     if not jump_receive:        
-        t = ticks_ms()
-        while uart_obj.any() == 0:
-            sleep(0.0001)
-            if ticks_diff(ticks_ms(), t) > timeout_ms:
-                raise Exception('Waiting for confirmation timed out')
+        if not wait_rx(uart_obj, timeout_ms):
+            raise Exception('Waiting for confirmation timed out')
 
         rx_temp = receive_data(uart_obj)
         # print(f'rx_temp: {rx_temp}')
@@ -72,7 +146,9 @@ def send_data_basic(uart_obj, txData, **kwargs):
 # and send them one at a time
 def send_data(uart_obj, txData, **kwargs):
     max_char = kwargs.get('max_char', None)
-    if max_char is None:
+    if max_char is None and frame_size is not None:
+        max_char = frame_size
+    elif max_char is None:
         max_char = 285 if os.uname().sysname == 'esp8266' else 12
     end_format = kwargs.get('end_format', 'string')
     retain_bytes = type(txData) is bytes
@@ -85,7 +161,10 @@ def send_data(uart_obj, txData, **kwargs):
     elif retain_bytes and (txData == b'received all' or txData == b'waiting next'):
         jump_receive = True
     
-    if txlen <= max_char:
+    if frame_size is not None:
+        received_final = send_data_framed(uart_obj, txData, retain_bytes, end_format, max_char)
+
+    elif txlen <= max_char:
         packet_end = b'e' if retain_bytes else 'e'
         txData = process_txData(txData, retain_bytes, end_format, packet_end)
         received_final = send_data_basic(uart_obj, txData, retain_bytes=retain_bytes, jump_receive=jump_receive)
@@ -124,9 +203,453 @@ def send_data(uart_obj, txData, **kwargs):
     return None
 
 
+class FrameParser():
+    # Incremental frame parser. Uart bytes are read straight into a fixed buffer, so
+    # frames split over several reads or several frames in one read are both fine.
+    # Noise, impossible headers and frames failing the CRC are skipped up to the next
+    # FRAME_SYNC byte
+    def __init__(self, size=2 * (MAX_FRAME_SIZE + FRAME_OVERHEAD)):
+        self.max_payload = MAX_FRAME_SIZE
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.crc_errors = 0
+        self.skipped = 0
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def buffered(self):
+        return self.end - self.start
+
+    # give up on the frame at the front, e.g. when a corrupted length waits for bytes that never come
+    def drop(self):
+        if self.start < self.end:
+            self.start += 1
+            self.skipped += 1
+
+    # free space at the end of the buffer for at least one whole frame
+    # Return: bytes that fit at the end
+    def space(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < MAX_FRAME_SIZE + FRAME_OVERHEAD:
+            # move the partial frame to the front
+            length = self.end - self.start
+            self.buf[0:length] = self.buf[self.start:self.end]
+            self.start, self.end = 0, length
+        return len(self.buf) - self.end
+
+    # read what the uart holds into the free end of the buffer
+    def fill(self, uart_obj):
+        self.space()
+        available = uart_obj.any()
+        if available > 0:
+            self.end += uart_obj.readinto(self.mv[self.end:], min(available, len(self.buf) - self.end)) or 0
+
+    # add bytes read elsewhere, e.g. by a uasyncio StreamReader. At most space() bytes
+    def feed(self, data):
+        if data:
+            self.buf[self.end:self.end + len(data)] = data
+            self.end += len(data)
+
+    # Return: (frame type, sequence number, payload) for the next complete frame or None.
+    # payload is a memoryview into the buffer, valid until the next fill
+    def next_frame(self):
+        buf = self.buf
+        while self.end - self.start >= FRAME_HEADER_LEN:
+            frame_start = self.start
+            if buf[frame_start] != FRAME_SYNC or buf[frame_start + 1] not in FRAME_TYPES or \
+                    buf[frame_start + 3] > self.max_payload:
+                self.start += 1
+                self.skipped += 1
+                continue
+
+            frame_end = frame_start + FRAME_OVERHEAD + buf[frame_start + 3]
+            if frame_end > self.end:
+                return None
+
+            crc = crc16(self.mv[frame_start + 1: frame_end - 2])
+            if buf[frame_end - 2] != crc & 0xff or buf[frame_end - 1] != crc >> 8:
+                self.crc_errors += 1
+                self.start += 1
+                continue
+
+            self.start = frame_end
+            return buf[frame_start + 1], buf[frame_start + 2], self.mv[frame_start + FRAME_HEADER_LEN: frame_end - 2]
+
+        return None
+
+
+frame_parser = FrameParser()
+pending_frames = []     # data frames that arrived while waiting for an acknowledgement
+rx_expected = 0     # next sequence number of the data being received
+rx_last = None      # sequence number of the last frame of the data received before, to spot it being resent
+_tx_header = bytearray(FRAME_HEADER_LEN)
+_tx_header[0] = FRAME_SYNC
+_tx_crc = bytearray(2)
+
+
+## write_frame - writes one frame to the uart
+def write_frame(uart_obj, frame_type, seq, payload=b''):
+    _tx_header[1] = frame_type
+    _tx_header[2] = seq & 0xff
+    _tx_header[3] = len(payload)
+    crc = crc16(payload, crc16(memoryview(_tx_header)[1:]))
+    _tx_crc[0] = crc & 0xff
+    _tx_crc[1] = crc >> 8
+    uart_obj.write(_tx_header)
+    if payload:
+        uart_obj.write(payload)
+    uart_obj.write(_tx_crc)
+
+
+## read_frame - waits for the next complete frame
+# Return: (frame type, sequence number, payload) or None if no bytes arrive for timeout_ms
+def read_frame(uart_obj, timeout_ms):
+    while True:
+        frame = frame_parser.next_frame()
+        if frame is not None:
+            return frame
+
+        if wait_rx(uart_obj, timeout_ms):
+            frame_parser.fill(uart_obj)
+        else:
+            frame_parser.drop()
+            return frame_parser.next_frame()
+
+
+## send_data_framed - sends data as numbered frames, window_size at a time
+# Return: "received all"
+# Description - frames are resent from the first one the receiver lacks
+# (go back n) on a nak or when no ack arrives within timeout_ms
+def send_data_framed(uart_obj, txData, retain_bytes, end_format, max_char, **kwargs):
+    timeout_ms = kwargs.get('timeout_ms', 2000)
+    if not retain_bytes:
+        txData = bytes(txData, 'utf-8')
+    last_type = ord('b') if retain_bytes else ord(format_chars[end_format])
+    frame_count = max((len(txData) + max_char - 1) // max_char, 1)
+    tx_view = memoryview(txData)
+    base = 0    # first frame not yet acknowledged
+    next_frame = 0
+    retries = window_retries
+
+    while base < frame_count:
+        while next_frame < frame_count and next_frame - base < window_size:
+            frame_type = last_type if next_frame == frame_count - 1 else 0
+            write_frame(uart_obj, frame_type, next_frame, tx_view[next_frame * max_char: (next_frame + 1) * max_char])
+            next_frame += 1
+
+        frame = read_frame(uart_obj, timeout_ms)
+        while frame is not None and frame[0] not in (FRAME_ACK, FRAME_NAK):
+            # the other side started sending too
+            stash_frame(uart_obj, frame)
+            frame = read_frame(uart_obj, timeout_ms)
+
+        if frame is not None:
+            expected = base + ((frame[1] - base) & 0xff)
+            if expected <= next_frame:
+                base = expected
+                if frame[0] == FRAME_NAK:
+                    next_frame = base
+                retries = window_retries
+                continue
+
+        # lost acknowledgement, resend the window
+        retries -= 1
+        if retries < 0:
+            raise Exception('Waiting for frame acknowledgement timed out')
+        next_frame = base
+
+    return b'received all' if retain_bytes else "received all"
+
+
+## stash_frame - keeps a data frame that arrived during send_data_framed for receive_data
+# Description - the frame is acknowledged the way receive_data_framed would, so the
+# other side is not left waiting while both ends are sending
+def stash_frame(uart_obj, frame):
+    global rx_expected, rx_last
+    frame_type, seq, payload = frame
+    if seq == rx_expected & 0xff:
+        pending_frames.append((frame_type, seq, bytes(payload)))
+        rx_expected += 1
+        if frame_type or rx_expected % window_size == 0:
+            write_frame(uart_obj, FRAME_ACK, rx_expected)
+        if frame_type:
+            rx_expected = 0
+            rx_last = seq
+    elif rx_expected == 0 and frame_type and seq == rx_last:
+        write_frame(uart_obj, FRAME_ACK, seq + 1)
+    elif 0 < (rx_expected - seq) & 0xff <= MAX_WINDOW_SIZE:
+        write_frame(uart_obj, FRAME_ACK, rx_expected)
+    else:
+        write_frame(uart_obj, FRAME_NAK, rx_expected)
+
+
+## receive_data_framed - reassembles frames sent by send_data_framed
+# Return: a list with the received data and the format character or None if nothing arrived
+def receive_data_framed(uart_obj, **kwargs):
+    global rx_expected, rx_last
+    timeout_ms = kwargs.get('timeout_ms', 2000)
+    rxData = bytearray()
+    expected = 0
+    nak_sent = False
+    retries = window_retries
+
+    while True:
+        if pending_frames:
+            # in order and acknowledged by stash_frame already
+            frame_type, seq, payload = pending_frames.pop(0)
+            rxData += payload
+            expected += 1
+            if frame_type:
+                return [bytes(rxData), chr(frame_type)]
+            continue
+
+        frame = read_frame(uart_obj, timeout_ms)
+        if frame is None:
+            if expected == 0:
+                return None
+            # the rest of the window or its ack got lost, ask for it again
+            retries -= 1
+            if retries < 0:
+                rx_expected = 0
+                raise Exception('Waiting for receive timed out')
+            write_frame(uart_obj, FRAME_NAK, expected)
+            continue
+        frame_type, seq, payload = frame
+
+        if frame_type == FRAME_ACK or frame_type == FRAME_NAK:
+            continue    # stale acknowledgement
+
+        if seq == expected & 0xff:
+            rxData += payload
+            expected += 1
+            rx_expected = 0 if frame_type else expected
+            nak_sent = False
+            retries = window_retries
+
+            if frame_type:
+                rx_last = seq
+                write_frame(uart_obj, FRAME_ACK, expected)
+                return [bytes(rxData), chr(frame_type)]
+            if expected % window_size == 0:
+                write_frame(uart_obj, FRAME_ACK, expected)
+        elif expected == 0 and frame_type and seq == rx_last:
+            # resent end of data already received, its ack got lost. Any other end
+            # frame means the start of the data got lost and gets a nak below
+            write_frame(uart_obj, FRAME_ACK, seq + 1)
+        elif 0 < (expected - seq) & 0xff <= MAX_WINDOW_SIZE:
+            # resent frame already received, the ack got lost
+            write_frame(uart_obj, FRAME_ACK, expected)
+        elif not nak_sent:
+            write_frame(uart_obj, FRAME_NAK, expected)
+            nak_sent = True
+
+
+## AsyncLink - framed transfers for uasyncio
+# Description - the framed link without blocking the event loop. One task calls receive()
+# in a loop and so owns the uart: it awaits the uart through a StreamReader, reassembles
+# and acknowledges data frames and hands acknowledgements to send(), which waits on an
+# event for them instead of reading the uart itself. The legacy link has no frames to tell
+# replies and confirmations apart, so AsyncLink needs a negotiated frame size
+class AsyncLink():
+    def __init__(self, uart_obj, timeout_ms=2000):
+        import uasyncio as asyncio
+        if frame_size is None:
+            raise Exception('AsyncLink needs a negotiated frame size')
+        self.uart_obj = uart_obj
+        self.timeout_ms = timeout_ms
+        self.stream = asyncio.StreamReader(uart_obj)
+        self.ack = None
+        self.ack_event = asyncio.Event()
+        self.tx_lock = asyncio.Lock()
+        self.rx_data = bytearray()
+        self.rx_expected = rx_expected  # carries on with data the synchronous side started receiving
+        self.rx_at = ticks_ms()
+        self.nak_sent = False
+
+    def _received(self, frame_type, seq):
+        global rx_last
+        rx_last = seq
+        rxData = bytes(self.rx_data)
+        self.rx_data = bytearray()
+        self.rx_expected = 0
+        if frame_type == ord('b'):
+            return [rxData, 'b']
+        return [rxData.decode('utf-8'), chr(frame_type)]
+
+    # Waits for the next message from the other side
+    # Return: a list with the received data and the format character, as receive_data
+    async def receive(self):
+        while True:
+            if pending_frames:
+                # stashed and acknowledged by the synchronous side
+                frame_type, seq, payload = pending_frames.pop(0)
+                self.rx_data += payload
+                self.rx_expected += 1
+                if frame_type:
+                    return self._received(frame_type, seq)
+                continue
+
+            frame = frame_parser.next_frame()
+            if frame is None:
+                frame_parser.feed(await self.stream.read(frame_parser.space()))
+                continue
+            frame_type, seq, payload = frame
+
+            if frame_type == FRAME_ACK or frame_type == FRAME_NAK:
+                self.ack = (frame_type, seq)
+                self.ack_event.set()
+                continue
+
+            if self.rx_expected and ticks_diff(ticks_ms(), self.rx_at) > self.timeout_ms * (window_retries + 1):
+                # the sender gave up on the data being received
+                self.rx_data = bytearray()
+                self.rx_expected = 0
+
+            if seq == self.rx_expected & 0xff:
+                self.rx_data += payload
+                self.rx_expected += 1
+                self.rx_at = ticks_ms()
+                self.nak_sent = False
+                if frame_type or self.rx_expected % window_size == 0:
+                    write_frame(self.uart_obj, FRAME_ACK, self.rx_expected)
+                if frame_type:
+                    return self._received(frame_type, seq)
+            elif self.rx_expected == 0 and frame_type and seq == rx_last:
+                # resent end of data already received, its ack got lost
+                write_frame(self.uart_obj, FRAME_ACK, seq + 1)
+            elif 0 < (self.rx_expected - seq) & 0xff <= MAX_WINDOW_SIZE:
+                # resent frame already received, the ack got lost
+                write_frame(self.uart_obj, FRAME_ACK, self.rx_expected)
+            elif not self.nak_sent:
+                write_frame(self.uart_obj, FRAME_NAK, self.rx_expected)
+                self.nak_sent = True
+
+    # Sends data the way send_data_framed does, one message at a time. Needs a task
+    # running receive() to pass on the acknowledgements
+    async def send(self, txData, end_format='string'):
+        import uasyncio as asyncio
+        retain_bytes = type(txData) is bytes
+        if not retain_bytes:
+            txData = bytes(txData, 'utf-8')
+        last_type = ord('b') if retain_bytes else ord(format_chars[end_format])
+        frame_count = max((len(txData) + frame_size - 1) // frame_size, 1)
+        tx_view = memoryview(txData)
+
+        async with self.tx_lock:
+            base = 0
+            next_frame = 0
+            retries = window_retries
+            while base < frame_count:
+                self.ack_event.clear()
+                while next_frame < frame_count and next_frame - base < window_size:
+                    frame_type = last_type if next_frame == frame_count - 1 else 0
+                    write_frame(self.uart_obj, frame_type, next_frame, tx_view[next_frame * frame_size: (next_frame + 1) * frame_size])
+                    next_frame += 1
+
+                try:
+                    await asyncio.wait_for(self.ack_event.wait(), self.timeout_ms / 1000)
+                    frame = self.ack
+                except asyncio.TimeoutError:
+                    frame = None
+
+                if frame is not None:
+                    expected = base + ((frame[1] - base) & 0xff)
+                    if expected <= next_frame:
+                        base = expected
+                        if frame[0] == FRAME_NAK:
+                            next_frame = base
+                        retries = window_retries
+                        continue
+
+                # lost acknowledgement, resend the window
+                retries -= 1
+                if retries < 0:
+                    raise Exception('Waiting for frame acknowledgement timed out')
+                next_frame = base
+
+
+## agree_frame_size - picks frame and window sizes that fit both uart buffers
+# Return: (frame_size, window_size)
+def agree_frame_size(other_rx_buffer_size):
+    capacity = min(other_rx_buffer_size, rx_buffer_size)
+    frame = min(MAX_FRAME_SIZE, capacity // MAX_WINDOW_SIZE - FRAME_OVERHEAD)
+    if frame >= MIN_FRAME_SIZE:
+        return frame, MAX_WINDOW_SIZE
+    return max(min(MAX_FRAME_SIZE, capacity - FRAME_OVERHEAD), 1), 1
+
+
+## use_legacy_framing - goes back to the stop and wait chunking used before negotiation
+def use_legacy_framing():
+    global frame_size, window_size, frame_unconfirmed_at
+    frame_size = None
+    window_size = 1
+    frame_unconfirmed_at = None
+    frame_parser.reset()
+    frame_parser.max_payload = MAX_FRAME_SIZE
+
+
+## negotiate_frame_size - agrees on frame and window sizes with the esp
+# The rp2 confirms the agreed sizes with a first frame. If that frame is not acknowledged,
+# as when the answer reached the rp2 but its confirmation of it was lost, both sides end up
+# on the legacy chunking: the rp2 straight away, the esp after FRAME_CONFIRM_MS
+# Return: the agreed frame size or None if the esp did not answer
+def negotiate_frame_size(uart_obj, **kwargs):
+    global frame_size, window_size, rx_expected, rx_last, compact_commands
+    timeout_ms = kwargs.get('timeout_ms', 500)
+    use_legacy_framing()
+    compact_commands = False
+    del pending_frames[:]
+    rx_expected = 0
+    rx_last = None
+
+    try:
+        send_data(uart_obj, f'frame size {rx_buffer_size}')
+        if not wait_rx(uart_obj, timeout_ms):
+            return None
+
+        rxData = receive_data(uart_obj)
+        if rxData is not None and rxData[0].startswith('frame size '):
+            agreed = rxData[0].split(' ')
+            frame_size, window_size = int(agreed[2]), int(agreed[3])
+            frame_parser.max_payload = frame_size
+            # esp firmware from before the compact envelope answers without 'compact'
+            compact_commands = 'compact' in agreed[4:]
+    except Exception:
+        # older esp firmware, keep stop and wait chunking
+        pass
+
+    sleep(0.1)
+    if frame_size is not None:
+        try:
+            send_data_framed(uart_obj, 'frame size ok', False, 'string', frame_size, timeout_ms=timeout_ms)
+        except Exception:
+            use_legacy_framing()
+    return frame_size
+
+
 ## receive_data_basic - receives data over uart
 # Return: a list with the received data and the end format or None
 def receive_data_basic(uart_obj):
+    global frame_unconfirmed_at
+    if frame_size is not None:
+        if frame_unconfirmed_at is not None and ticks_diff(ticks_ms(), frame_unconfirmed_at) > FRAME_CONFIRM_MS:
+            # the rp2 never confirmed the agreed sizes, it is still on the legacy chunking
+            use_legacy_framing()
+            return None
+        if not data_waiting(uart_obj):
+            return None
+        rxDatalist = receive_data_framed(uart_obj)
+        if rxDatalist is None:
+            return None
+        frame_unconfirmed_at = None
+        rxData, end_format = rxDatalist
+        return [rxData, end_format == 'b', end_format, True]
+
     rxData = None
     if uart_obj.any() > 0:
         rxData = uart_obj.read()
@@ -169,9 +692,15 @@ def receive_data_basic(uart_obj):
 
 
 ## receive_data - reads data on the rx buffer
+# wait_ms - how long to sleep for data to start arriving, None returns straight away
 # Return: a list with the received data and the end format or None
 def receive_data(uart_obj, **kwargs):
+    global frame_size, window_size, frame_unconfirmed_at
     timeout_ms = kwargs.get('timeout_ms', 2000)
+    wait_ms = kwargs.get('wait_ms', None)
+    if wait_ms is not None and not data_waiting(uart_obj):
+        wait_rx(uart_obj, wait_ms)
+
     rxDatalist = receive_data_basic(uart_obj)
     if rxDatalist is None:
         return None
@@ -180,13 +709,8 @@ def receive_data(uart_obj, **kwargs):
     # print(f'first receive: {rxData} packet end: {packet_end} end_format: {end_format}')    
     
     while not packet_end:        
-        # may need to wait for a certain timeout
-        # sleep isn't the best
-        t = ticks_ms()
-        while uart_obj.any() == 0:
-            sleep(0.0001)
-            if ticks_diff(ticks_ms(), t) > timeout_ms:
-                raise Exception('Waiting for receive timed out')
+        if not wait_rx(uart_obj, timeout_ms):
+            raise Exception('Waiting for receive timed out')
         rxDatalist = receive_data_basic(uart_obj)
         # print(f'in not packet end, rxDatalist: {rxDatalist}')
 
@@ -197,6 +721,20 @@ def receive_data(uart_obj, **kwargs):
         # print(f'temp receive: {temp_rx}')
         rxData += temp_rx
 
+    # answer negotiate_frame_size from the rp2
+    if os.uname().sysname == 'esp8266' and not retain_bytes and rxData[:11] == b'frame size ':
+        if rxData == b'frame size ok':
+            frame_unconfirmed_at = None
+            return None
+        agreed = agree_frame_size(int(rxData[11:]))
+        sleep(0.01)
+        send_data(uart_obj, f'frame size {agreed[0]} {agreed[1]} compact')
+        frame_size, window_size = agreed
+        frame_unconfirmed_at = ticks_ms()
+        frame_parser.reset()
+        frame_parser.max_payload = frame_size
+        return None
+
     if retain_bytes:
         return [rxData, end_format]
     
@@ -204,7 +742,28 @@ def receive_data(uart_obj, **kwargs):
         return [rxData.decode('utf-8'), end_format]
 
 
+## receive_responses - yields data from the other side as it arrives, sleeping in between
+# timeout_ms - time allowed for the whole request, None waits forever
+# Raises an exception if the caller is still waiting after timeout_ms
+def receive_responses(uart_obj, timeout_ms=None):
+    t = ticks_ms()
+    while True:
+        if timeout_ms is None:
+            wait_ms = -1
+        else:
+            wait_ms = timeout_ms - ticks_diff(ticks_ms(), t)
+            if wait_ms <= 0:
+                raise Exception('Waiting for response timed out')
+
+        rxData = receive_data(uart_obj, wait_ms=wait_ms)
+        if rxData is not None:
+            yield rxData
+
+
 def uart_config(uart_obj):
+    global frame_size, window_size
+    frame_size = None   # the esp is reset, so any agreed sizes no longer hold
+    window_size = 1
     x_led = Pin(12, Pin.OUT)
     esp_enable_pin = PCF8574_PIN(PCF8574_PIN.ESP_EN_PIN, PCF8574_PIN.OUT)
     print('Setting up ESP')
@@ -213,8 +772,7 @@ def uart_config(uart_obj):
     sleep(0.1)
     esp_enable_pin.value(1)
     # wait until boot up data is available on buffer
-    while uart_obj.any() == 0:
-        sleep(0.01)
+    wait_rx(uart_obj, -1)
     # read any bytes loaded to rp buffer due to ESP boot
     while uart_obj.any() > 0:
         uart_obj.read()
@@ -227,6 +785,7 @@ def uart_config(uart_obj):
         
         if receive_data(uart_obj)[0] == 'ESP: Ready':
             x_led.off()
+            negotiate_frame_size(uart_obj)
             return          
     except:
         if uart_obj.any() > 0:
@@ -234,8 +793,7 @@ def uart_config(uart_obj):
         x_led.on()
         # print("Press ESP reset button")
 
-        while uart_obj.any() == 0:
-            sleep(0.01)
+        wait_rx(uart_obj, -1)
         # read any bytes loaded to rp buffer due to ESP reset
         while uart_obj.any() > 0:
             uart_obj.read()
@@ -248,6 +806,7 @@ def uart_config(uart_obj):
         if receive_data(uart_obj)[0] == 'ESP: Ready':
             timer_x.deinit()
             x_led.off()
+            negotiate_frame_size(uart_obj)
             return
 
 
@@ -265,7 +824,7 @@ def print_s(uart_obj, s, **kwargs):
     if os.uname().sysname == 'esp8266':
         if uart_obj is None:
             raise Exception('Uart object is None')
-        sleep(0.01)
+        pace(0.01)
         send_data(uart_obj, s, end_format='esp_output')
     elif os.uname().sysname == 'rp2':
         print(s, **kwargs)
\ No newline at end of file
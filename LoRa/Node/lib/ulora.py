@@ -1,13 +1,17 @@
 import time
 import math
+import struct
 import ujson
+import micropython
 from ucollections import namedtuple
 from urandom import getrandbits
 from machine import SPI
 from machine import Pin
+from machine import disable_irq, enable_irq
 
 #Constants
 FLAGS_ACK = 0x80
+FLAGS_DOWNLINK_PENDING = 0x01   # set on an ack when the acking device has data queued for the sender
 BROADCAST_ADDRESS = 255
 
 REG_00_FIFO = 0x00
@@ -54,6 +58,18 @@ REG_09_PA_CONFIG = 0x09
 FXOSC = 32000000.0
 FSTEP = (FXOSC / 524288)
 
+HEADER_LEN = 4  # to, from, id, flags
+ACK_LEN = HEADER_LEN + 1    # an ack carries b'!'
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)  # MODEM_CONFIG1 bandwidth field to Hz
+
+FIFO_SIZE = 256 # the SX127x FIFO holds at most 256 bytes, so a slot this big fits any packet
+RX_QUEUE_SIZE = 8
+
+Payload = namedtuple(
+    "Payload",
+    ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'rssi', 'snr']
+)
+
 class ModemConfig():
     Bw125Cr45Sf128 = (0x72, 0x74, 0x04) #< Bw = 125 kHz, Cr = 4/5, Sf = 128chips/symbol, CRC on. Default medium range
     Bw500Cr45Sf128 = (0x92, 0x74, 0x04) #< Bw = 500 kHz, Cr = 4/5, Sf = 128chips/symbol, CRC on. Fast+short range
@@ -61,6 +77,61 @@ class ModemConfig():
     Bw125Cr48Sf4096 = (0x78, 0xc4, 0x0c) #/< Bw = 125 kHz, Cr = 4/8, Sf = 4096chips/symbol, low data rate, CRC on. Slow+long range
     Bw125Cr45Sf2048 = (0x72, 0xb4, 0x04) #< Bw = 125 kHz, Cr = 4/5, Sf = 2048chips/symbol, CRC on. Slow+long range
 
+# Returns (spreading factor, bandwidth in Hz, coding rate denominator, crc on,
+# implicit header, low data rate optimize) from a ModemConfig register triple
+def modem_params(modem_config):
+    config1, config2, config3 = modem_config
+    return (config2 >> 4, BANDWIDTHS[config1 >> 4], ((config1 >> 1) & 0x07) + 4,
+            bool(config2 & 0x04), bool(config1 & 0x01), bool(config3 & 0x08))
+
+
+# Time a packet of payload_len bytes (including the header) occupies the channel
+# in ms. Semtech SX1276 datasheet section 4.1.1.7
+def time_on_air_ms(modem_config, payload_len, preamble_len=8):
+    sf, bw, cr, crc, implicit_header, low_data_rate = modem_params(modem_config)
+    t_sym = (1 << sf) * 1000 / bw
+    t_preamble = (preamble_len + 4.25) * t_sym
+    payload_symbols = 8 + max(math.ceil((8 * payload_len - 4 * sf + 28 + 16 * crc - 20 * implicit_header) /
+                                        (4 * (sf - 2 * low_data_rate))) * cr, 0)
+    return t_preamble + payload_symbols * t_sym
+
+
+class DutyCycle():
+    # Keeps track of airtime used over a sliding window, e.g. DutyCycle(0.01, 3600) for 1% per hour
+    def __init__(self, budget=0.01, window_s=3600):
+        self.budget_ms = budget * window_s * 1000
+        self.window_ms = window_s * 1000
+        self._sends = []    # [ticks_ms, airtime_ms] of sends still inside the window
+
+    def _expire(self):
+        now = time.ticks_ms()
+        while self._sends and time.ticks_diff(now, self._sends[0][0]) >= self.window_ms:
+            del self._sends[0]
+        return now
+
+    def used_ms(self):
+        self._expire()
+        return sum(airtime for _, airtime in self._sends)
+
+    # ms to wait until airtime_ms fits in the budget. 0 if it fits now, -1 if it never can
+    def wait_ms(self, airtime_ms):
+        if airtime_ms > self.budget_ms:
+            return -1
+        now = self._expire()
+        excess = sum(airtime for _, airtime in self._sends) + airtime_ms - self.budget_ms
+        wait = 0
+        # the oldest sends leave the window first
+        for sent, airtime in self._sends:
+            if excess <= 0:
+                break
+            wait = self.window_ms - time.ticks_diff(now, sent)
+            excess -= airtime
+        return wait
+
+    def record(self, airtime_ms):
+        self._sends.append([time.ticks_ms(), airtime_ms])
+
+
 class SPIConfig():
     # spi pin defs for various boards (channel, sck, mosi, miso)
     rp2_0 = (0, 6, 7, 4)
@@ -71,10 +142,12 @@ class SPIConfig():
 
 class LoRa(object):
     def __init__(self, spi_channel, interrupt, this_address, cs_pin, reset_pin=None, freq=868.0, tx_power=14,
-                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None):
+                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None,
+                 rx_queue_size=RX_QUEUE_SIZE):
         """
         Lora(channel, interrupt, this_address, cs_pin, reset_pin=None, freq=868.0, tx_power=14,
-                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None)
+                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None,
+                 rx_queue_size=RX_QUEUE_SIZE)
         channel: SPI channel, check SPIConfig for preconfigured names
         interrupt: GPIO interrupt pin
         this_address: set address for this device [0-254]
@@ -86,6 +159,7 @@ class LoRa(object):
         receive_all: if True, don't filter packets on address
         acks: if True, request acknowledgments
         crypto: if desired, an instance of ucrypto AES (https://docs.pycom.io/firmwareapi/micropython/ucrypto/) - not tested
+        rx_queue_size: number of raw packets the interrupt handler can hold before further packets are dropped
         """
         
         self._spi_channel = spi_channel
@@ -109,13 +183,40 @@ class LoRa(object):
         self.cad_timeout = 0
         self.send_retries = 2
         self.wait_packet_sent_timeout = 0.2
-        self.retry_timeout = 0.2
+        self.retry_timeout = 0.2   # time allowed for the receiver to turn an ack around, on top of the ack airtime
         self.reset_pin = None
-        
-        # Setup the module
-#        gpio_interrupt = Pin(self._interrupt, Pin.IN, Pin.PULL_DOWN)
-        gpio_interrupt = Pin(self._interrupt, Pin.IN)
-        gpio_interrupt.irq(trigger=Pin.IRQ_RISING, handler=self._handle_interrupt)
+        self.duty_cycle = None  # set to a DutyCycle to limit airtime
+        self.duty_cycle_max_wait = 0    # seconds a send may be deferred to fit the duty cycle before it is rejected
+        self._preamble_len = 8
+        self._last_airtime_ms = 0
+        self.downlink_pending = set()   # addresses whose acks tell them to stay listening for a downlink
+        self.ack_flags = 0  # header flags of the ack to the last send_to_wait
+        # ms spent in each radio mode, indexed by MODE_*. Updated from the irq too, so no allocation
+        self.mode_ms = [0] * 8
+        self._mode_since = time.ticks_ms()
+
+        # Receive ring buffer. The interrupt handler copies the FIFO into the slot at
+        # _rx_tail and _service_rx consumes slots from _rx_head. Everything is allocated
+        # here so the (hard) interrupt handler never touches the heap
+        self._rx_queue_size = rx_queue_size
+        self._rx_slots = [bytearray(FIFO_SIZE) for _ in range(rx_queue_size)]
+        self._rx_len = bytearray(rx_queue_size)
+        self._rx_snr = bytearray(rx_queue_size)
+        self._rx_rssi = bytearray(rx_queue_size)
+        self._rx_head = 0
+        self._rx_tail = 0
+        self._rx_count = 0
+        self._rx_scheduled = False
+        self._rx_ready = []  # processed payloads waiting for recv()/recv_nowait()
+        self._service_rx_ref = self._service_rx # bound once, creating it in the irq would allocate
+        # SPI buffers reused by every register access (command + one value, and the
+        # header written ahead of a FIFO payload). Acks are sent from _service_rx, which
+        # can run while send() sleeps, so they have a header buffer of their own
+        self._reg_buf = bytearray(2)
+        self._cmd_buf = memoryview(self._reg_buf)[:1]
+        self._header_buf = bytearray(4)
+        self._ack_header_buf = bytearray(4)
+        self.rx_dropped = 0
         
         # reset the board
         if reset_pin:
@@ -132,6 +233,11 @@ class LoRa(object):
         # cs gpio pin
         self.cs = Pin(self._cs_pin, Pin.OUT)
         self.cs.value(1)
+
+        # Setup the module interrupt once spi is available for the handler
+#        gpio_interrupt = Pin(self._interrupt, Pin.IN, Pin.PULL_DOWN)
+        gpio_interrupt = Pin(self._interrupt, Pin.IN)
+        gpio_interrupt.irq(trigger=Pin.IRQ_RISING, handler=self._handle_interrupt, hard=True)
         
         # set mode
         self._spi_write(REG_01_OP_MODE, MODE_SLEEP | LONG_RANGE_MODE)
@@ -141,25 +247,21 @@ class LoRa(object):
         assert self._spi_read(REG_01_OP_MODE) == (MODE_SLEEP | LONG_RANGE_MODE), \
             "LoRa initialization failed"
 
-        self._spi_write(REG_0E_FIFO_TX_BASE_ADDR, 0)
-        self._spi_write(REG_0F_FIFO_RX_BASE_ADDR, 0)
+        # TX and RX base addresses are contiguous, write both in one burst
+        self._spi_write(REG_0E_FIFO_TX_BASE_ADDR, b'\x00\x00')
         
         self.set_mode_idle()
 
         # set modem config (Bw125Cr45Sf128)
-        self._spi_write(REG_1D_MODEM_CONFIG1, self._modem_config[0])
-        self._spi_write(REG_1E_MODEM_CONFIG2, self._modem_config[1])
+        self._spi_write(REG_1D_MODEM_CONFIG1, bytes(self._modem_config[0:2]))  # MODEM_CONFIG1 and MODEM_CONFIG2
         self._spi_write(REG_26_MODEM_CONFIG3, self._modem_config[2])
 
         # set preamble length (8)
-        self._spi_write(REG_20_PREAMBLE_MSB, 0)
-        self._spi_write(REG_21_PREAMBLE_LSB, 8)
+        self._spi_write(REG_20_PREAMBLE_MSB, bytes((self._preamble_len >> 8, self._preamble_len & 0xff)))
 
-        # set frequency
+        # set frequency, FRF MSB/MID/LSB in one burst
         frf = int((self._freq * 1000000.0) / FSTEP)
-        self._spi_write(REG_06_FRF_MSB, (frf >> 16) & 0xff)
-        self._spi_write(REG_07_FRF_MID, (frf >> 8) & 0xff)
-        self._spi_write(REG_08_FRF_LSB, frf & 0xff)
+        self._spi_write(REG_06_FRF_MSB, bytes(((frf >> 16) & 0xff, (frf >> 8) & 0xff, frf & 0xff)))
         
         # Set tx power
         if self._tx_power < 5:
@@ -176,31 +278,61 @@ class LoRa(object):
         self._spi_write(REG_09_PA_CONFIG, PA_SELECT | (self._tx_power - 5))
         
     def on_recv(self, message):
-        # This should be overridden by the user
-        pass
+        # This can be overridden by the user. By default received payloads are
+        # queued for recv()/recv_nowait()
+        if len(self._rx_ready) >= self._rx_queue_size:
+            del self._rx_ready[0]
+            self.rx_dropped += 1
+        self._rx_ready.append(message)
+
+    def recv_nowait(self):
+        # Return the oldest received payload or None if nothing is queued
+        if self._rx_ready:
+            return self._rx_ready.pop(0)
+        return None
+
+    def recv(self, timeout_ms=None):
+        # Wait for a received payload. Returns None if timeout_ms elapses first
+        start = time.ticks_ms()
+        while not self._rx_ready:
+            if timeout_ms is not None and time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                return None
+            time.sleep_ms(1)
+        return self._rx_ready.pop(0)
+
+    def _enter_mode(self, mode):
+        now = time.ticks_ms()
+        if self._mode is not None:
+            self.mode_ms[self._mode] += time.ticks_diff(now, self._mode_since)
+        self._mode_since = now
+        self._mode = mode
+
+    # Whether the ack to the last send_to_wait said a downlink is queued for this device
+    def downlink_expected(self):
+        return bool(self.ack_flags & FLAGS_DOWNLINK_PENDING)
 
     def sleep(self):
         if self._mode != MODE_SLEEP:
             self._spi_write(REG_01_OP_MODE, MODE_SLEEP)
-            self._mode = MODE_SLEEP
+            self._enter_mode(MODE_SLEEP)
 
     def set_mode_tx(self):
         if self._mode != MODE_TX:
             self._spi_write(REG_01_OP_MODE, MODE_TX)
             self._spi_write(REG_40_DIO_MAPPING1, 0x40)  # Interrupt on TxDone
-            self._mode = MODE_TX
+            self._enter_mode(MODE_TX)
 
     def set_mode_rx(self):
         if self._mode != MODE_RXCONTINUOUS:
             self._spi_write(REG_01_OP_MODE, MODE_RXCONTINUOUS)
             self._spi_write(REG_40_DIO_MAPPING1, 0x00)  # Interrupt on RxDone
-            self._mode = MODE_RXCONTINUOUS
+            self._enter_mode(MODE_RXCONTINUOUS)
             
     def set_mode_cad(self):
         if self._mode != MODE_CAD:
             self._spi_write(REG_01_OP_MODE, MODE_CAD)
             self._spi_write(REG_40_DIO_MAPPING1, 0x80)  # Interrupt on CadDone
-            self._mode = MODE_CAD
+            self._enter_mode(MODE_CAD)
 
     def _is_channel_active(self):
         self.set_mode_cad()
@@ -225,10 +357,15 @@ class LoRa(object):
             else:
                 return status
 
+    def time_on_air_ms(self, payload_len):
+        # airtime of a packet with payload_len bytes including the header
+        return time_on_air_ms(self._modem_config, payload_len, self._preamble_len)
+
     def wait_packet_sent(self):
         # wait for `_handle_interrupt` to switch the mode back
-        start = time.time()
-        while time.time() - start < self.wait_packet_sent_timeout:
+        timeout_ms = self._last_airtime_ms + self.wait_packet_sent_timeout * 1000
+        start = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
             if self._mode != MODE_TX:
                 return True
 
@@ -237,31 +374,44 @@ class LoRa(object):
     def set_mode_idle(self):
         if self._mode != MODE_STDBY:
             self._spi_write(REG_01_OP_MODE, MODE_STDBY)
-            self._mode = MODE_STDBY
+            self._enter_mode(MODE_STDBY)
 
     def send(self, data, header_to, header_id=0, header_flags=0):
+        return self._send(data, header_to, header_id, header_flags, self._header_buf)
+
+    def _send(self, data, header_to, header_id, header_flags, header):
         self.wait_packet_sent()
-        self.set_mode_idle()
-        self.wait_cad()
 
-        header = [header_to, self._this_address, header_id, header_flags]
+        header[0] = header_to
+        header[1] = self._this_address
+        header[2] = header_id
+        header[3] = header_flags
         if type(data) is dict:
             data = ujson.dumps(data)
 
         if type(data) == int:
-            data = [data]
-        elif type(data) == bytes:
-            data = [p for p in data]
+            data = bytes((data,))
         elif type(data) == str:
-            data = [ord(s) for s in data]
+            data = data.encode()
 
         if self.crypto:
-            data = [b for b in self._encrypt(bytes(data))]
+            data = self._encrypt(bytes(data))
+
+        airtime_ms = self.time_on_air_ms(len(header) + len(data))
+        if self.duty_cycle is not None:
+            wait_ms = self.duty_cycle.wait_ms(airtime_ms)
+            if wait_ms < 0 or wait_ms > self.duty_cycle_max_wait * 1000:
+                return False
+            time.sleep_ms(int(wait_ms))
+            self.duty_cycle.record(airtime_ms)
+        self._last_airtime_ms = airtime_ms
+
+        self.set_mode_idle()
+        self.wait_cad()
 
-        payload = header + data
         self._spi_write(REG_0D_FIFO_ADDR_PTR, 0)
-        self._spi_write(REG_00_FIFO, payload)
-        self._spi_write(REG_22_PAYLOAD_LENGTH, len(payload))
+        self._spi_write(REG_00_FIFO, header, data)
+        self._spi_write(REG_22_PAYLOAD_LENGTH, len(header) + len(data))
 
         self.set_mode_tx()
         return True
@@ -269,48 +419,93 @@ class LoRa(object):
     def send_to_wait(self, data, header_to, header_flags=0, retries=3):
         self._last_header_id = (self._last_header_id + 1) % 256
 
-        for _ in range(retries + 1):
-            self.send(data, header_to, header_id=self._last_header_id, header_flags=header_flags)
+        ack_timeout_ms = self.time_on_air_ms(ACK_LEN) + self.retry_timeout * 1000
+        self.ack_flags = 0
+
+        for attempt in range(retries + 1):
+            if attempt:
+                # random backoff of up to one packet airtime so colliding nodes drift apart
+                time.sleep_ms((getrandbits(16) * int(self._last_airtime_ms)) >> 16)
+
+            if not self.send(data, header_to, header_id=self._last_header_id, header_flags=header_flags):
+                self.set_mode_rx()
+                return False    # rejected by the duty cycle
+
+            self.wait_packet_sent()
             self.set_mode_rx()
 
             if header_to == BROADCAST_ADDRESS:  # Don't wait for acks from a broadcast message
                 return True
 
-            start = time.time()
-            while time.time() - start < self.retry_timeout + (self.retry_timeout * (getrandbits(16) / (2**16 - 1))):
+            start = time.ticks_ms()
+            while time.ticks_diff(time.ticks_ms(), start) < ack_timeout_ms:
                 if self._last_payload:
                     if self._last_payload.header_to == self._this_address and \
                             self._last_payload.header_flags & FLAGS_ACK and \
                             self._last_payload.header_id == self._last_header_id:
 
                         # We got an ACK
+                        self.ack_flags = self._last_payload.header_flags
                         return True
         return False
 
     def send_ack(self, header_to, header_id):
-        self.send(b'!', header_to, header_id, FLAGS_ACK)
+        header_flags = FLAGS_ACK | FLAGS_DOWNLINK_PENDING if header_to in self.downlink_pending else FLAGS_ACK
+        self._send(b'!', header_to, header_id, header_flags, self._ack_header_buf)
         self.wait_packet_sent()
 
-    def _spi_write(self, register, payload):
-        if type(payload) == int:
-            payload = [payload]
-        elif type(payload) == bytes:
-            payload = [p for p in payload]
-        elif type(payload) == str:
-            payload = [ord(s) for s in payload]
+    def _spi_write(self, register, payload, payload_2=None):
+        # Writes an int to a single register, or a bytes like payload as a burst starting
+        # at register (the address auto increments, the FIFO pointer advances).
+        # payload_2 is appended within the same transaction. Nothing is allocated
+        # for int, bytes, bytearray or memoryview payloads
+        if type(payload) == str:
+            payload = payload.encode()
+        elif type(payload) == list:
+            payload = bytes(payload)
+        # keep the interrupt handler off the bus (and the shared buffer) mid transaction
+        state = disable_irq()
+        buf = self._reg_buf
+        buf[0] = register | 0x80
         self.cs.value(0)
-        self.spi.write(bytearray([register | 0x80] + payload))
+        if type(payload) == int:
+            buf[1] = payload
+            self.spi.write(buf)
+        else:
+            self.spi.write(self._cmd_buf)
+            self.spi.write(payload)
+            if payload_2:
+                self.spi.write(payload_2)
         self.cs.value(1)
+        enable_irq(state)
 
     def _spi_read(self, register, length=1):
+        if length > 1:
+            data = bytearray(length)
+            self._spi_read_into(register, data)
+            return bytes(data)
+
+        state = disable_irq()
+        buf = self._reg_buf
+        buf[0] = register & 0x7f
+        buf[1] = 0
         self.cs.value(0)
-        if length == 1:
-            data = self.spi.read(length + 1, register)[1]
-        else:
-            data = self.spi.read(length + 1, register)[1:]
+        self.spi.write_readinto(buf, buf)
         self.cs.value(1)
+        data = buf[1]
+        enable_irq(state)
         return data
-        
+
+    def _spi_read_into(self, register, buf):
+        # Burst read of len(buf) bytes starting at register
+        state = disable_irq()
+        self._reg_buf[0] = register & 0x7f
+        self.cs.value(0)
+        self.spi.write(self._cmd_buf)
+        self.spi.readinto(buf)
+        self.cs.value(1)
+        enable_irq(state)
+
     def _decrypt(self, message):
         decrypted_msg = self.crypto.decrypt(message)
         msg_length = decrypted_msg[0]
@@ -324,17 +519,69 @@ class LoRa(object):
         return encrypted_msg
 
     def _handle_interrupt(self, channel):
+        # Runs as a hard irq: only drain the FIFO into the ring buffer and leave the
+        # header handling, decryption, acks and callbacks to _service_rx
         irq_flags = self._spi_read(REG_12_IRQ_FLAGS)
 
         if self._mode == MODE_RXCONTINUOUS and (irq_flags & RX_DONE):
             packet_len = self._spi_read(REG_13_RX_NB_BYTES)
             self._spi_write(REG_0D_FIFO_ADDR_PTR, self._spi_read(REG_10_FIFO_RX_CURRENT_ADDR))
 
-            packet = self._spi_read(REG_00_FIFO, packet_len)
-            self._spi_write(REG_12_IRQ_FLAGS, 0xff)  # Clear all IRQ flags
+            if self._rx_count < self._rx_queue_size:
+                slot = self._rx_tail
+                self._spi_read_into(REG_00_FIFO, self._rx_slots[slot])  # the FIFO wraps, reading a full slot is harmless
+                self._rx_len[slot] = packet_len
+                self._rx_snr[slot] = self._spi_read(REG_19_PKT_SNR_VALUE)
+                self._rx_rssi[slot] = self._spi_read(REG_1A_PKT_RSSI_VALUE)
+                self._rx_tail = (slot + 1) % self._rx_queue_size
+                self._rx_count += 1
+            else:
+                self.rx_dropped += 1
+
+            if not self._rx_scheduled:
+                self._rx_scheduled = True
+                try:
+                    micropython.schedule(self._service_rx_ref, 0)
+                except RuntimeError:
+                    # schedule queue full: the packet stays in the ring buffer and the
+                    # next irq schedules it again
+                    self._rx_scheduled = False
+
+        elif self._mode == MODE_TX and (irq_flags & TX_DONE):
+            self.set_mode_idle()
+
+        elif self._mode == MODE_CAD and (irq_flags & CAD_DONE):
+            self._cad = irq_flags & CAD_DETECTED
+            self.set_mode_idle()
+
+        self._spi_write(REG_12_IRQ_FLAGS, 0xff) # Clear all IRQ flags
+
+    def _service_rx(self, _):
+        # Scheduled by _handle_interrupt. Turns raw slots into payloads
+        self._rx_scheduled = False
+
+        while self._rx_count:
+            slot = self._rx_head
+            packet_len = self._rx_len[slot]
+            packet = self._rx_slots[slot]
+            snr = self._rx_snr[slot]
+            rssi = self._rx_rssi[slot]
+            header_to, header_from, header_id, header_flags = packet[0], packet[1], packet[2], packet[3]
+            message = bytes(packet[4:packet_len]) if packet_len > 4 else b''
+
+            # release the slot before doing any slow work
+            state = disable_irq()
+            self._rx_head = (slot + 1) % self._rx_queue_size
+            self._rx_count -= 1
+            enable_irq(state)
+
+            if packet_len < 4:
+                continue
+
+            if (self._this_address != header_to) and ((header_to != BROADCAST_ADDRESS) or (self._receive_all is False)):
+                continue
 
-            snr = self._spi_read(REG_19_PKT_SNR_VALUE) / 4
-            rssi = self._spi_read(REG_1A_PKT_RSSI_VALUE)
+            snr = (snr - 256 if snr > 127 else snr) / 4
 
             if snr < 0:
                 rssi = snr + rssi
@@ -346,40 +593,18 @@ class LoRa(object):
             else:
                 rssi = round(rssi - 164, 2)
 
-            if packet_len >= 4:
-                header_to = packet[0]
-                header_from = packet[1]
-                header_id = packet[2]
-                header_flags = packet[3]
-                message = bytes(packet[4:]) if packet_len > 4 else b''
-
-                if (self._this_address != header_to) and ((header_to != BROADCAST_ADDRESS) or (self._receive_all is False)):
-                    return
-
-                if self.crypto and len(message) % 16 == 0:
-                    message = self._decrypt(message)
-
-                if self._acks and header_to == self._this_address and not header_flags & FLAGS_ACK:
-                    self.send_ack(header_from, header_id)
+            if self.crypto and len(message) % 16 == 0:
+                message = self._decrypt(message)
 
-                self.set_mode_rx()
-
-                self._last_payload = namedtuple(
-                    "Payload",
-                    ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'rssi', 'snr']
-                )(message, header_to, header_from, header_id, header_flags, rssi, snr)
-
-                if not header_flags & FLAGS_ACK:
-                    self.on_recv(self._last_payload)
+            if self._acks and header_to == self._this_address and not header_flags & FLAGS_ACK:
+                self.send_ack(header_from, header_id)
 
-        elif self._mode == MODE_TX and (irq_flags & TX_DONE):
-            self.set_mode_idle()
+            self.set_mode_rx()
 
-        elif self._mode == MODE_CAD and (irq_flags & CAD_DONE):
-            self._cad = irq_flags & CAD_DETECTED
-            self.set_mode_idle()
+            self._last_payload = Payload(message, header_to, header_from, header_id, header_flags, rssi, snr)
 
-        self._spi_write(REG_12_IRQ_FLAGS, 0xff)
+            if not header_flags & FLAGS_ACK:
+                self.on_recv(self._last_payload)
 
     def close(self):
         self.spi.deinit()
@@ -419,4 +644,265 @@ def conex_dict(provided_dict, ref_dict):
         temp_value = value if temp_value is None else temp_value
         conexed_dict[temp_key] = temp_value
     
-    return conexed_dict
\ No newline at end of file
+    return conexed_dict
+
+
+# Binary telemetry frames, an alternative to sending conex_dict(...) as json.
+# Layout: schema id (1 byte), presence mask (2 bytes, bit n set when field n of the
+# schema is present), then the present fields packed big endian in schema order.
+# Fields are (key, struct format, scale): numbers travel as fixed point round(value * scale)
+# and scale 0 marks a string sent as its index in telemetry_enums[key].
+# Keys are the same ones listed in con_dict.
+TELEMETRY_SCHEMA_COMBINED = 1
+
+telemetry_enums = {
+    'device_id': ('COMBINED',),
+}
+
+telemetry_schemas = {
+    TELEMETRY_SCHEMA_COMBINED: (
+        ('count', 'I', 1),
+        ('device_id', 'B', 0),
+        ('AMBIENT_LIGHT', 'H', 100),
+        ('DHT_TEMPERATURE', 'h', 100),
+        ('DHT_HUMIDITY', 'H', 100),
+        ('SOIL_TEMPERATURE', 'h', 100),
+        ('SOIL_MOISTURE', 'H', 100),
+        ('TDS', 'I', 100),
+        ('Nitrogen', 'H', 1),
+        ('Phosphorus', 'H', 1),
+        ('Potassium', 'H', 1),
+        ('lamp_status', 'B', 1),
+        ('user_id', 'I', 1),
+        ('project_id', 'I', 1),
+    ),
+}
+
+_fmt_limits = {'B': (0, 0xff), 'H': (0, 0xffff), 'h': (-0x8000, 0x7fff), 'I': (0, 0xffffffff)}
+
+
+def is_telemetry_frame(message):
+    return len(message) >= 3 and message[0] in telemetry_schemas
+
+
+# Packs a dict with the long (unconstricted) keys into a binary frame.
+# Raises ValueError if a key or value does not fit the schema so the caller can fall back to json
+def encode_telemetry(provided_dict, schema_id=TELEMETRY_SCHEMA_COMBINED):
+    fmt = '>BH'
+    mask = 0
+    values = []
+
+    for i, (key, field_fmt, scale) in enumerate(telemetry_schemas[schema_id]):
+        value = provided_dict.get(key, None)
+        if value is None:
+            continue
+
+        if scale == 0:
+            value = telemetry_enums[key].index(value)
+        else:
+            value = int(round(value * scale))
+
+        low, high = _fmt_limits[field_fmt]
+        if value < low or value > high:
+            raise ValueError(f'{key} value out of range for telemetry schema {schema_id}')
+
+        mask |= 1 << i
+        fmt += field_fmt
+        values.append(value)
+
+    if len(values) != len(provided_dict):
+        raise ValueError(f'Fields not in telemetry schema {schema_id}')
+
+    return struct.pack(fmt, schema_id, mask, *values)
+
+
+# Unpacks a binary frame into a dict with the long keys, the same dict
+# conex_dict(ujson.loads(message), ex_dict) gives for the json format
+def decode_telemetry(message):
+    schema_id, mask = struct.unpack_from('>BH', message, 0)
+    schema = telemetry_schemas[schema_id]
+    fmt = '>'
+    fields = []
+
+    for i, field in enumerate(schema):
+        if mask & (1 << i):
+            fmt += field[1]
+            fields.append(field)
+
+    decoded_dict = {}
+    for (key, field_fmt, scale), value in zip(fields, struct.unpack_from(fmt, message, 3)):
+        if scale == 0:
+            value = telemetry_enums[key][value]
+        elif scale != 1:
+            value = value / scale
+        decoded_dict[key] = value
+
+    return decoded_dict
+
+# Batched telemetry, several readings of one schema in a single frame to save airtime.
+# Layout: schema id | TELEMETRY_BATCH (1 byte), presence mask (2 bytes, shared by all the
+# readings), number of readings (1 byte), age in seconds of the newest reading when sent,
+# the oldest reading packed as in encode_telemetry, then for each later reading the
+# seconds since the one before and the change of each present field. Ages and changes are
+# varints (7 bits a byte, low bits first), changes zigzag coded so small negatives stay short
+TELEMETRY_BATCH = 0x80
+TELEMETRY_MAX_LEN = FIFO_SIZE - HEADER_LEN
+
+
+def is_telemetry_batch(message):
+    return len(message) >= 4 and message[0] & TELEMETRY_BATCH and message[0] & ~TELEMETRY_BATCH in telemetry_schemas
+
+
+def _put_varint(buf, value):
+    while value > 0x7f:
+        buf.append(value & 0x7f | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _get_varint(message, i):
+    value = 0
+    shift = 0
+    while True:
+        byte = message[i]
+        i += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, i
+
+
+# Packs readings, a list of (time in seconds, dict with the long keys) oldest first, into one
+# frame. now is the time the frame is sent at, on the same clock as the readings.
+# Raises ValueError if the readings do not share their keys, do not fit the schema or make a
+# frame longer than a lora packet, so the caller can send them one by one instead
+def encode_telemetry_batch(readings, now, schema_id=TELEMETRY_SCHEMA_COMBINED):
+    if not 0 < len(readings) < 256:
+        raise ValueError('A batch holds 1 to 255 readings')
+
+    first = encode_telemetry(readings[0][1], schema_id)
+    mask = struct.unpack_from('>H', first, 1)[0]
+    fields = [field for i, field in enumerate(telemetry_schemas[schema_id]) if mask & (1 << i)]
+
+    frame = bytearray(first[:3])
+    frame[0] |= TELEMETRY_BATCH
+    frame.append(len(readings))
+    _put_varint(frame, max(int(now - readings[-1][0]), 0))
+    frame.extend(first[3:])
+
+    fmt = '>' + ''.join(f[1] for f in fields)
+    previous_t, previous = readings[0][0], struct.unpack_from(fmt, first, 3)
+    for t, provided_dict in readings[1:]:
+        encoded = encode_telemetry(provided_dict, schema_id)
+        if struct.unpack_from('>H', encoded, 1)[0] != mask:
+            raise ValueError('Readings of a batch must have the same fields')
+        values = struct.unpack_from(fmt, encoded, 3)
+        _put_varint(frame, max(int(t - previous_t), 0))
+        for value, previous_value in zip(values, previous):
+            delta = value - previous_value
+            _put_varint(frame, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        previous_t, previous = t, values
+
+    if len(frame) > TELEMETRY_MAX_LEN:
+        raise ValueError(f'Batch of {len(readings)} readings does not fit in a lora packet')
+    return bytes(frame)
+
+
+# Unpacks a batch frame into a list of (age in seconds when received, dict with the long keys),
+# oldest first. Each dict is the one decode_telemetry gives for a single reading
+def decode_telemetry_batch(message):
+    schema_id = message[0] & ~TELEMETRY_BATCH
+    mask, n = struct.unpack_from('>HB', message, 1)
+    fields = [field for i, field in enumerate(telemetry_schemas[schema_id]) if mask & (1 << i)]
+    fmt = '>' + ''.join(f[1] for f in fields)
+
+    newest_age, i = _get_varint(message, 4)
+    values = list(struct.unpack_from(fmt, message, i))
+    i += struct.calcsize(fmt)
+    rows = [values]
+    gaps = []
+    for _ in range(n - 1):
+        gap, i = _get_varint(message, i)
+        gaps.append(gap)
+        values = values[:]
+        for j in range(len(fields)):
+            delta, i = _get_varint(message, i)
+            values[j] += -((delta + 1) >> 1) if delta & 1 else delta >> 1
+        rows.append(values)
+
+    header = struct.pack('>BH', schema_id, mask)
+    age = newest_age + sum(gaps)
+    readings = []
+    for k, values in enumerate(rows):
+        readings.append((age, decode_telemetry(header + struct.pack(fmt, *values))))
+        if k < len(gaps):
+            age -= gaps[k]
+    return readings
+
+
+class TelemetryBatch():
+    # Readings waiting to go out together in batch frames. Each reading is also appended to
+    # file_name as a (time, length, telemetry frame) record, so readings gathered over
+    # several hibernate cycles survive a reset. At most max_len readings are kept, oldest
+    # dropped first, in case the gateway stays out of reach
+    def __init__(self, size, file_name='telemetry_batch.bin', max_len=None):
+        self.size = size
+        self.file_name = file_name
+        self.max_len = 8 * size if max_len is None else max_len
+        self.readings = []  # (time, dict with the long keys), oldest first
+        try:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+
+        i = 0
+        while i + 5 <= len(data):
+            t, length = struct.unpack_from('>IB', data, i)
+            if i + 5 + length > len(data):
+                break   # cut short by a reset
+            self.readings.append((t, decode_telemetry(data[i + 5:i + 5 + length])))
+            i += 5 + length
+
+    def __len__(self):
+        return len(self.readings)
+
+    def full(self):
+        return len(self.readings) >= self.size
+
+    # Adds a reading taken at time t (seconds). Raises ValueError if it does not fit the
+    # telemetry schema, in which case it should be sent on its own as json
+    def add(self, t, provided_dict):
+        frame = encode_telemetry(provided_dict)
+        self.readings.append((t, provided_dict))
+        if len(self.readings) > self.max_len:
+            self.sent(len(self.readings) - self.max_len)
+        else:
+            with open(self.file_name, 'ab') as f:
+                f.write(struct.pack('>IB', t, len(frame)) + frame)
+
+    # Batch frames holding every reading, each as (number of readings, frame). A batch too
+    # long for one lora packet is split. now is the send time on the readings' clock
+    def frames(self, now):
+        frames = []
+        readings = self.readings
+        while readings:
+            n = len(readings)
+            while True:
+                try:
+                    frames.append((n, encode_telemetry_batch(readings[:n], now)))
+                    break
+                except ValueError:
+                    if n == 1:
+                        raise
+                    n = (n + 1) // 2
+            readings = readings[n:]
+        return frames
+
+    # Forgets the oldest n readings once they are delivered
+    def sent(self, n):
+        self.readings = self.readings[n:]
+        with open(self.file_name, 'wb') as f:
+            for t, provided_dict in self.readings:
+                frame = encode_telemetry(provided_dict)
+                f.write(struct.pack('>IB', t, len(frame)) + frame)
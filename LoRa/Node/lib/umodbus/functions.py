@@ -282,15 +282,46 @@ def validate_resp_data(data: bytes,
     return False
 
 
-def response(function_code: int,
-             request_register_addr: int,
-             request_register_qty: int,
-             request_data: list,
-             value_list: Optional[list] = None,
-             signed: bool = True) -> bytes:
+def _register_format(prefix: str,
+                     quantity: int,
+                     signed: Union[bool, List[bool]]) -> str:
     """
-    Construct a Modbus response Protocol Data Unit
+    Get the struct format of registers
+
+    :param      prefix:    The format of what comes before the registers
+    :type       prefix:    str
+    :param      quantity:  The amount of registers
+    :type       quantity:  int
+    :param      signed:    Indicates if signed, per register if a list
+    :type       signed:    Union[bool, List[bool]]
+
+    :returns:   The format string
+    :rtype:     str
+    """
+    if signed is True or signed is False:
+        return '%s%d%s' % (prefix, quantity, 'h' if signed else 'H')
+
+    fmt = prefix
+    for s in signed:
+        fmt += 'h' if s else 'H'
+    return fmt
+
 
+def response_into(buffer: bytearray,
+                  offset: int,
+                  function_code: int,
+                  request_register_addr: int,
+                  request_register_qty: int,
+                  request_data: list,
+                  value_list: Optional[list] = None,
+                  signed: bool = True) -> int:
+    """
+    Write a Modbus response Protocol Data Unit into a buffer
+
+    :param      buffer:                 The buffer
+    :type       buffer:                 bytearray
+    :param      offset:                 Position of the PDU in the buffer
+    :type       offset:                 int
     :param      function_code:          The function code
     :type       function_code:          int
     :param      request_register_addr:  The request register address
@@ -304,27 +335,33 @@ def response(function_code: int,
     :param      signed:                 Indicates if signed
     :type       signed:                 bool
 
-    :returns:   Protocol data unit
-    :rtype:     bytes
+    :returns:   Length of the PDU, 0 for functions without a response
+    :rtype:     int
     """
     if function_code in [Const.READ_COILS, Const.READ_DISCRETE_INPUTS]:
-        sectioned_list = [value_list[i:i + 8] for i in range(0, len(value_list), 8)]    # noqa: E501
-
-        output_value = []
-        for index, byte in enumerate(sectioned_list):
-            # see https://github.com/brainelectronics/micropython-modbus/issues/22
-            # output = sum(v << i for i, v in enumerate(byte))
-            # see https://github.com/brainelectronics/micropython-modbus/issues/38
-            output = 0
-            for bit in byte:
-                output = (output << 1) | bit
-            output_value.append(output)
-
-        fmt = 'B' * len(output_value)
-        return struct.pack('>BB' + fmt,
-                           function_code,
-                           ((len(value_list) - 1) // 8) + 1,
-                           *output_value)
+        quantity = len(value_list)
+        byte_count = ((quantity - 1) // 8) + 1
+        buffer[offset] = function_code
+        buffer[offset + 1] = byte_count
+        pos = offset + 2
+
+        # see https://github.com/brainelectronics/micropython-modbus/issues/38
+        # each group of 8 values is packed first value in the highest bit
+        # used, a last group of less than 8 is not shifted up
+        output = 0
+        bits = 0
+        for bit in value_list:
+            output = (output << 1) | bit
+            bits += 1
+            if bits == 8:
+                buffer[pos] = output
+                pos += 1
+                output = 0
+                bits = 0
+        if bits:
+            buffer[pos] = output
+
+        return 2 + byte_count
 
     elif function_code in [Const.READ_HOLDING_REGISTERS,
                            Const.READ_INPUT_REGISTER]:
@@ -333,31 +370,73 @@ def response(function_code: int,
         if not (0x0001 <= quantity <= 0x007D):
             raise ValueError('invalid number of registers')
 
-        if signed is True or signed is False:
-            fmt = ('h' if signed else 'H') * quantity
-        else:
-            fmt = ''
-            for s in signed:
-                fmt += 'h' if s else 'H'
-
-        return struct.pack('>BB' + fmt,
-                           function_code,
-                           quantity * 2,
-                           *value_list)
+        struct.pack_into(_register_format('>BB', quantity, signed),
+                         buffer,
+                         offset,
+                         function_code,
+                         quantity * 2,
+                         *value_list)
+        return 2 + quantity * 2
 
     elif function_code in [Const.WRITE_SINGLE_COIL,
                            Const.WRITE_SINGLE_REGISTER]:
-        return struct.pack('>BHBB',
-                           function_code,
-                           request_register_addr,
-                           *request_data)
+        struct.pack_into('>BHBB',
+                         buffer,
+                         offset,
+                         function_code,
+                         request_register_addr,
+                         *request_data)
+        return 5
 
     elif function_code in [Const.WRITE_MULTIPLE_COILS,
                            Const.WRITE_MULTIPLE_REGISTERS]:
-        return struct.pack('>BHH',
-                           function_code,
-                           request_register_addr,
-                           request_register_qty)
+        struct.pack_into('>BHH',
+                         buffer,
+                         offset,
+                         function_code,
+                         request_register_addr,
+                         request_register_qty)
+        return 5
+
+    return 0
+
+
+def response(function_code: int,
+             request_register_addr: int,
+             request_register_qty: int,
+             request_data: list,
+             value_list: Optional[list] = None,
+             signed: bool = True) -> bytes:
+    """
+    Construct a Modbus response Protocol Data Unit
+
+    :param      function_code:          The function code
+    :type       function_code:          int
+    :param      request_register_addr:  The request register address
+    :type       request_register_addr:  int
+    :param      request_register_qty:   The request register qty
+    :type       request_register_qty:   int
+    :param      request_data:           The request data
+    :type       request_data:           list
+    :param      value_list:             The values
+    :type       value_list:             Optional[list]
+    :param      signed:                 Indicates if signed
+    :type       signed:                 bool
+
+    :returns:   Protocol data unit
+    :rtype:     bytes
+    """
+    buffer = bytearray(Const.MAX_PDU_LENGTH)
+    length = response_into(buffer=buffer,
+                           offset=0,
+                           function_code=function_code,
+                           request_register_addr=request_register_addr,
+                           request_register_qty=request_register_qty,
+                           request_data=request_data,
+                           value_list=value_list,
+                           signed=signed)
+    if length:
+        return bytes(buffer[:length])
 
 
 def exception_response(function_code: int, exception_code: int) -> bytes:
@@ -389,16 +468,19 @@ def bytes_to_bool(byte_list: bytes, bit_qty: Optional[int] = 1) -> List[bool]:
     """
     bool_list = []
 
-    for index, byte in enumerate(byte_list):
+    for byte in byte_list:
         this_qty = bit_qty
 
         if this_qty >= 8:
             this_qty = 8
 
-        # evil hack for missing keyword support in MicroPython format()
-        fmt = '{:0' + str(this_qty) + 'b}'
+        # as many bits as '{:0<this_qty>b}'.format(byte) gives, highest first
+        width = this_qty if this_qty > 0 else 1
+        while byte >> width:
+            width += 1
 
-        bool_list.extend([bool(int(x)) for x in fmt.format(byte)])
+        for shift in range(width - 1, -1, -1):
+            bool_list.append(bool((byte >> shift) & 1))
 
         bit_qty -= 8
 
@@ -422,7 +504,7 @@ def to_short(byte_array: bytes, signed: bool = True) -> bytes:
         return int.from_bytes(byte_array, 'big')
 
     response_quantity = int(len(byte_array) / 2)
-    fmt = '>' + (('h' if signed else 'H') * response_quantity)
+    fmt = _register_format('>', response_quantity, signed)
 
     return struct.unpack(fmt, byte_array)
 
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Modbus register storage
+
+Values of one register type are kept in arrays of consecutive addresses, one
+byte per coil or discrete input and two per register, instead of a dict per
+register. Callbacks are kept in a separate table holding only the addresses
+that have one.
+
+Registers hold their 16 bit content. A register set to a negative value is
+noted in a set of such addresses and reads back negative, while the wire
+takes the raw content.
+"""
+
+# system packages
+from array import array
+
+# typing not natively supported on MicroPython
+from .typing import Callable, List, Optional, Tuple, Union
+
+
+class RegisterBank(object):
+    """
+    Storage for the registers of one type
+
+    :param      bits:  Flag whether the registers are coils or discrete
+                       inputs, 16 bit registers otherwise
+    :type       bits:  bool
+    """
+    def __init__(self, bits: bool = False) -> None:
+        self._bits = bits
+        self._typecode = 'B' if bits else 'H'
+        # [start address, array of values], sorted by start address. Blocks
+        # never touch, registers added next to a block extend it
+        self._blocks = []
+        # address -> [on_set_cb, on_get_cb], only for addresses with one
+        self._callbacks = dict()
+        # addresses of registers last set to a negative value
+        self._negative = set()
+
+    def __contains__(self, address: int) -> bool:
+        return self._find(address) >= 0
+
+    def __len__(self) -> int:
+        return sum(len(values) for start, values in self._blocks)
+
+    def _find(self, address: int) -> int:
+        """
+        Find the block holding an address
+
+        :param      address:  The address (ID) of the register
+        :type       address:  int
+
+        :returns:   Index of the block, -1 if no block holds the address
+        :rtype:     int
+        """
+        lo = 0
+        hi = len(self._blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, values = self._blocks[mid]
+            if address < start:
+                hi = mid
+            elif address >= start + len(values):
+                lo = mid + 1
+            else:
+                return mid
+        return -1
+
+    def _store(self, value: Union[bool, int]) -> int:
+        if self._bits:
+            return 1 if value else 0
+        return value & 0xFFFF
+
+    def _note_signs(self, address: int, value: List[int]) -> None:
+        if self._bits or (not self._negative and min(value) >= 0):
+            return
+        for idx, val in enumerate(value):
+            if val < 0:
+                self._negative.add(address + idx)
+            else:
+                self._negative.discard(address + idx)
+
+    def _set_one(self, address: int, value: int) -> None:
+        blocks = self._blocks
+        idx = self._find(address)
+        if idx >= 0:
+            start, values = blocks[idx]
+            values[address - start] = value
+            return
+
+        # index of the first block after the address
+        idx = 0
+        while idx < len(blocks) and blocks[idx][0] < address:
+            idx += 1
+        before = blocks[idx - 1] if idx > 0 else None
+        after = blocks[idx] if idx < len(blocks) else None
+
+        if before is not None and before[0] + len(before[1]) == address:
+            before[1].append(value)
+            if after is not None and after[0] == address + 1:
+                # the new register joins two blocks
+                before[1].extend(after[1])
+                del blocks[idx]
+        elif after is not None and after[0] == address + 1:
+            after[0] = address
+            after[1] = array(self._typecode, [value]) + after[1]
+        else:
+            blocks.insert(idx, [address, array(self._typecode, [value])])
+
+    def set(self,
+            address: int,
+            value: Union[bool, int, List[bool], List[int]]) -> None:
+        """
+        Set one or consecutive registers, adding those that do not exist
+
+        :param      address:  The address (ID) of the first register
+        :type       address:  int
+        :param      value:    The value(s) of the register(s)
+        :type       value:    Union[bool, int, List[bool], List[int]]
+        """
+        if not isinstance(value, (list, tuple)):
+            self._set_one(address, self._store(value))
+            self._note_signs(address, [value])
+            return
+
+        quantity = len(value)
+        if quantity:
+            self._note_signs(address, value)
+        idx = self._find(address)
+        if idx >= 0:
+            start, values = self._blocks[idx]
+            offset = address - start
+            if offset + quantity <= len(values):
+                # all inside one block, a single slice assignment
+                values[offset:offset + quantity] = \
+                    array(self._typecode, [self._store(v) for v in value])
+                return
+
+        for idx, val in enumerate(value):
+            self._set_one(address + idx, self._store(val))
+
+    def get(self, address: int) -> Union[bool, int]:
+        """
+        Get the value of a register
+
+        :param      address:  The address (ID) of the register
+        :type       address:  int
+
+        :raise      KeyError:  No register at specified address found
+        :returns:   Register value
+        :rtype:     Union[bool, int]
+        """
+        idx = self._find(address)
+        if idx < 0:
+            raise KeyError(address)
+        start, values = self._blocks[idx]
+        value = values[address - start]
+        if self._bits:
+            return bool(value)
+        if address in self._negative:
+            return value - 0x10000
+        return value
+
+    def read(self,
+             address: int,
+             quantity: int,
+             raw: bool = False) -> Union[List[bool], List[int]]:
+        """
+        Get the values of consecutive registers, addresses without a register
+        read as 0 or False
+
+        :param      address:   The address (ID) of the first register
+        :type       address:   int
+        :param      quantity:  The amount of registers
+        :type       quantity:  int
+        :param      raw:       Flag whether to return the unsigned 16 bit
+                               content of registers set to a negative value
+        :type       raw:       bool
+
+        :returns:   Register values
+        :rtype:     Union[List[bool], List[int]]
+        """
+        data = None
+        idx = self._find(address)
+        if idx >= 0:
+            start, values = self._blocks[idx]
+            offset = address - start
+            if offset + quantity <= len(values):
+                if self._bits:
+                    return [bool(v) for v in values[offset:offset + quantity]]
+                data = list(values[offset:offset + quantity])
+
+        if data is None:
+            data = []
+            for addr in range(address, address + quantity):
+                idx = self._find(addr)
+                if idx < 0:
+                    data.append(False if self._bits else 0)
+                else:
+                    start, values = self._blocks[idx]
+                    data.append(bool(values[addr - start]) if self._bits
+                                else values[addr - start])
+
+        if self._negative and not raw:
+            for addr in self._negative:
+                if address <= addr < address + quantity:
+                    data[addr - address] -= 0x10000
+        return data
+
+    def remove(self, address: int) -> Union[None, bool, int]:
+        """
+        Remove a register
+
+        :param      address:  The address (ID) of the register
+        :type       address:  int
+
+        :returns:   Register value, None if the register did not exist
+        :rtype:     Union[None, bool, int]
+        """
+        idx = self._find(address)
+        if idx < 0:
+            return None
+        value = self.get(address)
+        self._callbacks.pop(address, None)
+        self._negative.discard(address)
+
+        start, values = self._blocks[idx]
+        offset = address - start
+        if len(values) == 1:
+            del self._blocks[idx]
+        elif offset == 0:
+            self._blocks[idx] = [start + 1, values[1:]]
+        elif offset == len(values) - 1:
+            self._blocks[idx] = [start, values[:-1]]
+        else:
+            # split the block around the removed register
+            self._blocks[idx] = [start, values[:offset]]
+            self._blocks.insert(idx + 1, [address + 1, values[offset + 1:]])
+        return value
+
+    def addresses(self) -> List[int]:
+        """
+        Get the addresses of all registers
+
+        :returns:   The addresses in ascending order
+        :rtype:     List[int]
+        """
+        result = []
+        for start, values in self._blocks:
+            result.extend(range(start, start + len(values)))
+        return result
+
+    def callbacks(self, address: int) -> Tuple[Optional[Callable], Optional[Callable]]:
+        """
+        Get the callbacks of a register
+
+        :param      address:  The address (ID) of the register
+        :type       address:  int
+
+        :returns:   The on_set_cb and on_get_cb, None where there is none
+        :rtype:     Tuple[Optional[Callable], Optional[Callable]]
+        """
+        return self._callbacks.get(address, (None, None))
+
+    def set_callbacks(self,
+                      address: int,
+                      on_set_cb: Optional[Callable] = None,
+                      on_get_cb: Optional[Callable] = None) -> None:
+        """
+        Set the callbacks of a register, callbacks it already has are kept
+
+        :param      address:    The address (ID) of the register
+        :type       address:    int
+        :param      on_set_cb:  Callback on setting the register
+        :type       on_set_cb:  Optional[Callable]
+        :param      on_get_cb:  Callback on getting the register
+        :type       on_get_cb:  Optional[Callable]
+        """
+        current = self._callbacks.get(address, (None, None))
+        on_set_cb = current[0] or (on_set_cb if callable(on_set_cb) else None)
+        on_get_cb = current[1] or (on_get_cb if callable(on_get_cb) else None)
+        if on_set_cb is None and on_get_cb is None:
+            return
+        self._callbacks[address] = (on_set_cb, on_get_cb)
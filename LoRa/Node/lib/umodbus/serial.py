@@ -17,6 +17,7 @@ import time
 # custom packages
 from . import const as Const
 from . import functions
+from crc16 import crc16, crc16_bytes
 from .common import Request, CommonModbusFunctions
 from .common import ModbusException
 from .modbus import Modbus
@@ -88,6 +89,7 @@ class Serial(CommonModbusFunctions):
                  de_pin: int = None,
                  re_pin: int = None,
                 #  ctrl_pin: int = None
+                 response_timeout: int = 1000
                  ):
         """
         Setup Serial/RTU Modbus
@@ -106,6 +108,9 @@ class Serial(CommonModbusFunctions):
         :type       pins:        List[Union[int, Pin], Union[int, Pin]]
         :param      ctrl_pin:    The control pin
         :type       ctrl_pin:    int
+        :param      response_timeout:  Time to wait for a slave to start its
+                                       response in milliseconds, default 1000
+        :type       response_timeout:  int
         """
         # UART flush function is introduced in Micropython v1.20.0
         self._has_uart_flush = callable(getattr(UART, "flush", None))
@@ -141,6 +146,34 @@ class Serial(CommonModbusFunctions):
         else:
             self._inter_frame_delay = 1750
 
+        # time to wait for the first byte of a response, per slave address
+        self._response_timeout = response_timeout
+        self._response_timeouts = {}
+
+        # responses are read into this buffer, an RTU frame is at most 256 bytes
+        self._rx_buffer = bytearray(256)
+        self._rx_view = memoryview(self._rx_buffer)
+        # frames are built in this buffer and sent from it
+        self._tx_buffer = bytearray(256)
+        self._tx_view = memoryview(self._tx_buffer)
+
+    def set_response_timeout(self,
+                             timeout: int,
+                             slave_addr: Optional[int] = None) -> None:
+        """
+        Set the time to wait for a slave to start its response
+
+        :param      timeout:     The timeout in milliseconds
+        :type       timeout:     int
+        :param      slave_addr:  The slave address, all slaves without their
+                                 own timeout if None
+        :type       slave_addr:  Optional[int]
+        """
+        if slave_addr is None:
+            self._response_timeout = timeout
+        else:
+            self._response_timeouts[slave_addr] = timeout
+
     def _calculate_crc16(self, data: bytearray) -> bytes:
         """
         Calculates the CRC16.
@@ -151,12 +184,7 @@ class Serial(CommonModbusFunctions):
         :returns:   The crc 16.
         :rtype:     bytes
         """
-        crc = 0xFFFF
-
-        for char in data:
-            crc = (crc >> 8) ^ Const.CRC16_TABLE[((crc) ^ char) & 0xFF]
-
-        return struct.pack('<H', crc)
+        return crc16_bytes(crc16(data))
 
     def _exit_read(self, response: bytearray) -> bool:
         """
@@ -182,31 +210,91 @@ class Serial(CommonModbusFunctions):
 
         return True
 
-    def _uart_read(self) -> bytearray:
+    def _expected_response_len(self, modbus_pdu: bytes) -> Optional[int]:
+        """
+        Length of the response to a request, known from its PDU
+
+        :param      modbus_pdu:  The modbus Protocol Data Unit of the request
+        :type       modbus_pdu:  bytes
+
+        :returns:   Response length including address and CRC, None if it
+                    can not be known before the response arrives
+        :rtype:     Optional[int]
+        """
+        function_code = modbus_pdu[0]
+        if function_code in (Const.READ_COILS, Const.READ_DISCRETE_INPUTS):
+            quantity = struct.unpack('>H', modbus_pdu[3:5])[0]
+            return Const.RESPONSE_HDR_LENGTH + 1 + (quantity + 7) // 8 + \
+                Const.CRC_LENGTH
+        elif function_code in (Const.READ_HOLDING_REGISTERS,
+                               Const.READ_INPUT_REGISTER):
+            quantity = struct.unpack('>H', modbus_pdu[3:5])[0]
+            return Const.RESPONSE_HDR_LENGTH + 1 + 2 * quantity + \
+                Const.CRC_LENGTH
+        elif function_code in (Const.WRITE_SINGLE_COIL,
+                               Const.WRITE_SINGLE_REGISTER,
+                               Const.WRITE_MULTIPLE_COILS,
+                               Const.WRITE_MULTIPLE_REGISTERS):
+            return Const.FIXED_RESP_LEN
+        return None
+
+    def _uart_read(self,
+                   expected_len: Optional[int] = None,
+                   timeout: Optional[int] = None) -> bytearray:
         """
         Read incoming slave response from UART
 
+        Reading stops once expected_len bytes or a complete exception
+        response have arrived, or at the first silence of 3.5 characters
+        after the response started. Without expected_len the length is
+        worked out from the response header as it arrives.
+
+        :param      expected_len:  The expected response length
+        :type       expected_len:  Optional[int]
+        :param      timeout:       Time to wait for the response to start in
+                                   milliseconds, the default timeout if None
+        :type       timeout:       Optional[int]
+
         :returns:   Read content
         :rtype:     bytearray
         """
-        response = bytearray()
-
-        # TODO: use some kind of hint or user-configurable delay
-        #       to determine this loop counter
-        for x in range(1, 120):
-            if self._uart.any():
-                # WiPy only
-                # response.extend(self._uart.readall())
-                response.extend(self._uart.read())
+        if timeout is None:
+            timeout = self._response_timeout
+        timeout_us = timeout * 1000
+        buffer = self._rx_buffer
+        view = self._rx_view
+        received = 0
 
-                # variable length function codes may require multiple reads
-                if self._exit_read(response):
+        start_us = time.ticks_us()
+        last_byte_us = start_us
+        while received < len(buffer):
+            available = self._uart.any()
+            if available:
+                n = self._uart.readinto(view[received:received + available])
+                if n:
+                    received += n
+                    last_byte_us = time.ticks_us()
+
+                    if received >= Const.ERROR_RESP_LEN and \
+                            buffer[1] >= Const.ERROR_BIAS:
+                        break
+                    if expected_len is not None:
+                        if received >= expected_len:
+                            break
+                    elif self._exit_read(view[:received]):
+                        break
+                continue
+
+            if received:
+                # a gap of 3.5 characters ends the frame
+                if time.ticks_diff(time.ticks_us(), last_byte_us) > \
+                        self._inter_frame_delay:
                     break
+            elif time.ticks_diff(time.ticks_us(), start_us) > timeout_us:
+                break
+            time.sleep_us(self._t1char)
 
-            # wait for the maximum time between two frames
-            time.sleep_us(self._inter_frame_delay)
-
-        return response
+        return buffer[:received]
 
     def _uart_read_frame(self, timeout: Optional[int] = None) -> bytearray:
         """
@@ -267,12 +355,28 @@ class Serial(CommonModbusFunctions):
         :param      slave_addr:  The slave address
         :type       slave_addr:  int
         """
+        pdu_length = len(modbus_pdu)
+        self._tx_buffer[1:1 + pdu_length] = modbus_pdu
+        self._send_buffer(slave_addr=slave_addr, pdu_length=pdu_length)
+
+    def _send_buffer(self, slave_addr: int, pdu_length: int) -> None:
+        """
+        Send the Modbus PDU written into the transmit buffer after its first
+        byte via UART
+
+        :param      slave_addr:  The slave address
+        :type       slave_addr:  int
+        :param      pdu_length:  The length of the Protocol Data Unit
+        :type       pdu_length:  int
+        """
         # modbus_adu: Modbus Application Data Unit
         # consists of the Modbus PDU, with slave address prepended and checksum appended
-        modbus_adu = bytearray()
-        modbus_adu.append(slave_addr)
-        modbus_adu.extend(modbus_pdu)
-        modbus_adu.extend(self._calculate_crc16(modbus_adu))
+        buffer = self._tx_buffer
+        buffer[0] = slave_addr
+        crc = crc16(self._tx_view[:1 + pdu_length])
+        buffer[1 + pdu_length] = crc & 0xFF
+        buffer[2 + pdu_length] = crc >> 8
+        modbus_adu = self._tx_view[:3 + pdu_length]
 
         # if self._ctrlPin:
         #     self._ctrlPin.on()
@@ -341,7 +445,12 @@ class Serial(CommonModbusFunctions):
         # print(f'sent modbus pdu: {modbus_pdu}')
         self._send(modbus_pdu=modbus_pdu, slave_addr=slave_addr)
 
-        return self._validate_resp_hdr(response=self._uart_read(),
+        response = self._uart_read(
+            expected_len=self._expected_response_len(modbus_pdu),
+            timeout=self._response_timeouts.get(slave_addr,
+                                                self._response_timeout))
+
+        return self._validate_resp_hdr(response=response,
                                        slave_addr=slave_addr,
                                        function_code=modbus_pdu[0],
                                        count=count)
@@ -372,13 +481,8 @@ class Serial(CommonModbusFunctions):
         # print(f'response: {response}')
         # print(f'response hex: {response.hex()}')
 
-        resp_crc = response[-Const.CRC_LENGTH:]
-        expected_crc = self._calculate_crc16(
-            response[0:len(response) - Const.CRC_LENGTH]
-        )
-
-        if ((resp_crc[0] is not expected_crc[0]) or
-                (resp_crc[1] is not expected_crc[1])):
+        # the CRC of a frame including its own CRC is 0 if the frame is intact
+        if crc16(memoryview(response)) != 0:
             raise OSError('invalid response CRC')
 
         if (response[0] != slave_addr):
@@ -421,7 +525,10 @@ class Serial(CommonModbusFunctions):
         :param      signed:                 Indicates if signed
         :type       signed:                 bool
         """
-        modbus_pdu = functions.response(
+        # the PDU is written straight into the transmit buffer
+        pdu_length = functions.response_into(
+            buffer=self._tx_buffer,
+            offset=1,
             function_code=function_code,
             request_register_addr=request_register_addr,
             request_register_qty=request_register_qty,
@@ -429,7 +536,8 @@ class Serial(CommonModbusFunctions):
             value_list=values,
             signed=signed
         )
-        self._send(modbus_pdu=modbus_pdu, slave_addr=slave_addr)
+        if pdu_length:
+            self._send_buffer(slave_addr=slave_addr, pdu_length=pdu_length)
 
     def send_exception_response(self,
                                 slave_addr: int,
@@ -472,13 +580,11 @@ class Serial(CommonModbusFunctions):
         if req[0] not in unit_addr_list:
             return None
 
-        req_crc = req[-Const.CRC_LENGTH:]
-        req_no_crc = req[:-Const.CRC_LENGTH]
-        expected_crc = self._calculate_crc16(req_no_crc)
-
-        if (req_crc[0] != expected_crc[0]) or (req_crc[1] != expected_crc[1]):
+        if crc16(memoryview(req)) != 0:
             return None
 
+        req_no_crc = req[:-Const.CRC_LENGTH]
+
         try:
             request = Request(interface=self, data=req_no_crc)
         except ModbusException as e:
@@ -1,5 +1,5 @@
 from time import sleep
-from ulora import LoRa, ModemConfig, SPIConfig, conex_dict, con_dict
+from ulora import LoRa, ModemConfig, SPIConfig, conex_dict, con_dict, TelemetryBatch
 import ujson
 import machine
 import onewire
@@ -8,16 +8,24 @@ from PicoDHT22 import PicoDHT22
 from angaza_mqtt import *
 from device_handler import *
 from power_modes import *
+from energy import EnergyMeter
+from acquisition import Acquisition
+from modbus_poller import ModbusPoller
 from umodbus.serial import Serial as ModbusRTUMaster
+from umodbus.const import READ_HOLDING_REGISTERS
 from pcf8574 import *
-from time import sleep
+from time import sleep, time, ticks_ms, ticks_diff
 
 # Create DeviceDetails object to access/store device details on board
 device_details = DeviceDetails()
 # Create FileDetails object to access/store file details on board
 file_details = FileDetails('send_lora_combined_mqtt_low.py')
 
+downlink_received = False
+
 def on_recv(payload):
+    global downlink_received
+    downlink_received = True
     try:
         message_json = ujson.loads(payload.message)
         broker_error = message_json.get('broker_error', None)
@@ -56,9 +64,34 @@ def fetch_dht_values():
     return [round(i, 2) for i in [T, H]]
 
 
+# Collect the DHT22 values once dht22.read_ready() is True, after dht22.start_read()
+def collect_dht_values():
+    T, H = dht22.read_result()
+    return [round(i, 2) for i in [T, H]]
+
+
 # Read soil temperature
 def detect_soil_temperature():
-    ds18b20_sensor.convert_temp()   # Read the soil temperature values from the sensor
+    start_soil_temperature()
+    sleep(DS18B20_CONVERSION_MS / 1000)
+    return collect_soil_temperature()
+
+
+DS18B20_CONVERSION_MS = 750 # time the sensor takes to convert at 12 bit resolution
+ds18b20_started = 0
+
+# Start a soil temperature conversion, soil_temperature_ready() is True once it is done
+def start_soil_temperature():
+    global ds18b20_started
+    ds18b20_sensor.convert_temp()
+    ds18b20_started = ticks_ms()
+
+
+def soil_temperature_ready():
+    return ticks_diff(ticks_ms(), ds18b20_started) >= DS18B20_CONVERSION_MS
+
+
+def collect_soil_temperature():
     soil_temperature = ds18b20_sensor.read_temp(ds_18[0]) # Read the soil temperature values from the sensor
     return round(soil_temperature, 2)
 
@@ -88,15 +121,32 @@ host = ModbusRTUMaster(
     uart_id=1 # see port specific documentation
 )
 # address of the target/client/slave device on the bus
-slave_addr = host.read_slave_address()
+slave_addr = host.read_slave_address()[0]
 register_address = 30
 register_qty = 3
 
+# every RS485 sensor read each cycle. Add a job per sensor, reads of one slave are merged
+modbus_poller = ModbusPoller(host)
+modbus_poller.add('npk', slave_addr, READ_HOLDING_REGISTERS, register_address, register_qty)
+
 def read_npk():
-    nitrogen, phosphorus, potassium = host.read_holding_registers(slave_addr, register_address, register_qty)
+    modbus_poller.poll()
+    if modbus_poller.stale('npk'):
+        raise Exception('NPK sensor not read')
+    nitrogen, phosphorus, potassium = modbus_poller.value('npk')
     return [nitrogen, phosphorus, potassium]
 
 
+# The DS18B20 conversion and the DHT22 transaction run while the ADCs and the NPK sensor are read
+sensors = Acquisition()
+sensors.add_started('soil_temperature', start_soil_temperature, soil_temperature_ready, collect_soil_temperature)
+sensors.add_started('dht', dht22.start_read, dht22.read_ready, collect_dht_values, dht22.stop_read)
+sensors.add('light', fetch_light_values)
+sensors.add('soil_moisture', detect_soil_moisture)
+sensors.add('tds', detect_tds_values)
+sensors.add('npk', read_npk)
+
+
 # Wireless specs. Store on device level
 user_id = int(device_details.get('user_id', ask_always=True))
 project_id = int(file_details.get('project_id', ask_always=True))
@@ -118,24 +168,37 @@ while CLIENT_ADDRESS not in range(2, 255):
         print('Invalid lora_client_address. Must be from 2 to 254')
 
 SERVER_ADDRESS = 1  # Address of the server, make sure to ask for this number if you are not configuring the server device yourself
+UPLINK_BATCH_LEN = 6    # readings sent together in one lora frame. 1 sends every reading straight away
+DOWNLINK_WINDOW_S = 10  # how long to listen for a downlink after sending
+ALWAYS_LISTEN = False   # listen after every send, for gateways that do not flag pending downlinks in their acks
+HIBERNATE_S = 60 + 5    # low power time between readings. sensors need 5 seconds setup
+DEBUG = False           # print sensor timings and energy use each cycle, the serial output keeps the node awake longer
 
 # initialise radio
 lora = LoRa(RA02_SPIBUS, RA02_INT, CLIENT_ADDRESS, RA02_CS, reset_pin=RA02_RST, freq=RA02_FREQ, tx_power=RA02_POW, acks=True)
 # set callback
 lora.on_recv = on_recv
 count = 0
+# readings wait here across hibernate cycles until there are enough for a batch
+batch = TelemetryBatch(UPLINK_BATCH_LEN)
+# time spent in tx, rx, idle and hibernate each cycle
+meter = EnergyMeter(lora)
 # power off esp
 power_off_esp()
 
 
 # loop and send data
 while True:
-    light = fetch_light_values()    # Fetch light values
-    T, H = fetch_dht_values() # Read ambient temperature and humidity values
-    soil_temperature = detect_soil_temperature()    # Read the soil temperature value
-    soil_moisture_percentage = detect_soil_moisture()   # Read the soil moisture content value
-    tds_value = detect_tds_values() # Read TDS values
-    nitrogen, phosphorus, potassium = read_npk()
+    awake_from = ticks_ms()
+    values = sensors.run()  # every sensor, the slow ones overlapped with the rest
+    light = values['light']
+    T, H = values['dht'] or (None, None)   # ambient temperature and humidity, None if the sensor failed
+    soil_temperature = values['soil_temperature']
+    soil_moisture_percentage = values['soil_moisture']
+    tds_value = values['tds']
+    nitrogen, phosphorus, potassium = values['npk'] or (None, None, None)
+    if DEBUG:
+        print(f'Sensors read in {sensors.cycle_ms} ms, failed: {sensors.failed}')
 
     mesg = {
         'count': count,
@@ -153,14 +216,37 @@ while True:
         'project_id': project_id,
     }
 
-    lora.send_to_wait(conex_dict(mesg, con_dict), SERVER_ADDRESS)
-    print("sent")
-    sleep(1)
-    # set to listen continuously for 10 seconds
-    lora.set_mode_rx()
-    sleep(10)
+    sent = False
+    # cleared before sending, the gateway can send the downlink as soon as it has acked
+    downlink_received = False
+    try:
+        batch.add(time(), mesg)    # compact binary frames, far less airtime than json
+    except ValueError:
+        sent = lora.send_to_wait(conex_dict(mesg, con_dict), SERVER_ADDRESS)
+
+    if batch.full():
+        # one frame for the whole batch, values sent as changes from the reading before
+        for n, frame in batch.frames(time()):
+            if not lora.send_to_wait(frame, SERVER_ADDRESS):
+                break   # kept for the next batch
+            batch.sent(n)
+            sent = True
+
+    if sent:
+        print("sent")
+
+    # only listen when the gateway's ack says it has a downlink waiting for this node
+    if sent and (ALWAYS_LISTEN or lora.downlink_expected()):
+        lora.set_mode_rx()
+        t = ticks_ms()
+        while not downlink_received and ticks_diff(ticks_ms(), t) < DOWNLINK_WINDOW_S * 1000:
+            sleep(0.1)
     lora.sleep()
-    # enter low power for 6 minutes. sensors needs 5 seconds setup
-    hibernate(60 + 5)
+    awake_ms = ticks_diff(ticks_ms(), awake_from)
+    meter.end_cycle(awake_ms, HIBERNATE_S * 1000)
+    if DEBUG:
+        print(f'Energy: {meter.stats()}')
+    # enter low power until the next reading
+    hibernate(HIBERNATE_S)
     led.toggle()
     count += 1
@@ -0,0 +1,34 @@
+# Runs the shared lib modules on CPython. tests/stubs stands in for the MicroPython
+# modules they import, and the ticks functions MicroPython adds to time are added here.
+# LoRa/Gateway/lib and LoRa/Node/lib hold the same files, the tests import LoRa/Node/lib
+import os
+import sys
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, 'stubs'), os.path.join(TESTS_DIR, '..', 'LoRa', 'Node', 'lib')]
+
+time.ticks_ms = lambda: int(time.monotonic() * 1000)
+time.ticks_us = lambda: int(time.monotonic() * 1000000)
+time.ticks_add = lambda ticks, delta: ticks + delta
+time.ticks_diff = lambda new, old: new - old
+time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+time.sleep_us = lambda us: time.sleep(us / 1000000)
+
+import micropython
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_scheduled():
+    # calls scheduled by one test never run in the next
+    micropython.pending.clear()
+
+
+@pytest.fixture
+def link():
+    # an rp2 and an esp end of the uart bridge, see uart_pair.py
+    import uart_pair
+    link = uart_pair.Link()
+    yield link
+    link.close()
@@ -0,0 +1,65 @@
+# SX127x register file behind the machine.SPI stub. The first byte after chip select is
+# the register address with the write bit, the register then advances on every byte
+# except the FIFO, as on the chip. Counts transactions so tests can compare SPI traffic
+import machine
+
+REG_FIFO = 0x00
+REG_FIFO_ADDR_PTR = 0x0d
+REG_FIFO_RX_CURRENT_ADDR = 0x10
+REG_IRQ_FLAGS = 0x12
+REG_RX_NB_BYTES = 0x13
+RX_DONE = 0x40
+
+
+class FakeRadio():
+    def __init__(self):
+        self.regs = bytearray(128)
+        self.fifo = bytearray(256)
+        self.fifo_ptr = 0
+        self.register = None
+        self.writing = False
+        self.transactions = 0
+        machine.SPI.device = self
+
+    def select(self):
+        self.register = None
+        self.transactions += 1
+
+    def transfer(self, write_buf, read_buf=None):
+        for i, byte in enumerate(write_buf):
+            if self.register is None:
+                self.register = byte & 0x7f
+                self.writing = bool(byte & 0x80)
+                continue
+            if self.writing:
+                self._write(self.register, byte)
+            elif read_buf is not None:
+                read_buf[i] = self._read(self.register)
+            if self.register != REG_FIFO:
+                self.register += 1
+
+    def _write(self, register, value):
+        if register == REG_FIFO:
+            self.fifo[self.fifo_ptr] = value
+            self.fifo_ptr = (self.fifo_ptr + 1) % 256
+        elif register == REG_FIFO_ADDR_PTR:
+            self.regs[register] = value
+            self.fifo_ptr = value
+        elif register == REG_IRQ_FLAGS:
+            self.regs[register] &= ~value   # flags clear by writing 1
+        else:
+            self.regs[register] = value
+
+    def _read(self, register):
+        if register == REG_FIFO:
+            value = self.fifo[self.fifo_ptr]
+            self.fifo_ptr = (self.fifo_ptr + 1) % 256
+            return value
+        return self.regs[register]
+
+    # a packet arrives: into the FIFO at 0, with RxDone raised
+    def receive(self, packet):
+        self.fifo[0:len(packet)] = packet
+        self.regs[REG_RX_NB_BYTES] = len(packet)
+        self.regs[REG_FIFO_RX_CURRENT_ADDR] = 0
+        self.regs[REG_IRQ_FLAGS] |= RX_DONE
@@ -0,0 +1,96 @@
+# machine for CPython. SPI talks to whatever device the test puts in SPI.device
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    PULL_DOWN = 3
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+    instances = {}  # pin number -> last Pin made for it, so tests can fire its irq handler
+
+    def __init__(self, pin, mode=None, pull=None, value=None):
+        self.pin = pin
+        self._value = 0 if value is None else value
+        self.handler = None
+        Pin.instances[pin] = self
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+        if not value and SPI.device is not None:
+            SPI.device.select()
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def irq(self, trigger=None, handler=None, hard=False):
+        self.handler = handler
+
+
+class SPI:
+    device = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def write(self, buf):
+        SPI.device.transfer(bytes(buf))
+
+    def read(self, nbytes, write=0):
+        out = bytearray(nbytes)
+        SPI.device.transfer(bytes([write]) * nbytes, out)
+        return bytes(out)
+
+    def readinto(self, buf, write=0):
+        SPI.device.transfer(bytes([write]) * len(buf), buf)
+
+    def write_readinto(self, write_buf, read_buf):
+        SPI.device.transfer(bytes(write_buf), read_buf)
+
+    def deinit(self):
+        pass
+
+
+class UART:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class Timer:
+    PERIODIC = 1
+    ONE_SHOT = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def init(self, **kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+
+class RTC:
+    pass
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state):
+    pass
+
+
+def idle():
+    pass
@@ -0,0 +1,24 @@
+# micropython for CPython. Scheduled calls wait in pending until the test runs them
+pending = []
+
+
+def const(value):
+    return value
+
+
+def native(f):
+    return f
+
+
+def viper(f):
+    return f
+
+
+def schedule(f, arg):
+    pending.append((f, arg))
+
+
+def run_scheduled():
+    while pending:
+        f, arg = pending.pop(0)
+        f(arg)
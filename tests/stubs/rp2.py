@@ -0,0 +1,36 @@
+# rp2 for CPython. PIO programs are not assembled, a StateMachine only records what it is
+# told and hands out what the test puts in its fifo
+class PIO:
+    OUT_LOW = 0
+    OUT_HIGH = 1
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+
+
+def asm_pio(**kwargs):
+    return lambda program: program
+
+
+class StateMachine:
+    def __init__(self, id, program=None, **kwargs):
+        self.id = id
+        self.running = False
+        self.fifo = []
+
+    def init(self, program, **kwargs):
+        self.running = False
+
+    def active(self, value=None):
+        if value is None:
+            return self.running
+        self.running = bool(value)
+
+    def put(self, value):
+        pass
+
+    def get(self):
+        return self.fifo.pop(0)
+
+    def rx_fifo(self):
+        return len(self.fifo)
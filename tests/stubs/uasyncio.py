@@ -0,0 +1,18 @@
+# uasyncio for CPython. StreamReader takes a fake uart of tests/uart_pair.py, which has no
+# file descriptor for asyncio to wait on, so it checks the uart between event loop turns
+import asyncio
+from asyncio import *
+
+
+def sleep_ms(ms):
+    return asyncio.sleep(ms / 1000)
+
+
+class StreamReader:
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def read(self, n):
+        while not self.stream.any():
+            await asyncio.sleep(0.001)
+        return self.stream.read(n)
@@ -0,0 +1,32 @@
+# uselect for CPython. poll() waits on the fake uarts of tests/uart_pair.py, which call
+# notify() whenever bytes arrive
+import threading
+import time
+
+POLLIN = 1
+_arrived = threading.Condition()
+
+
+def notify():
+    with _arrived:
+        _arrived.notify_all()
+
+
+class poll:
+    def __init__(self):
+        self.objs = []
+
+    def register(self, obj, mask=POLLIN):
+        self.objs.append(obj)
+
+    def poll(self, timeout=-1):
+        end = None if timeout < 0 else time.monotonic() + timeout / 1000
+        with _arrived:
+            while True:
+                ready = [(obj, POLLIN) for obj in self.objs if obj.any()]
+                if ready:
+                    return ready
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return []
+                _arrived.wait(remaining)
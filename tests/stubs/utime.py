@@ -0,0 +1,2 @@
+# utime for CPython, time with the ticks functions conftest.py adds to it
+from time import *
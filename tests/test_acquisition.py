@@ -0,0 +1,137 @@
+# user-020: the node starts the DS18B20 conversion and the DHT22 transaction, reads the ADCs
+# and the NPK sensor meanwhile and collects the slow ones once ready. A sensor that times out
+# reads as None, is powered down and the others are still returned
+import pytest
+
+import acquisition
+from acquisition import Acquisition
+import machine
+from PicoDHT22 import PicoDHT22
+
+
+class Clock():
+    def __init__(self):
+        self.ms = 0
+
+    def ticks_ms(self):
+        return self.ms
+
+    def sleep_ms(self, ms):
+        self.ms += ms
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(acquisition, 'ticks_ms', clock.ticks_ms)
+    monkeypatch.setattr(acquisition, 'sleep_ms', clock.sleep_ms)
+    return clock
+
+
+# ms each sensor keeps the cpu busy (blocking) or takes by itself once started (started)
+NODE = {
+    'soil_temperature': {'started': 750, 'blocking': 12},   # conversion, then the scratchpad read
+    'dht': {'started': 205, 'blocking': 1},                 # pin settle and the transaction
+    'light': {'blocking': 1},
+    'soil_moisture': {'blocking': 1},
+    'tds': {'blocking': 10},
+    'npk': {'blocking': 120},                               # modbus query at 9600 baud
+}
+
+
+class SimSensor():
+    def __init__(self, clock, name, latency):
+        self.clock = clock
+        self.name = name
+        self.started_ms = latency.get('started')
+        self.blocking_ms = latency['blocking']
+        self.start_at = None
+        self.stopped = False
+
+    def read(self):
+        if self.started_ms is not None:
+            self.clock.ms += self.started_ms
+        self.clock.ms += self.blocking_ms
+        return self.name
+
+    def start(self):
+        self.start_at = self.clock.ms
+
+    def ready(self):
+        return self.clock.ms - self.start_at >= self.started_ms
+
+    def result(self):
+        self.clock.ms += self.blocking_ms
+        return self.name
+
+    def stop(self):
+        self.stopped = True
+
+
+def build(clock, latencies, overlapped):
+    sensors = Acquisition()
+    sims = {}
+    for name, latency in latencies.items():
+        sim = sims[name] = SimSensor(clock, name, latency)
+        if overlapped and sim.started_ms is not None:
+            sensors.add_started(name, sim.start, sim.ready, sim.result, sim.stop)
+        else:
+            sensors.add(name, sim.read)
+    return sensors, sims
+
+
+@pytest.mark.parametrize('latencies', [
+    NODE,
+    dict(NODE, npk={'blocking': 900}),                                  # slow modbus sensor
+    dict(NODE, soil_temperature={'started': 94, 'blocking': 12}),       # DS18B20 at 9 bit
+])
+def test_cycle_time(clock, latencies):
+    cycles = {}
+    for overlapped in (False, True):
+        sensors, sims = build(clock, latencies, overlapped)
+        values = sensors.run()
+        assert values == {name: name for name in latencies}
+        cycles[overlapped] = sensors.cycle_ms
+
+    sequential = sum(latency.get('started', 0) + latency['blocking'] for latency in latencies.values())
+    blocking = sum(latency['blocking'] for latency in latencies.values())
+    slowest = max(latency.get('started', 0) + latency['blocking'] for latency in latencies.values())
+    assert cycles[False] == sequential
+    assert cycles[True] <= max(slowest, blocking) + acquisition.POLL_MS + blocking
+    print(f'sequential {cycles[False]} ms, overlapped {cycles[True]} ms')
+
+
+def test_timed_out_sensor_reads_none_and_is_stopped(clock):
+    sensors, sims = build(clock, NODE, True)
+    sims['dht'].started_ms = 10 ** 6    # never answers
+    values = sensors.run()
+    assert values['dht'] is None
+    assert sensors.failed == ['dht']
+    assert sims['dht'].stopped
+    assert {name: value for name, value in values.items() if name != 'dht'} == {name: name for name in NODE if name != 'dht'}
+    assert sensors.cycle_ms <= acquisition.TIMEOUT_MS + acquisition.POLL_MS + NODE['npk']['blocking']
+
+
+def test_failing_read_reads_none(clock):
+    sensors, sims = build(clock, NODE, True)
+
+    def no_answer():
+        raise Exception('NPK sensor not read')
+    sensors.add('npk2', no_answer)
+    values = sensors.run()
+    assert values['npk2'] is None and values['npk'] == 'npk'
+    assert sensors.failed == ['npk2']
+
+
+def test_dht22_is_powered_down_when_it_times_out(clock, monkeypatch):
+    power = machine.Pin(14, machine.Pin.OUT)
+    dht22 = PicoDHT22(machine.Pin(15, machine.Pin.IN, machine.Pin.PULL_UP), power)
+    ticks = iter(range(0, 10 ** 6, 50))
+    monkeypatch.setattr('utime.ticks_ms', lambda: next(ticks))
+    sensors = Acquisition()
+    sensors.add_started('dht', dht22.start_read, dht22.read_ready, dht22.read_result, dht22.stop_read)
+    sensors.add('light', lambda: 42)
+    assert sensors.run() == {'dht': None, 'light': 42}
+    assert not dht22.sm.active()
+    assert power.value() == 0
+    assert not dht22.started
@@ -0,0 +1,162 @@
+# user-010: the asyncio mqtt client keeps several requests outstanding over AsyncLink and
+# hands each reply to its request by req_id, whatever order the esp answers in
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import asyncio
+import time
+
+import ujson
+
+import angaza_mqtt
+import angaza_mqtt_async
+from angaza_mqtt_async import AsyncMQTTClient
+
+
+class FakeEsp():
+    # Answers mqtt operations sent in the compact envelope. Requests are held until batch of
+    # them are waiting, or the link has been idle for idle_ms, then answered newest first
+    def __init__(self, link, batch=1, idle_ms=100):
+        self.link = link
+        self.batch = batch
+        self.idle_ms = idle_ms
+        self.waiting = []
+        self.last_at = time.monotonic()
+        self.most_waiting = 0
+        self.published = []
+        self.pushes = []    # sent from the esp thread, like the esp's mqtt callback would
+        link.serve(self.received, self.idle)
+
+    def received(self, rxData):
+        if rxData[1] != 'c':
+            return
+        command = ujson.loads(rxData[0])
+        self.waiting.append(command)
+        self.last_at = time.monotonic()
+        self.most_waiting = max(self.most_waiting, len(self.waiting))
+        if len(self.waiting) >= self.batch:
+            self.answer()
+
+    def idle(self):
+        while self.pushes:
+            self.send(self.pushes.pop(0), 'json')
+        if self.waiting and (time.monotonic() - self.last_at) * 1000 > self.idle_ms:
+            self.answer()
+
+    def answer(self):
+        waiting, self.waiting = self.waiting[::-1], []
+        for opcode, req_id, *args in waiting:
+            if opcode == angaza_mqtt.opcode_dict['mqtt_publish_batch']:
+                self.published.extend(args[2])
+                self.send({'req_id': req_id, 'status_list': [True] * len(args[2])}, 'json')
+            elif opcode == angaza_mqtt.opcode_dict['mqtt_publish']:
+                self.published.append(args[2])
+            self.send({'status': True, 'status_list': [True], 'req_id': req_id}, 'command_execution')
+
+    def push(self, topic, message):
+        self.pushes.append({'topic': topic, 'message': message})
+
+    def send(self, txjson, end_format):
+        self.link.esp.send_data(self.link.esp_uart, ujson.dumps(txjson), end_format=end_format)
+
+
+def make_client(link, **kwargs):
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    link.esp_loop.stop()
+    client = AsyncMQTTClient(link.rp2_uart, 'gw-1', 'broker', **kwargs)
+    client.session = angaza_mqtt.SESSION_WIFI | angaza_mqtt.SESSION_TLS | angaza_mqtt.SESSION_MQTT
+    client.target_ref = 0
+    return client
+
+
+def test_replies_in_reverse_order_reach_their_requests(link):
+    client = make_client(link)
+    esp = FakeEsp(link, batch=4)
+
+    async def main():
+        client.start()
+        try:
+            return await asyncio.gather(*[client.publish('t', 'm%d' % i) for i in range(8)])
+        finally:
+            client.stop()
+    assert asyncio.run(main()) == [True] * 8
+    assert sorted(esp.published) == sorted('m%d' % i for i in range(8))
+    assert esp.most_waiting == 4
+
+
+@pytest.mark.parametrize('max_outstanding', [1, 2])
+def test_max_outstanding(link, max_outstanding):
+    client = make_client(link, max_outstanding=max_outstanding)
+    # the esp would wait for 3 requests, it only ever gets max_outstanding and answers once idle
+    esp = FakeEsp(link, batch=3, idle_ms=50)
+
+    async def main():
+        client.start()
+        try:
+            return await asyncio.gather(*[client.publish('t', 'm%d' % i) for i in range(6)])
+        finally:
+            client.stop()
+    assert asyncio.run(main()) == [True] * 6
+    assert esp.most_waiting == max_outstanding
+    assert client._requests == {}
+
+
+def test_publish_many_takes_the_json_reply_of_its_request(link):
+    client = make_client(link)
+    esp = FakeEsp(link, batch=2)
+
+    async def main():
+        client.start()
+        try:
+            return await asyncio.gather(client.publish_many('t', ['a', 'b', 'c']), client.publish('t', 'd'))
+        finally:
+            client.stop()
+    assert asyncio.run(main()) == [[True, True, True], True]
+    assert sorted(esp.published) == ['a', 'b', 'c', 'd']
+
+
+def test_pushed_messages_reach_the_iterator_between_replies(link):
+    client = make_client(link)
+    esp = FakeEsp(link, batch=2)
+    got = []
+    client.cb['downlink'] = got.append
+
+    async def main():
+        client.start()
+        try:
+            publishes = asyncio.gather(client.publish('t', 'a'), client.publish('t', 'b'))
+            await asyncio.sleep(0.05)
+            esp.push('downlink', 'on')
+            msg = await asyncio.wait_for(client.__anext__(), 5)
+            return await publishes, msg
+        finally:
+            client.stop()
+    statuses, msg = asyncio.run(main())
+    assert statuses == [True, True]
+    assert msg == {'topic': 'downlink', 'message': 'on'}
+    assert got == ['on']
+
+
+def test_requests_survive_a_lossy_link(link, monkeypatch):
+    for end in (link.rp2_uart, link.esp_uart):
+        end.loss = 0.01
+    client = make_client(link)
+    FakeEsp(link, batch=4)
+    monkeypatch.setattr(angaza_mqtt_async.uartlib, 'window_retries', 6)
+
+    async def main():
+        client.start()
+        try:
+            t = time.monotonic()
+            statuses = await asyncio.gather(*[client.publish('t', 'x' * (37 * i)) for i in range(8)])
+            return statuses, time.monotonic() - t
+        finally:
+            client.stop()
+    statuses, elapsed = asyncio.run(main())
+    assert statuses == [True] * 8
+    print(f'8 concurrent requests at 1% loss: {elapsed:.2f} s')
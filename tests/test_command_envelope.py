@@ -0,0 +1,69 @@
+# user-012: commands go in the compact [opcode, req_id, argument, ...] envelope only once the
+# esp has advertised it while negotiating the frame size. Older esp firmware gets the dict
+# envelope it has always parsed
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import ujson
+
+import cmdlib
+import uartlib
+
+
+@pytest.fixture
+def compact(monkeypatch):
+    monkeypatch.setattr(uartlib, 'compact_commands', True)
+
+
+def test_dict_envelope_until_the_esp_advertises_compact():
+    assert not uartlib.compact_commands
+    assert ujson.loads(cmdlib.encode_command('mqtt_connect', ('ref-1',), 3)) == {
+        'action': ['mqtt_operation'],
+        'mqtt_operation': {'arg_available': True, 'argument': [
+            {'operation': 'mqtt_connect', 'mqtt_connect': {'arg_available': True, 'argument': ['ref-1']}}]},
+        'req_id': 3}
+    assert ujson.loads(cmdlib.encode_command('get_ntp_time', ())) == {
+        'action': ['get_ntp_time'], 'get_ntp_time': {'arg_available': False, 'argument': []}}
+
+
+def test_compact_envelope(compact):
+    assert cmdlib.encode_command('mqtt_connect', ('ref-1',), 3) == '[%d, 3, "ref-1"]' % cmdlib.opcode_dict['mqtt_connect']
+
+
+@pytest.mark.parametrize('is_compact', [False, True])
+def test_both_envelopes_run_the_same_handler(monkeypatch, is_compact):
+    calls = []
+    statuses = []
+    monkeypatch.setitem(cmdlib.mqtt_operation_map, 'mqtt_connect', lambda uart_obj, *args: calls.append(args) or True)
+    monkeypatch.setattr(cmdlib, 'send_status', lambda uart_obj, execution_list: statuses.append((execution_list, cmdlib.current_req_id)))
+    monkeypatch.setattr(cmdlib, 'pace', lambda seconds=0.1: None)
+    monkeypatch.setattr(uartlib, 'compact_commands', is_compact)
+    monkeypatch.setattr(cmdlib, 'opcode_handlers', [None] * len(cmdlib.command_list))
+    cmdlib.process_command(None, cmdlib.encode_command('mqtt_connect', ('ref-1', False), 5))
+    assert calls == [('ref-1', False)]
+    assert statuses == [([True], 5)]
+
+
+def test_esp_advertises_compact_while_negotiating(link):
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    assert link.rp2.compact_commands
+
+
+def test_older_esp_firmware_keeps_the_dict_envelope(link):
+    # esp firmware from before the compact envelope answers the frame size alone
+    send_data = link.esp.send_data
+
+    def old_send_data(uart_obj, txData, **kwargs):
+        if type(txData) is str and txData.startswith('frame size '):
+            txData = txData.replace(' compact', '')
+        return send_data(uart_obj, txData, **kwargs)
+    link.esp.send_data = old_send_data
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    assert not link.rp2.compact_commands
+    assert type(ujson.loads(cmdlib.encode_command('mqtt_publish', ('ref-1', 'topic', 'msg', True)))) is dict
@@ -0,0 +1,93 @@
+# user-019: battery life of a node that listens for a downlink after every reading against
+# one that only opens the receive window when the gateway's ack flags a pending downlink
+import json
+import random
+
+import pytest
+
+import ulora
+from energy import EnergyMeter
+
+MODEM = ulora.ModemConfig.Bw125Cr45Sf128
+BATTERY_MAH = 2600      # one 18650 cell
+SENSORS_MS = 765        # an overlapped sensor cycle, see test_acquisition.py
+HIBERNATE_MS = 65000
+ACK_TURNAROUND_MS = 30  # gateway rx done to its ack on the air
+DOWNLINK_AFTER_MS = 800 # a queued downlink arrives this long after the ack
+DAY_MS = 24 * 3600 * 1000
+
+
+class SimRadio():
+    # the mode_ms counters EnergyMeter reads off a LoRa object
+    def __init__(self):
+        self.mode_ms = [0] * 8
+
+    def spend(self, mode, ms):
+        self.mode_ms[mode] += ms
+        return ms
+
+
+def reading(count, rnd):
+    return {
+        'count': count, 'device_id': 'COMBINED', 'AMBIENT_LIGHT': round(rnd.uniform(0, 100), 2),
+        'DHT_TEMPERATURE': round(rnd.uniform(18, 30), 1), 'DHT_HUMIDITY': round(rnd.uniform(40, 80), 1),
+        'Nitrogen': 37, 'Phosphorus': 12, 'Potassium': 58, 'SOIL_TEMPERATURE': round(rnd.uniform(15, 25), 2),
+        'SOIL_MOISTURE': round(rnd.uniform(30, 50), 1), 'TDS': round(rnd.uniform(250, 350), 2),
+        'user_id': 1042, 'project_id': 7,
+    }
+
+
+def simulate(listen_always, batch_len, downlink_share, cycles=2000, seed=0):
+    # Return: the EnergyMeter after cycles node loops
+    rnd = random.Random(seed)
+    radio = SimRadio()
+    meter = EnergyMeter(radio)
+    batch = []
+    ack_ms = ulora.time_on_air_ms(MODEM, 4)
+    for count in range(cycles):
+        awake_ms = SENSORS_MS
+        batch.append(reading(count, rnd))
+        if len(batch) >= batch_len:
+            if batch_len == 1:
+                frame = json.dumps(ulora.conex_dict(batch[0], ulora.con_dict)).encode()
+            else:
+                frame = ulora.encode_telemetry_batch([(count * 66 + i, values) for i, values in enumerate(batch)], count * 66 + batch_len)
+            batch = []
+            awake_ms += radio.spend(ulora.MODE_TX, ulora.time_on_air_ms(MODEM, len(frame) + 4))
+            awake_ms += radio.spend(ulora.MODE_RXCONTINUOUS, ACK_TURNAROUND_MS + ack_ms)
+            downlink = rnd.random() < downlink_share
+            if downlink:
+                awake_ms += radio.spend(ulora.MODE_RXCONTINUOUS, DOWNLINK_AFTER_MS + ulora.time_on_air_ms(MODEM, 40))
+            elif listen_always:
+                awake_ms += radio.spend(ulora.MODE_RXCONTINUOUS, 10000)
+        meter.end_cycle(awake_ms, HIBERNATE_MS)
+    return meter
+
+
+@pytest.mark.parametrize('downlink_share', [0.01, 0.1])
+def test_battery_life(downlink_share):
+    schemes = {
+        'json, listen every cycle': simulate(True, 1, downlink_share),
+        'json, listen when flagged': simulate(False, 1, downlink_share),
+        'batch of 6, listen when flagged': simulate(False, 6, downlink_share),
+    }
+    days = {}
+    for name, meter in schemes.items():
+        days[name] = meter.battery_life_days(BATTERY_MAH)
+        rx_share = meter.total_ms['rx'] / sum(meter.total_ms.values())
+        print(f'{downlink_share:.0%} downlinks, {name}: {meter.average_ma():.2f} mA, '
+              f'rx {rx_share:.1%} of the time, {days[name]:.0f} days')
+    assert days['json, listen when flagged'] > 2 * days['json, listen every cycle']
+    assert days['batch of 6, listen when flagged'] > days['json, listen when flagged']
+
+
+def test_energy_meter_splits_awake_time():
+    radio = SimRadio()
+    meter = EnergyMeter(radio)
+    radio.spend(ulora.MODE_TX, 100)
+    radio.spend(ulora.MODE_RXCONTINUOUS, 50)
+    charge = meter.end_cycle(1000, 60000)
+    assert meter.cycle_ms == {'tx': 100, 'rx': 50, 'idle': 850, 'hibernate': 60000}
+    assert charge == pytest.approx((120 * 100 + 36 * 50 + 25 * 850 + 1.2 * 60000) / 3600000)
+    meter.end_cycle(1000, 60000)
+    assert meter.cycle_ms['tx'] == 0 and meter.cycles == 2
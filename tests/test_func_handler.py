@@ -0,0 +1,208 @@
+# user-014: func_handler retries with jittered exponential backoff on the rp2, circuit
+# breakers refuse calls while what they guard is known to be down, and StagedRecovery
+# brings the link back cheapest stage first. Checked against a fault injecting fake esp
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import cmdlib
+from cmdlib import backoff_ms, CircuitBreaker, CircuitOpen, StagedRecovery
+
+
+class Clock():
+    def __init__(self):
+        self.ms = 0
+
+    def ticks_ms(self):
+        return self.ms
+
+    def sleep(self, seconds):
+        self.ms += int(seconds * 1000)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cmdlib, 'ticks_ms', clock.ticks_ms)
+    monkeypatch.setattr(cmdlib, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    calls = []
+    monkeypatch.setitem(cmdlib.handler_dict, 'update', lambda: calls.append('update'))
+    monkeypatch.setitem(cmdlib.handler_dict, 'standby', lambda: calls.append('standby'))
+    return calls
+
+
+def handled(monkeypatch, sysname, results, retries=3, **policy):
+    # func_handler reads its policy when it decorates, as on the device
+    monkeypatch.setattr(cmdlib, 'sysname', sysname)
+    calls = []
+
+    def operation():
+        calls.append(cmdlib.ticks_ms())
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    monkeypatch.setitem(cmdlib.retry_dict, 'operation', dict(policy, retries=retries))
+    return cmdlib.func_handler(operation), calls
+
+
+def test_backoff_doubles_up_to_the_cap(monkeypatch):
+    for bits, low in ((0, True), (0xffff, False)):
+        monkeypatch.setattr(cmdlib, 'getrandbits', lambda n: bits)
+        delays = [backoff_ms(attempt, 500, 30000) for attempt in range(10)]
+        ceilings = [min(500 << attempt, 30000) for attempt in range(10)]
+        expected = [ceiling // 2 for ceiling in ceilings] if low else ceilings
+        assert delays == expected
+
+
+def test_rp2_backs_off_between_retries(monkeypatch, clock, handlers):
+    f, calls = handled(monkeypatch, 'rp2', [False, Exception('no reply'), True], backoff_ms=100)
+    assert f()
+    gaps = [b - a for a, b in zip(calls, calls[1:])]
+    assert 50 <= gaps[0] <= 100 and 100 <= gaps[1] <= 200
+    assert handlers == ['update']
+
+
+def test_rp2_goes_to_standby_once_retries_run_out(monkeypatch, clock, handlers):
+    f, calls = handled(monkeypatch, 'rp2', [False] * 4)
+    assert not f()
+    assert len(calls) == 4
+    assert handlers == ['standby']
+
+
+def test_esp_retries_straight_away_and_raises(monkeypatch, clock, handlers):
+    f, calls = handled(monkeypatch, 'esp8266', [False] * 3, retries=2)
+    with pytest.raises(Exception, match='operation failed'):
+        f()
+    assert calls == [0, 0, 0]
+    assert handlers == []
+
+
+def test_partial_list_is_handed_back_without_retrying(monkeypatch, clock, handlers):
+    f, calls = handled(monkeypatch, 'rp2', [[True, False]])
+    assert f() == [True, False]
+    assert len(calls) == 1 and handlers == []
+
+
+def test_breaker_opens_and_tries_again_after_open_ms(clock):
+    breaker = CircuitBreaker('broker', threshold=3, open_ms=1000, max_open_ms=3000)
+    for i in range(3):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == breaker.OPEN and not breaker.allow()
+    clock.ms += 1000
+    assert breaker.allow() and breaker.state == breaker.HALF_OPEN
+    breaker.failure()   # the trial failed, open twice as long
+    clock.ms += 1999
+    assert not breaker.allow()
+    clock.ms += 1
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.open_ms == 3000   # capped
+    clock.ms += 3000
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == breaker.CLOSED and breaker.open_ms == 1000
+
+
+def test_open_breaker_short_circuits_the_call(monkeypatch, clock, handlers):
+    breaker = CircuitBreaker('broker', threshold=1, open_ms=1000)
+    monkeypatch.setitem(cmdlib.breaker_dict, 'operation', breaker)
+    f, calls = handled(monkeypatch, 'rp2', [False, True], retries=0)
+    assert not f()
+    with pytest.raises(CircuitOpen):
+        f()
+    assert len(calls) == 1
+    clock.ms += 1000
+    assert f()
+    assert breaker.state == breaker.CLOSED
+
+
+class FaultyEsp():
+    # What each recovery stage costs in bridge operations, and whether it can work with
+    # wifi and the broker up or down
+    def __init__(self):
+        self.wifi_up = True
+        self.broker_up = True
+        self.operations = 0
+
+    def reconnect_mqtt(self):
+        self.operations += 2    # mqtt_connect, mqtt_subscribe
+        return self.wifi_up and self.broker_up
+
+    def reconnect_wifi(self):
+        self.operations += 3    # connect_to_wifi, mqtt_connect, mqtt_subscribe
+        return self.wifi_up and self.broker_up
+
+    def reset_esp(self):
+        # reset, negotiate, key and cert, mqtt_init, connect_to_wifi, mqtt_connect, mqtt_subscribe, mqtt_push_msgs
+        self.operations += 8
+        return self.wifi_up and self.broker_up
+
+
+def test_stages_escalate_and_back_off(clock):
+    esp = FaultyEsp()
+    esp.broker_up = False
+    breaker = CircuitBreaker('broker', threshold=1)
+    breaker.failure()
+    recovery = StagedRecovery([('mqtt', esp.reconnect_mqtt), ('wifi', esp.reconnect_wifi), ('esp', esp.reset_esp)],
+                              base_ms=1000, breakers=[breaker])
+    recovery.start()
+    stages = []
+    for round in range(4):
+        stages.append(recovery.stages[recovery.level][0])
+        assert recovery.run() is None
+        assert recovery.run() is None   # not due yet
+        clock.ms += recovery.wait_ms
+    assert stages == ['mqtt', 'wifi', 'esp', 'esp']
+    esp.broker_up = True
+    assert recovery.run() == 'esp'
+    assert not recovery.active and breaker.state == breaker.CLOSED
+
+
+def test_known_down_stage_waits_without_escalating(clock):
+    def mqtt():
+        raise CircuitOpen('broker down')
+    recovery = StagedRecovery([('mqtt', mqtt), ('esp', lambda: True)], base_ms=1000)
+    recovery.start()
+    assert recovery.run() is None
+    assert recovery.level == 0
+
+
+@pytest.mark.parametrize('outage', ['broker', 'wifi'])
+def test_outage(clock, outage):
+    # 30 min outage, loop every 5 s. Before: every loop redid the whole wireless_setup.
+    # After: staged recovery with backoff. Bridge operations during the outage and the
+    # time from the link coming back to the gateway publishing again
+    results = {}
+    for scheme in ('wireless_setup every loop', 'staged recovery'):
+        esp = FaultyEsp()
+        recovery = StagedRecovery([('mqtt', esp.reconnect_mqtt), ('wifi', esp.reconnect_wifi), ('esp', esp.reset_esp)])
+        clock.ms = 0
+        recovered_at = None
+        while recovered_at is None:
+            down = clock.ms < 30 * 60000
+            setattr(esp, outage + '_up', not down)
+            if scheme == 'staged recovery':
+                recovery.start()
+                if recovery.run() is not None:
+                    recovered_at = clock.ms
+            elif esp.reset_esp():
+                recovered_at = clock.ms
+            if down:
+                operations = esp.operations
+            clock.ms += 5000
+        results[scheme] = (operations, (recovered_at - 30 * 60000) / 1000)
+
+    for scheme, (operations, delay_s) in results.items():
+        print(f'{outage} down 30 min, {scheme}: {operations} bridge operations, publishing {delay_s:.0f} s after it came back')
+    assert results['staged recovery'][0] < results['wireless_setup every loop'][0] / 10
+    assert results['staged recovery'][1] <= 300 + 5    # at most the backoff cap
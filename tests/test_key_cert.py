@@ -0,0 +1,160 @@
+# user-015: mqtt_init sends a key or certificate only if the esp does not already keep the
+# blob with the same sha256 in flash, and the rp2 decodes each pem file once. The esp end
+# runs cmdlib's mqtt_have_key_cert and store_key_cert
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import base64
+import os
+import random
+import time
+
+import ujson
+
+import angaza_mqtt
+from angaza_mqtt import MQTTClient
+import uart_pair
+
+
+class Esp():
+    # receive_key_cert and mqtt_init as the esp firmware runs them
+    def __init__(self, link):
+        self.link = link
+        self.cmdlib = uart_pair.load_esp_cmdlib(link.esp)
+        self.cmdlib.mqtt_operation_map['receive_key_cert'] = self.receive_key_cert
+        self.cmdlib.mqtt_operation_map['mqtt_init'] = self.mqtt_init
+        self.received_blobs = []
+        link.serve(self.received)
+
+    def received(self, rxData):
+        if rxData[1] == 'c':
+            self.cmdlib.process_command(self.link.esp_uart, rxData[0])
+
+    def receive_key_cert(self, uart_obj, ref, specifier):
+        self.cmdlib.print_s(uart_obj, f'receive {specifier} ready')
+        for rxData in self.cmdlib.receive_responses(uart_obj, 10000):
+            if rxData[1] == 'b':
+                self.received_blobs.append(specifier)
+                self.cmdlib.store_key_cert(ref, specifier, rxData[0])
+                return True
+
+    def mqtt_init(self, uart_obj, params):
+        ref = params[-1]
+        assert (ref, 'key') in self.cmdlib.key_cert_dict and (ref, 'cert') in self.cmdlib.key_cert_dict
+        self.cmdlib.send_data(uart_obj, ujson.dumps([self.cmdlib.opcode_dict['target_ref'], 0, ref, 'mqtt-%d' % ref]),
+                              end_format='command')
+        # the legacy link cannot carry the rp2's status of target_ref and ours at once
+        for rxData in self.cmdlib.receive_responses(uart_obj, 5000):
+            if rxData[1] == 'd':
+                return True
+
+
+def write_pem(filename, kind, der):
+    lines = base64.b64encode(der).decode()
+    with open(filename, 'w') as f:
+        f.write(f'-----BEGIN {kind}-----\n')
+        for i in range(0, len(lines), 64):
+            f.write(lines[i:i + 64] + '\n')
+        f.write(f'-----END {kind}-----\n')
+
+
+@pytest.fixture
+def pems(monkeypatch, tmp_path):
+    # the rp2's pem files and the esp's flash share the test directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(angaza_mqtt, 'der_cache', {})
+    rnd = random.Random(15)
+    blobs = {'key': rnd.randbytes(1217), 'cert': rnd.randbytes(1224)}
+    write_pem('private.pem.key', 'RSA PRIVATE KEY', blobs['key'])
+    write_pem('certificate.pem.crt', 'CERTIFICATE', blobs['cert'])
+    return {'key': 'private.pem.key', 'cert': 'certificate.pem.crt'}, blobs
+
+
+def esp_files():
+    return sorted(f for f in os.listdir() if f.startswith('kc_'))
+
+
+def test_blobs_are_sent_once(link, pems):
+    file_dict, blobs = pems
+    esp = Esp(link)
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+    assert client.mqtt_init(file_dict)
+    assert esp.received_blobs == ['key', 'cert']
+    assert len(esp_files()) == 2
+    assert esp.cmdlib.key_cert_dict[(client.ref, 'cert')] == blobs['cert']
+
+    # the esp resets and forgets what it held in ram, its flash keeps the blobs
+    esp.cmdlib.key_cert_dict.clear()
+    assert client.mqtt_init(file_dict)
+    assert esp.received_blobs == ['key', 'cert']
+    assert esp.cmdlib.key_cert_dict[(client.ref, 'key')] == blobs['key']
+
+
+def test_changed_certificate_replaces_the_old_blob(link, pems):
+    file_dict, blobs = pems
+    esp = Esp(link)
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+    assert client.mqtt_init(file_dict)
+    write_pem('certificate.pem.crt', 'CERTIFICATE', b'renewed' * 100)
+    angaza_mqtt.der_cache.clear()   # a new pem file is read after a reset of the rp2
+    assert client.mqtt_init(file_dict)
+    assert esp.received_blobs == ['key', 'cert', 'cert']
+    assert len(esp_files()) == 2
+    assert esp.cmdlib.key_cert_dict[(client.ref, 'cert')] == b'renewed' * 100
+
+
+def test_corrupted_blob_in_flash_is_sent_again(link, pems):
+    file_dict, blobs = pems
+    esp = Esp(link)
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+    assert client.mqtt_init(file_dict)
+    key_file = [f for f in esp_files() if f.startswith('kc_key_')][0]
+    with open(key_file, 'r+b') as f:
+        f.write(b'\x00')
+    assert client.mqtt_init(file_dict)
+    assert esp.received_blobs == ['key', 'cert', 'key']
+
+
+def test_pem_files_are_read_once(pems):
+    file_dict, blobs = pems
+    client = MQTTClient(None, 'gw-1', 'broker')
+    der, digest = client.load_pem(file_dict['key'])
+    assert der == blobs['key']
+    os.remove(file_dict['key'])
+    assert client.load_pem(file_dict['key']) == (der, digest)
+
+
+@pytest.mark.parametrize('framed', [False, True])
+def test_reconnect_time(pems, framed):
+    # mqtt_init over a 115200 baud bridge with 1 ms latency each way: cold with nothing
+    # cached, the esp holding the blobs in flash after a reset, and both caches warm
+    file_dict, blobs = pems
+    link = uart_pair.Link(baud=115200, latency_ms=1)
+    try:
+        esp = Esp(link)
+        if framed:
+            assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+        client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+        times = {}
+        for cache in ('cold', 'esp flash', 'warm'):
+            if cache == 'esp flash':
+                angaza_mqtt.der_cache.clear()
+            esp.cmdlib.key_cert_dict.clear()
+            bytes_before = link.rp2_uart.written
+            t = time.monotonic()
+            assert client.mqtt_init(file_dict)
+            times[cache] = ((time.monotonic() - t) * 1000, link.rp2_uart.written - bytes_before)
+    finally:
+        link.close()
+    for cache, (ms, sent) in times.items():
+        print(f'{"framed" if framed else "legacy"} link, {cache:>9}: mqtt_init {ms:6.0f} ms, {sent:5d} bytes to the esp')
+    assert esp.received_blobs == ['key', 'cert']
+    assert times['warm'][1] < times['cold'][1] / 3
+    assert times['warm'][0] < times['cold'][0]
@@ -0,0 +1,160 @@
+# user-022: the poller merges nearby register reads of a slave, reads the quickest slaves
+# first and skips a missing slave after one timeout. Timed against a simulated RS485 bus
+import pytest
+
+import modbus_poller
+from modbus_poller import ModbusPoller
+from umodbus import const as Const
+
+CHAR_MS = 11000 / 9600  # one character at 9600 baud, 8N1 plus parity
+SLAVE_DELAY_MS = {1: 20, 2: 60, 3: 150, 4: None}   # slave 4 is missing
+TIMEOUT_MS = 1000
+
+JOBS = [
+    ('npk', 1, Const.READ_HOLDING_REGISTERS, 30, 3, 0),
+    ('ph', 1, Const.READ_HOLDING_REGISTERS, 6, 1, 0),
+    ('ec', 1, Const.READ_HOLDING_REGISTERS, 21, 1, 0),
+    ('moisture', 1, Const.READ_HOLDING_REGISTERS, 18, 2, 0),
+    ('wind', 2, Const.READ_HOLDING_REGISTERS, 0, 2, 0),
+    ('direction', 2, Const.READ_HOLDING_REGISTERS, 3, 1, 0),
+    ('rain', 2, Const.READ_INPUT_REGISTER, 0, 1, 60),
+    ('co2', 3, Const.READ_HOLDING_REGISTERS, 2, 1, 0),
+    ('lux', 3, Const.READ_HOLDING_REGISTERS, 7, 2, 0),
+    ('level', 4, Const.READ_HOLDING_REGISTERS, 0, 1, 0),
+]
+
+
+class Clock():
+    def __init__(self):
+        self.ms = 0.0
+
+    def __call__(self):
+        return int(self.ms)
+
+
+class Bus():
+    # Slaves answer register n with the value n. Each request costs its characters, the
+    # slave's delay and the response characters, a missing slave costs the timeout
+    def __init__(self, clock):
+        self.clock = clock
+        self.requests = []
+
+    def read_holding_registers(self, slave_addr, start, qty, signed=True):
+        self.requests.append((slave_addr, start, qty))
+        self.clock.ms += (8 + 3.5) * CHAR_MS
+        delay = SLAVE_DELAY_MS[slave_addr]
+        if delay is None:
+            self.clock.ms += TIMEOUT_MS
+            raise OSError('no data received from slave')
+        self.clock.ms += delay + (5 + 2 * qty + 3.5) * CHAR_MS
+        return tuple(range(start, start + qty))
+
+    read_input_registers = read_holding_registers
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(modbus_poller, 'ticks_ms', clock)
+    return clock
+
+
+def make_poller(clock, max_gap=modbus_poller.MAX_GAP):
+    bus = Bus(clock)
+    poller = ModbusPoller(bus, max_gap=max_gap)
+    for job in JOBS:
+        poller.add(*job)
+    return poller, bus
+
+
+def test_nearby_ranges_are_merged(clock):
+    poller, bus = make_poller(clock, max_gap=4)
+    reads = poller.schedule()
+    slave_1 = [read[3:5] for read in reads if read[0] == 1]
+    assert slave_1 == [[6, 1], [18, 4], [30, 3]]    # moisture and ec are 1 register apart
+    assert sorted(name for read in reads for name in read[5]) == sorted(job[0] for job in JOBS)
+
+
+def test_merged_values_match_per_job_reads(clock):
+    poller, bus = make_poller(clock, max_gap=12)
+    poller.poll()
+    for name, slave, function, start, qty, period in JOBS:
+        if slave != 4:
+            assert poller.value(name) == tuple(range(start, start + qty))
+            assert not poller.stale(name)
+
+
+def test_missing_slave_costs_one_timeout_and_goes_stale(clock):
+    poller, bus = make_poller(clock)
+    poller.poll()
+    assert [request[0] for request in bus.requests].count(4) == 1
+    assert poller.stale('level')
+    assert poller.value('level') is None
+    assert poller.failures == 1
+
+
+def test_quickest_slaves_are_read_first(clock):
+    poller, bus = make_poller(clock)
+    poller.poll()
+    bus.requests.clear()
+    clock.ms += 65000
+    poller.poll()
+    order = [request[0] for request in bus.requests]
+    assert order == sorted(order, key=lambda slave: poller.slave_ms[slave])
+
+
+def test_every_poll_job_stays_fresh_across_second_boundaries(clock):
+    poller, bus = make_poller(clock)
+    clock.ms = 999
+    poller.poll()
+    clock.ms += 5000
+    assert not poller.stale('npk')
+    assert poller.stale('level')
+
+
+def test_period_job_is_only_read_when_due(clock):
+    poller, bus = make_poller(clock)
+    poller.poll()
+    read_at = poller.jobs['rain']['read_at']
+    clock.ms += 30000
+    poller.poll()
+    assert poller.jobs['rain']['read_at'] == read_at
+    assert not poller.stale('rain')
+    clock.ms += 100000
+    assert poller.stale('rain')
+    poller.poll()
+    assert poller.jobs['rain']['read_at'] > read_at
+
+
+def cycle_cost(clock, rounds, max_gap=None):
+    bus = Bus(clock)
+    if max_gap is None:
+        for _ in range(rounds):
+            for name, slave, function, start, qty, period in JOBS:
+                try:
+                    bus.read_holding_registers(slave, start, qty)
+                except OSError:
+                    pass
+    else:
+        poller = ModbusPoller(bus, max_gap=max_gap)
+        for job in JOBS:
+            poller.add(*job)
+        for _ in range(rounds):
+            poller.poll()
+            clock.ms += 65000
+    bus_ms = clock.ms - (0 if max_gap is None else rounds * 65000)
+    return len(bus.requests) / rounds, bus_ms / rounds
+
+
+def test_bus_time_per_cycle(clock):
+    rounds = 10
+    requests, naive_ms = cycle_cost(clock, rounds)
+    results = [(requests, naive_ms)]
+    for max_gap in (4, 12):
+        clock.ms = 0
+        results.append(cycle_cost(clock, rounds, max_gap))
+    assert results[0][0] == 10
+    assert results[1][0] < results[0][0] and results[2][0] < results[1][0]
+    assert results[1][1] < results[0][1] and results[2][1] < results[1][1]
+    print('one read per job: {:.0f} requests, {:.0f} ms per cycle; max_gap 4: {:.0f}, {:.0f} ms; '
+          'max_gap 12: {:.0f}, {:.0f} ms'.format(*results[0], *results[1], *results[2]))
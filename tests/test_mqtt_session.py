@@ -0,0 +1,182 @@
+# user-016: the mqtt client tracks wifi, tls, mqtt and subscriptions as separate session
+# layers. A failure drops the layer it hit and the ones built on it, and resume() only redoes
+# those, against a fake esp on a simulated uart
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import time
+
+import ujson
+
+import angaza_mqtt
+from angaza_mqtt import MQTTClient, SESSION_WIFI, SESSION_TLS, SESSION_MQTT, SESSION_SUBSCRIBED, connect_to_wifi
+
+ALL_LAYERS = SESSION_WIFI | SESSION_TLS | SESSION_MQTT | SESSION_SUBSCRIBED
+
+
+class FakeEsp():
+    # Runs the mqtt operations the rp2 sends. up holds which of wifi and the broker are
+    # reachable, tls whether the esp still has the mqtt client from mqtt_init
+    def __init__(self, link):
+        self.link = link
+        self.calls = []
+        self.wifi_up = True
+        self.broker_up = True
+        self.tls = False
+        self.session_present = False
+        link.serve(self.received)
+
+    def received(self, rxData):
+        if rxData[1] != 'c':
+            return
+        opcode, req_id, *args = ujson.loads(rxData[0])
+        name = angaza_mqtt.command_list[opcode][0]
+        self.calls.append(name)
+        status = getattr(self, name)(*args)
+        self.send({'status': status, 'status_list': [status]}, 'command_execution')
+
+    def send(self, txjson, end_format):
+        self.link.esp.send_data(self.link.esp_uart, ujson.dumps(txjson), end_format=end_format)
+
+    def connect_to_wifi(self, ssid, password, timeout_ms):
+        return self.wifi_up
+
+    def mqtt_init(self, params):
+        self.tls = True
+        ref = params[-1]
+        self.link.esp.send_data(self.link.esp_uart, ujson.dumps([angaza_mqtt.opcode_dict['target_ref'], 0, ref, 'mqtt-%d' % ref]),
+                                end_format='command')
+        return True
+
+    def mqtt_connect(self, target_ref, clean_session=True):
+        if not self.tls or target_ref is None or not (self.wifi_up and self.broker_up):
+            return False
+        self.send({'session_present': self.session_present and not clean_session}, 'json')
+        return True
+
+    def mqtt_subscribe(self, target_ref, topic):
+        return self.tls and self.wifi_up and self.broker_up
+
+    def mqtt_push_msgs(self, target_ref, enable):
+        return True
+
+    def reset(self):
+        self.tls = False
+
+
+@pytest.fixture
+def esp(link):
+    esp = FakeEsp(link)
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    return esp
+
+
+def connected_client(esp, **kwargs):
+    client = MQTTClient(esp.link.rp2_uart, 'gw-1', 'broker', **kwargs)
+    client.set_callback('downlink', lambda msg: None)
+    assert connect_to_wifi(esp.link.rp2_uart, 'ssid', 'password')
+    assert client.connect({})
+    # as the gateway's connect_mqtt does
+    client.subscriptions['downlink'] = 0
+    assert client.restore_subscriptions()
+    assert client.enable_push()
+    assert client.session == ALL_LAYERS
+    esp.calls.clear()
+    return client
+
+
+def test_layers_come_up_in_order(esp):
+    client = MQTTClient(esp.link.rp2_uart, 'gw-1', 'broker')
+    client.set_callback('downlink', lambda msg: None)
+    assert client.session == 0
+    assert connect_to_wifi(esp.link.rp2_uart, 'ssid', 'password')
+    assert client.session == SESSION_WIFI
+    assert client.connect({})
+    assert client.session == SESSION_WIFI | SESSION_TLS | SESSION_MQTT
+    assert client.target_ref == 'mqtt-%d' % client.ref
+    assert client.subscribe('downlink')
+    assert client.session == SESSION_WIFI | SESSION_TLS | SESSION_MQTT
+    assert client.restore_subscriptions()
+    assert client.session == ALL_LAYERS
+
+
+@pytest.mark.parametrize('layer, redone, kept', [
+    (SESSION_SUBSCRIBED, ['mqtt_subscribe'], SESSION_WIFI | SESSION_TLS | SESSION_MQTT),
+    (SESSION_MQTT, ['mqtt_connect', 'mqtt_subscribe'], SESSION_WIFI | SESSION_TLS),
+    (SESSION_TLS, ['mqtt_init', 'mqtt_connect', 'mqtt_subscribe', 'mqtt_push_msgs'], SESSION_WIFI),
+    (SESSION_WIFI, ['connect_to_wifi', 'mqtt_connect', 'mqtt_subscribe'], SESSION_TLS),
+])
+def test_losing_a_layer_redoes_only_it_and_its_dependents(esp, layer, redone, kept):
+    client = connected_client(esp)
+    client.lost(layer)
+    assert client.session == kept
+    if layer == SESSION_TLS:
+        esp.reset()
+    assert client.resume()
+    assert esp.calls == redone
+    assert client.session == ALL_LAYERS
+
+
+def test_kept_broker_session_skips_subscribing(esp):
+    client = connected_client(esp, clean_session=False)
+    esp.session_present = True
+    assert client.resume(SESSION_MQTT)
+    assert esp.calls == ['mqtt_connect']
+    assert client.session == ALL_LAYERS
+
+
+def test_wifi_failure_keeps_tls(esp):
+    client = connected_client(esp)
+    esp.wifi_up = False
+    assert not client.resume(SESSION_WIFI)
+    assert client.session == SESSION_TLS
+    esp.wifi_up = True
+    esp.calls.clear()
+    assert client.resume()
+    assert 'mqtt_init' not in esp.calls
+
+
+def test_broker_failure_keeps_wifi_and_tls(esp):
+    client = connected_client(esp)
+    esp.broker_up = False
+    assert not client.resume(SESSION_MQTT)
+    assert client.session == SESSION_WIFI | SESSION_TLS
+    esp.broker_up = True
+    esp.calls.clear()
+    assert client.resume()
+    assert esp.calls == ['mqtt_connect', 'mqtt_subscribe']
+
+
+def test_subscribe_failure_keeps_the_connection(esp):
+    client = connected_client(esp)
+    esp.broker_up = False
+    assert not client.resume(SESSION_SUBSCRIBED)
+    assert client.session == SESSION_WIFI | SESSION_TLS | SESSION_MQTT
+
+
+def test_resume_against_a_full_reconnect(esp):
+    # bridge operations and time to get back up after each kind of failure
+    client = connected_client(esp)
+    results = []
+    for name, layer in (('subscriptions', SESSION_SUBSCRIBED), ('broker', SESSION_MQTT),
+                        ('esp reset', SESSION_TLS), ('wifi', SESSION_WIFI)):
+        if layer == SESSION_TLS:
+            esp.reset()
+        esp.calls.clear()
+        t = time.perf_counter()
+        assert client.resume(layer)
+        results.append((name, len(esp.calls), (time.perf_counter() - t) * 1000))
+    esp.calls.clear()
+    esp.reset()
+    t = time.perf_counter()
+    client.lost(ALL_LAYERS)
+    assert client.resume()
+    full = (len(esp.calls), (time.perf_counter() - t) * 1000)
+    assert all(calls < full[0] for name, calls, ms in results)
+    print('bridge operations over the simulated uart. ' +
+          '; '.join(f'{name} lost: {calls} operations {ms:.0f} ms' for name, calls, ms in results) +
+          f'; full reconnect: {full[0]} operations {full[1]:.0f} ms')
@@ -0,0 +1,205 @@
+# user-017: the gateway outbox keeps readings in flash through broker outages and resets.
+# put() runs from the lora callback and stays in ram; flush(), peek() and pop() on the main
+# loop do the flash writes. A power cut loses only what was still buffered in ram
+import os
+import random
+import types
+
+import pytest
+
+import outbox
+from outbox import Outbox, SEQ_BLOCK
+
+
+class Clock():
+    def __init__(self):
+        self.ms = 0
+
+    def __call__(self):
+        return self.ms
+
+
+class PowerCut(Exception):
+    pass
+
+
+class Flash():
+    # The filesystem as outbox sees it. cut_at set to 'write' tears the next segment write
+    # part way, 'cursor' cuts the power before the new cursor file is renamed into place
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.cut_at = None
+        self.writes = 0
+        self.renames = 0
+
+    def open(self, path, mode='r'):
+        f = open(path, mode)
+        if 'w' in mode or 'a' in mode:
+            self.writes += 1
+        if 'a' in mode:
+            return TornFile(f, self)
+        return f
+
+    def rename(self, old, new):
+        self.renames += 1
+        if self.cut_at == 'cursor':
+            self.cut_at = None
+            raise PowerCut('cut before the cursor was saved')
+        os.rename(old, new)
+
+
+class TornFile():
+    def __init__(self, f, flash):
+        self.f = f
+        self.flash = flash
+
+    def write(self, data):
+        if self.flash.cut_at == 'write':
+            self.flash.cut_at = None
+            self.f.write(bytes(data[:self.flash.rnd.randrange(1, len(data))]))
+            raise PowerCut('torn segment write')
+        return self.f.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(outbox, 'ticks_ms', clock)
+    return clock
+
+
+@pytest.fixture
+def flash(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    flash = Flash(random.Random(1))
+    monkeypatch.setattr(outbox, 'open', flash.open, raising=False)
+    monkeypatch.setattr(outbox, 'os', types.SimpleNamespace(
+        listdir=os.listdir, mkdir=os.mkdir, stat=os.stat, remove=os.remove, rename=flash.rename))
+    return flash
+
+
+def reading(i):
+    return {'user_id': 7, 'client_id': 'gw-1', 'd_id': i % 5, 'dh_t': 24.5, 'dh_h': 61.2, 's_m': 33, 'c_t': i}
+
+
+def drain(box):
+    items = []
+    while len(box):
+        batch = box.peek(10)
+        items.extend(batch)
+        box.pop_published([True] * len(batch))
+    return items
+
+
+def test_put_never_touches_flash(clock, flash):
+    box = Outbox(seq_key='seq')
+    writes = flash.writes
+    for i in range(3 * SEQ_BLOCK):
+        box.put(reading(i))
+    assert flash.writes == writes
+    assert [item['c_t'] for item in box.peek()] == list(range(3 * SEQ_BLOCK))
+
+
+def test_sequence_numbers_never_repeat_after_a_reset(clock, flash):
+    # more puts than one reserved block between main loop calls, published from ram, then a cut
+    box = Outbox(seq_key='seq')
+    for i in range(SEQ_BLOCK + 10):
+        box.put(reading(i))
+    seen = [item['seq'] for item in drain(box)]
+    box.put(reading(-1))
+    box = Outbox(seq_key='seq')
+    box.put(reading(-2))
+    seen += [item['seq'] for item in drain(box)]
+    assert len(seen) == len(set(seen))
+
+
+def test_flush_waits_for_bytes_or_age(clock, flash):
+    box = Outbox(flush_bytes=512, flush_ms=60000)
+    box.put(reading(0))
+    assert box.flush() == 0
+    clock.ms += 60000
+    assert box.flush() == 1
+    for i in range(5):
+        box.put(reading(i))
+    assert box.flush() == 5     # over 512 B
+    assert [item['c_t'] for item in drain(box)] == [0, 0, 1, 2, 3, 4]
+
+
+def test_records_torn_by_a_cut_end_their_segment(clock, flash):
+    box = Outbox()
+    for i in range(4):
+        box.put(reading(i))
+    box.flush(force=True)
+    box.put(reading(4))
+    flash.cut_at = 'write'
+    with pytest.raises(PowerCut):
+        box.flush(force=True)
+    box = Outbox()
+    box.put(reading(5))
+    box.flush(force=True)
+    assert [item['c_t'] for item in drain(box)] == [0, 1, 2, 3, 5]
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_outage_with_power_cuts(clock, flash, seed):
+    # 9 h of 4 nodes every 60 s with the broker down from 1 h to 7 h. Power is cut at random
+    # while draining (torn writes and cuts before the cursor is saved) and during the outage
+    rnd = random.Random(seed)
+    flash.rnd = rnd
+    box = Outbox(seq_key='seq')
+    put = 0
+    received = []       # (seq, c_t) the broker got
+    lost_in_ram = set()
+    payload_bytes = 0   # json of every reading, most are published before reaching flash
+    cuts = 0
+    for t in range(0, 9 * 3600, 60):
+        clock.ms = t * 1000
+        for node in range(4):
+            box.put(reading(put))
+            payload_bytes += len(outbox.ujson.dumps(reading(put)))
+            put += 1
+        broker_up = not 3600 <= t < 7 * 3600
+        try:
+            if broker_up:
+                while len(box):
+                    if rnd.random() < 0.02:
+                        flash.cut_at = rnd.choice(['cursor', 'write'])
+                    batch = box.peek(10)
+                    received.extend((item['seq'], item['c_t']) for item in batch)
+                    box.pop_published([True] * len(batch))
+            elif rnd.random() < 0.01:
+                flash.cut_at = 'write'
+            box.flush()
+        except PowerCut:
+            cuts += 1
+            # under flush_bytes, plus the readings of this cycle not flushed yet
+            assert box._pending_bytes < outbox.FLUSH_BYTES + 4 * 100
+            lost_in_ram.update(outbox.ujson.loads(record[outbox.HEADER_LEN:-2])['c_t'] for seq, record in box._pending)
+            bytes_written = box.bytes_written
+            box = Outbox(seq_key='seq')
+            box.bytes_written += bytes_written
+        flash.cut_at = None
+    box.flush(force=True)
+    received.extend((item['seq'], item['c_t']) for item in drain(box))
+
+    delivered = set(c_t for seq, c_t in received)
+    missing = set(range(put)) - delivered
+    # only readings buffered in ram at a cut are lost, never one that reached flash
+    assert missing <= lost_in_ram
+    # a repeat keeps its sequence number, and no number is given to two readings
+    assert len(set(received)) == len(delivered)
+    assert len(set(seq for seq, c_t in set(received))) == len(delivered)
+    # in order apart from repeats after a cut
+    first_seen = []
+    for seq, c_t in received:
+        if c_t not in first_seen:
+            first_seen.append(c_t)
+    assert first_seen == sorted(first_seen)
+    print(f'seed {seed}: {put} readings, {cuts} cuts, {len(received) - len(delivered)} repeats, '
+          f'{len(missing)} lost in ram, {box.bytes_written / payload_bytes:.2f} flash bytes per json byte')
@@ -0,0 +1,109 @@
+# user-013: once the frame size is negotiated every message is acknowledged, so bridge
+# operations no longer sleep a fixed 0.1 s to pace the esp. handler_dict['latency'] is told
+# how long each operation waited on the esp and how long it was busy otherwise
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import time
+
+import angaza_mqtt
+from angaza_mqtt import MQTTClient, SESSION_WIFI, SESSION_TLS, SESSION_MQTT
+import cmdlib
+import uart_pair
+import uartlib
+
+
+class Esp():
+    def __init__(self, link):
+        self.link = link
+        self.cmdlib = uart_pair.load_esp_cmdlib(link.esp)
+        self.cmdlib.mqtt_operation_map['mqtt_publish'] = lambda uart_obj, target_ref, topic, msg, feedback=True: True
+        link.serve(self.received)
+
+    def received(self, rxData):
+        if rxData[1] == 'c':
+            self.cmdlib.process_command(self.link.esp_uart, rxData[0])
+
+
+def connected(link):
+    client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+    client.session = SESSION_WIFI | SESSION_TLS | SESSION_MQTT
+    client.target_ref = 'mqtt-%d' % client.ref
+    return client
+
+
+@pytest.fixture
+def latencies(monkeypatch):
+    latencies = []
+    monkeypatch.setitem(cmdlib.handler_dict, 'latency', lambda name, busy_ms, wait_ms: latencies.append((name, busy_ms, wait_ms)))
+    return latencies
+
+
+def test_pace_sleeps_only_on_the_legacy_link(monkeypatch):
+    slept = []
+    monkeypatch.setattr(uartlib, 'sleep', slept.append)
+    uart_pair.reset(uartlib)
+    uartlib.pace()
+    uart_pair.set_frame_size(uartlib, 58, 4)
+    uartlib.pace()
+    uart_pair.reset(uartlib)
+    assert slept == [0.1]
+
+
+def test_operations_report_their_latency(latencies):
+    link = uart_pair.Link(latency_ms=2)
+    try:
+        Esp(link)
+        assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+        client = connected(link)
+        assert client.publish('readings', '{}')     # func_handler
+        assert client.enable_push()                 # timed
+    finally:
+        link.close()
+    assert [name for name, busy_ms, wait_ms in latencies] == ['publish', 'enable_push']
+    for name, busy_ms, wait_ms in latencies:
+        # the command there and its reply back
+        assert busy_ms >= 0 and wait_ms >= 4
+
+
+def test_timed_keeps_the_result_and_reports_failures(latencies):
+    @cmdlib.timed
+    def fails():
+        raise Exception('no reply')
+    with pytest.raises(Exception, match='no reply'):
+        fails()
+    assert cmdlib.timed(lambda: 5)() == 5
+    assert [name for name, busy_ms, wait_ms in latencies] == ['fails', '<lambda>']
+
+
+def round_trip_ms(negotiate, latencies, count=5):
+    link = uart_pair.Link(baud=115200, latency_ms=1)
+    try:
+        Esp(link)
+        if negotiate:
+            assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+        client = connected(link)
+        latencies.clear()
+        t = time.monotonic()
+        for i in range(count):
+            assert client.publish('readings', '{"d_id": %d, "dh_t": 24.5}' % i)
+        total_ms = (time.monotonic() - t) * 1000 / count
+    finally:
+        link.close()
+    busy_ms = sum(busy for name, busy, wait in latencies) / count
+    wait_ms = sum(wait for name, busy, wait in latencies) / count
+    return total_ms, busy_ms, wait_ms
+
+
+def test_publish_round_trip(latencies):
+    # before: the legacy link, paced by fixed sleeps. after: acknowledged frames, no sleeps
+    before = round_trip_ms(False, latencies)
+    after = round_trip_ms(True, latencies)
+    for name, (total_ms, busy_ms, wait_ms) in (('fixed sleeps', before), ('acknowledged', after)):
+        print(f'{name:>12}: {total_ms:6.1f} ms per publish, {busy_ms:6.1f} ms busy, {wait_ms:6.1f} ms waiting on the esp')
+    assert after[0] < before[0] / 4
+    assert after[0] < 100
@@ -0,0 +1,114 @@
+# user-006: publish_many sends a list of messages in one mqtt_publish_batch command and gets
+# one status per message back. The esp end runs cmdlib's own mqtt_publish_batch
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import time
+
+import ujson
+
+import angaza_mqtt
+from angaza_mqtt import MQTTClient, publish_statuses, SESSION_WIFI, SESSION_TLS, SESSION_MQTT
+import uart_pair
+
+
+class EspBroker():
+    # The esp end: commands go through the esp's cmdlib, its mqtt_publish hands messages to
+    # a broker that refuses any message containing 'refused'
+    def __init__(self, link):
+        self.link = link
+        self.cmdlib = uart_pair.load_esp_cmdlib(link.esp)
+        self.cmdlib.mqtt_operation_map['mqtt_publish'] = self.mqtt_publish
+        self.published = []
+        self.commands = 0
+        link.serve(self.received)
+
+    def received(self, rxData):
+        if rxData[1] == 'c':
+            self.commands += 1
+            self.cmdlib.process_command(self.link.esp_uart, rxData[0])
+
+    def mqtt_publish(self, uart_obj, target_ref, topic, msg, feedback=True):
+        if 'refused' in msg:
+            raise Exception('broker refused the message')
+        self.published.append((topic, msg))
+        return True
+
+
+def connected(link):
+    client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+    client.session = SESSION_WIFI | SESSION_TLS | SESSION_MQTT
+    client.target_ref = 'mqtt-%d' % client.ref
+    return client
+
+
+@pytest.fixture
+def broker(link):
+    broker = EspBroker(link)
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    return broker
+
+
+def readings(count):
+    return [ujson.dumps({'d_id': i % 4, 'dh_t': 24.5, 'dh_h': 61.2, 'c_t': i}) for i in range(count)]
+
+
+def test_one_round_trip_for_the_batch(broker):
+    client = connected(broker.link)
+    messages = readings(10)
+    assert client.publish_many('readings', messages) == [True] * 10
+    assert broker.commands == 1
+    assert broker.published == [('readings', msg) for msg in messages]
+
+
+def test_status_per_message(broker):
+    client = connected(broker.link)
+    messages = readings(5)
+    messages[2] = 'refused'
+    assert client.publish_many('readings', messages) == [True, True, False, True, True]
+    assert len(broker.published) == 4
+
+
+def test_dict_envelope(broker, monkeypatch):
+    # an esp that never advertised the compact envelope
+    monkeypatch.setattr(broker.link.rp2, 'compact_commands', False)
+    client = connected(broker.link)
+    assert client.publish_many('readings', readings(3)) == [True] * 3
+    assert len(broker.published) == 3
+
+
+def test_statuses_from_an_esp_without_a_status_list():
+    assert publish_statuses(None, True, 3) == [True] * 3
+    assert publish_statuses(None, False, 2) == [False] * 2
+    # messages the esp did not report on count as failed
+    assert publish_statuses([True, 'x'], False, 4) == [True, False, False, False]
+    assert publish_statuses([True, True, True], True, 2) == [True, True]
+
+
+def test_messages_per_second():
+    # 115200 baud with 1 ms latency each way, publish() per reading against publish_many
+    link = uart_pair.Link(baud=115200, latency_ms=1)
+    try:
+        broker = EspBroker(link)
+        assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+        client = connected(link)
+        rates = {}
+        for count in (1, 10, 100):
+            messages = readings(count)
+            t = time.monotonic()
+            for msg in messages:
+                assert client.publish('readings', msg)
+            rates['publish', count] = count / (time.monotonic() - t)
+            t = time.monotonic()
+            assert client.publish_many('readings', messages) == [True] * count
+            rates['publish_many', count] = count / (time.monotonic() - t)
+    finally:
+        link.close()
+    for (api, count), rate in rates.items():
+        print(f'{api:>12} {count:3d} readings: {rate:6.0f} messages/s')
+    # a batch of 100 is bound by the 11520 B/s the uart carries, not by round trips
+    assert rates['publish_many', 100] > 1.5 * rates['publish', 100]
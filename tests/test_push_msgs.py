@@ -0,0 +1,159 @@
+# user-011: the esp pushes subscribed messages to the rp2 as they arrive, and the gateway
+# hands them to the topic callback from poll_msgs or while waiting on any request, instead
+# of asking for them with check_msg every loop. The esp end runs cmdlib's mqtt_push_msgs
+# and push_mqtt_msg
+import sys
+
+import pytest
+
+if sys.version_info < (3, 12):
+    pytest.skip('cmdlib uses nested f-string quotes, which CPython parses from 3.12', allow_module_level=True)
+
+import queue
+import time
+
+import ujson
+
+from angaza_mqtt import MQTTClient, SESSION_WIFI, SESSION_TLS, SESSION_MQTT
+import uart_pair
+
+LOOP_PERIOD_MAX = 5     # the gateway's idle loop period, receive_lora_mqtt.py
+
+
+class EspBroker():
+    # Messages from the broker are handed to the esp thread, which pushes them if the rp2
+    # asked for it and keeps them for mqtt_check_msg otherwise
+    def __init__(self, link):
+        self.link = link
+        self.cmdlib = uart_pair.load_esp_cmdlib(link.esp)
+        self.cmdlib.mqtt_operation_map['mqtt_publish'] = lambda uart_obj, target_ref, topic, msg, feedback=True: True
+        self.cmdlib.mqtt_operation_map['mqtt_check_msg'] = self.mqtt_check_msg
+        self.arrived = queue.Queue()
+        self.kept = []
+        link.serve(self.received, self.idle)
+
+    def received(self, rxData):
+        if rxData[1] == 'c':
+            self.cmdlib.process_command(self.link.esp_uart, rxData[0])
+
+    def idle(self):
+        while not self.arrived.empty():
+            target_ref, topic, msg = self.arrived.get()
+            if not self.cmdlib.push_mqtt_msg(self.link.esp_uart, target_ref, topic, msg):
+                self.kept.append((topic, msg))
+
+    def mqtt_check_msg(self, uart_obj, target_ref):
+        if self.kept:
+            topic, msg = self.kept.pop(0)
+            self.cmdlib.send_data(uart_obj, ujson.dumps({'topic': topic, 'message': msg}), end_format='json')
+        return True
+
+    def message(self, client, msg, topic='downlink'):
+        self.arrived.put((client.target_ref, topic, msg))
+
+
+@pytest.fixture
+def broker(link):
+    broker = EspBroker(link)
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    return broker
+
+
+def connected(link, received):
+    client = MQTTClient(link.rp2_uart, 'gw-1', 'broker')
+    client.session = SESSION_WIFI | SESSION_TLS | SESSION_MQTT
+    client.target_ref = 'mqtt-%d' % client.ref
+    client.set_callback('downlink', lambda msg: received.append((time.monotonic(), msg)))
+    return client
+
+
+def test_enable_push(broker):
+    client = connected(broker.link, [])
+    assert client.enable_push()
+    assert client.push_msgs
+    assert broker.cmdlib.push_msg_dict[client.target_ref]
+    assert client.enable_push(False) is True
+    assert not client.push_msgs
+
+
+def test_pushed_message_reaches_the_callback(broker):
+    received = []
+    client = connected(broker.link, received)
+    assert client.enable_push()
+    broker.message(client, '{"user_id": 5, "cmd": "reboot"}')
+    count = 0
+    end = time.monotonic() + 2
+    while not count and time.monotonic() < end:
+        count = client.poll_msgs(500)
+    assert count == 1
+    assert [msg for t, msg in received] == ['{"user_id": 5, "cmd": "reboot"}']
+
+
+def test_message_pushed_during_a_request_is_delivered(broker):
+    received = []
+    client = connected(broker.link, received)
+    assert client.enable_push()
+    broker.message(client, 'during publish')
+    time.sleep(0.1)
+    assert client.publish('readings', '{}')
+    assert [msg for t, msg in received] == ['during publish']
+
+
+def test_messages_wait_for_check_msg_until_pushing_is_on(broker):
+    received = []
+    client = connected(broker.link, received)
+    broker.message(client, 'kept')
+    time.sleep(0.1)
+    assert client.poll_msgs(100) == 0
+    assert broker.kept == [('downlink', 'kept')]
+    client.check_msg()
+    assert [msg for t, msg in received] == ['kept']
+
+
+def test_latency_and_bridge_traffic():
+    # broker message to callback, and uart bytes per hour with a message every 10 minutes,
+    # over a 115200 baud link with 1 ms latency each way
+    link = uart_pair.Link(baud=115200, latency_ms=1)
+    try:
+        broker = EspBroker(link)
+        assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+        received = []
+        client = connected(link, received)
+
+        def traffic():
+            return link.rp2_uart.written + link.esp_uart.written
+
+        # polling: an idle check_msg every loop, the message waits for the next one
+        start = traffic()
+        t = time.monotonic()
+        client.check_msg()
+        check_ms = (time.monotonic() - t) * 1000
+        check_bytes = traffic() - start
+        broker.message(client, 'x' * 40)
+        time.sleep(0.1)
+        start = traffic()
+        client.check_msg()
+        polled_message_bytes = traffic() - start - check_bytes
+        polling = {'latency_ms': LOOP_PERIOD_MAX * 1000 / 2 + check_ms,
+                   'bytes_per_hour': 3600 / LOOP_PERIOD_MAX * check_bytes + 6 * polled_message_bytes}
+
+        # pushing: bytes only move when a message arrives
+        assert client.enable_push()
+        latencies = []
+        start = traffic()
+        for i in range(5):
+            received.clear()
+            t = time.monotonic()
+            broker.message(client, 'x' * 40)
+            while not received:
+                client.poll_msgs(1000)
+            latencies.append((received[0][0] - t) * 1000)
+        pushing = {'latency_ms': sum(latencies) / len(latencies),
+                   'bytes_per_hour': 6 * (traffic() - start) / 5}
+    finally:
+        link.close()
+
+    for name, result in (('check_msg', polling), ('pushed', pushing)):
+        print(f'{name:>9}: {result["latency_ms"]:7.1f} ms to the callback, {result["bytes_per_hour"]:7.0f} uart bytes per hour')
+    assert pushing['latency_ms'] < polling['latency_ms'] / 10
+    assert pushing['bytes_per_hour'] < polling['bytes_per_hour'] / 10
@@ -0,0 +1,101 @@
+# user-005: the gateway's bounded reading queue keeps readings in order, counts what it
+# drops and only lets go of readings once they are published
+import random
+
+import pytest
+
+import reading_queue
+from reading_queue import ReadingQueue, DROP_NEWEST, DROP_OLDEST
+
+
+class Clock():
+    def __init__(self):
+        self.ms = 0
+
+    def __call__(self):
+        return self.ms
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(reading_queue, 'ticks_ms', clock)
+    return clock
+
+
+def test_items_come_out_oldest_first(clock):
+    queue = ReadingQueue(10)
+    for i in range(5):
+        assert queue.put(i)
+    assert queue.peek(3) == [0, 1, 2]
+    queue.pop(2)
+    assert queue.peek() == [2, 3, 4]
+    assert queue.stats() == {'queued': 3, 'received': 5, 'dropped': 0, 'published': 2}
+
+
+@pytest.mark.parametrize('policy, kept', [(DROP_OLDEST, [2, 3, 4]), (DROP_NEWEST, [0, 1, 2])])
+def test_drop_policy(clock, policy, kept):
+    queue = ReadingQueue(3, drop_policy=policy)
+    results = [queue.put(i) for i in range(5)]
+    assert queue.peek() == kept
+    assert queue.dropped == 2
+    assert results == ([True] * 5 if policy == DROP_OLDEST else [True, True, True, False, False])
+
+
+def test_failed_publishes_stay_queued_in_order(clock):
+    queue = ReadingQueue(10)
+    for i in range(6):
+        queue.put(i)
+    queue.pop_published([True, False, True, False])
+    assert queue.peek() == [1, 3, 4, 5]
+    assert queue.published == 2
+
+
+def test_oldest_age(clock):
+    queue = ReadingQueue(10)
+    assert queue.oldest_age_ms() == 0
+    queue.put('a')
+    clock.ms += 1500
+    queue.put('b')
+    assert queue.oldest_age_ms() == 1500
+    queue.pop()
+    assert queue.oldest_age_ms() == 0
+
+
+def simulate(clock, nodes, period_ms, duration_ms, fail_rate, batch_len=10, maxlen=50, seed=1):
+    # nodes report every period_ms with some jitter, the gateway drains the queue in batches
+    # every 200 ms and the broker fails a share of the publishes
+    rng = random.Random(seed)
+    queue = ReadingQueue(maxlen)
+    next_report = [rng.randrange(period_ms) for _ in range(nodes)]
+    latencies = []
+    while clock.ms < duration_ms:
+        for node in range(nodes):
+            if clock.ms >= next_report[node]:
+                queue.put(clock.ms)
+                next_report[node] += period_ms + rng.randrange(-period_ms // 10, period_ms // 10)
+        while len(queue):
+            batch = queue.peek(batch_len)
+            status_list = [rng.random() >= fail_rate for _ in batch]
+            latencies += [clock.ms - sent for sent, status in zip(batch, status_list) if status]
+            queue.pop_published(status_list)
+            if False in status_list:
+                break   # the gateway backs off until the next pass
+        clock.ms += 200
+    return queue, latencies
+
+
+def test_simulated_nodes_lose_nothing_within_capacity(clock):
+    queue, latencies = simulate(clock, nodes=20, period_ms=10000, duration_ms=600000, fail_rate=0.2)
+    assert queue.dropped == 0
+    assert queue.published + len(queue) == queue.received
+    print(f'20 nodes every 10 s, 20% failed publishes: {queue.received} readings, '
+          f'{queue.dropped} dropped, latency avg {sum(latencies) / len(latencies):.0f} ms max {max(latencies)} ms')
+
+
+def test_simulated_broker_outage_drops_the_oldest(clock):
+    queue, latencies = simulate(clock, nodes=20, period_ms=10000, duration_ms=120000, fail_rate=1.0)
+    assert queue.published == 0
+    assert len(queue) == queue.maxlen
+    assert queue.dropped == queue.received - queue.maxlen
+    assert queue.peek() == sorted(queue.peek())
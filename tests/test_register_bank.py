@@ -0,0 +1,147 @@
+# user-024: registers of one type are kept in arrays of consecutive addresses instead of a
+# dict per register. Checked against a plain dict reference and on the wire through Modbus
+import random
+import struct
+import time
+import tracemalloc
+
+import pytest
+
+from umodbus import functions
+from umodbus.common import Request
+from umodbus.modbus import Modbus
+from umodbus.register_bank import RegisterBank
+
+
+class Interface():
+    # stands in for the serial interface, keeping the response PDUs
+    def __init__(self):
+        self.out = []
+        self.request = None
+
+    def get_request(self, unit_addr_list, timeout):
+        request, self.request = self.request, None
+        return request
+
+    def send_response(self, slave_addr, function_code, addr, qty, data, values=None, signed=True):
+        self.out.append(functions.response(function_code, addr, qty, data, values, signed))
+
+    def send_exception_response(self, slave_addr, function_code, exception_code):
+        self.out.append(bytes((function_code | 0x80, exception_code)))
+
+
+def request(modbus, pdu):
+    modbus._itf.request = Request(interface=modbus._itf, data=bytes([1]) + pdu)
+    modbus.process()
+    return modbus._itf.out.pop()
+
+
+def test_blocks_merge_and_split():
+    bank = RegisterBank()
+    bank.set(10, [1, 2, 3])
+    bank.set(14, 5)
+    assert len(bank._blocks) == 2
+    bank.set(13, 4)     # joins both blocks
+    assert bank._blocks == [[10, bank._blocks[0][1]]] and list(bank._blocks[0][1]) == [1, 2, 3, 4, 5]
+    bank.set(9, 0)
+    assert bank.addresses() == list(range(9, 15))
+    assert bank.remove(12) == 3
+    assert bank.addresses() == [9, 10, 11, 13, 14]
+    assert len(bank._blocks) == 2
+    assert bank.remove(12) is None
+    assert 12 not in bank and 13 in bank
+    with pytest.raises(KeyError):
+        bank.get(12)
+
+
+def test_gaps_read_as_zero_or_false():
+    bank = RegisterBank()
+    bank.set(0, [7, 8])
+    bank.set(4, 9)
+    assert bank.read(0, 6) == [7, 8, 0, 0, 9, 0]
+    coils = RegisterBank(bits=True)
+    coils.set(1, [True, 3, 0])
+    assert coils.read(0, 5) == [False, True, True, False, False]
+    assert coils.get(2) is True
+
+
+def test_signed_values():
+    bank = RegisterBank()
+    bank.set(0, [1, -2, 3])
+    assert bank.get(1) == -2
+    assert bank.read(0, 3) == [1, -2, 3]
+    assert bank.read(0, 3, raw=True) == [1, 0xFFFE, 3]
+    bank.set(1, 0xFFFE)     # set unsigned, reads back unsigned
+    assert bank.get(1) == 0xFFFE
+    bank.set(1, -1)
+    assert bank.remove(1) == -1
+    bank.set(1, 0xFFFF)
+    assert bank.get(1) == 0xFFFF
+
+
+def test_matches_dict_reference():
+    rnd = random.Random(5)
+    bank = RegisterBank()
+    reference = {}
+    for _ in range(2000):
+        address = rnd.randrange(64)
+        op = rnd.randrange(4)
+        if op == 0:
+            values = [rnd.randrange(-0x8000, 0x10000) for _ in range(rnd.randrange(1, 8))]
+            bank.set(address, values)
+            reference.update((address + idx, val) for idx, val in enumerate(values))
+        elif op == 1:
+            assert bank.remove(address) == reference.pop(address, None)
+        else:
+            quantity = rnd.randrange(1, 16)
+            assert bank.read(address, quantity) == [reference.get(a, 0) for a in range(address, address + quantity)]
+    assert bank.addresses() == sorted(reference)
+
+
+def test_wire_responses():
+    modbus = Modbus(Interface(), [1])
+    modbus.add_hreg(10, [1, -2, 3])
+    modbus.add_coil(0, [True, False, True])
+    modbus.add_ireg(50, 7)
+    assert request(modbus, struct.pack('>BHH', 3, 10, 3)) == b'\x03\x06\x00\x01\xff\xfe\x00\x03'
+    assert request(modbus, struct.pack('>BHH', 3, 12, 2)) == b'\x03\x04\x00\x03\x00\x00'
+    assert request(modbus, struct.pack('>BHH', 1, 0, 3)) == b'\x01\x01\x05'
+    assert request(modbus, struct.pack('>BHH', 4, 50, 1)) == b'\x04\x02\x00\x07'
+    assert request(modbus, struct.pack('>BHH', 3, 20, 1)) == b'\x83\x02'
+    assert request(modbus, struct.pack('>BHH', 6, 11, 500)) == b'\x06\x00\x0b\x01\xf4'
+    assert modbus.get_hreg(11) == 500
+    assert request(modbus, struct.pack('>BHHB3H', 16, 10, 3, 6, 4, 5, 6)) == b'\x10\x00\x0a\x00\x03'
+    assert [modbus.get_hreg(address) for address in (10, 11, 12)] == [4, 5, 6]
+    assert request(modbus, struct.pack('>BHH', 5, 1, 0xFF00)) == b'\x05\x00\x01\xff\x00'
+    assert [modbus.get_coil(address) for address in (0, 1, 2)] == [True, True, True]
+
+
+def test_callbacks_see_signed_values():
+    seen = []
+    modbus = Modbus(Interface(), [1])
+    modbus.add_hreg(200, -9,
+                    on_set_cb=lambda **kwargs: seen.append(('set', kwargs['address'], kwargs['val'])),
+                    on_get_cb=lambda **kwargs: seen.append(('get', kwargs['address'], list(kwargs['val']))))
+    assert request(modbus, struct.pack('>BHH', 3, 200, 1)) == b'\x03\x02\xff\xf7'
+    request(modbus, struct.pack('>BHH', 6, 200, 7))
+    assert seen[0] == ('get', 200, [-9])
+    assert seen[1][:2] == ('set', 200)
+
+
+def test_memory_and_read_time():
+    modbus = Modbus(Interface(), [1])
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for address in range(1000):
+        modbus.add_hreg(address, address)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert used < 4000     # a dict per register took over 200 kB
+
+    pdu = struct.pack('>BHH', 3, 100, 125)
+    rounds = 2000
+    t = time.perf_counter()
+    for _ in range(rounds):
+        request(modbus, pdu)
+    read_us = (time.perf_counter() - t) * 1e6 / rounds
+    print(f'1000 holding registers: {used} bytes, 125 register read in {read_us:.1f} us')
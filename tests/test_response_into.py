@@ -0,0 +1,201 @@
+# user-025: response_into builds Modbus responses in place, byte for byte the same as the
+# response() they replaced, and bytes_to_bool/to_short give the same values as before
+import random
+import struct
+import time
+import tracemalloc
+
+import pytest
+
+from crc16 import crc16, crc16_bytes
+from umodbus import const as Const
+from umodbus import functions
+from umodbus import serial
+
+
+def old_response(function_code, request_register_addr, request_register_qty, request_data,
+                 value_list=None, signed=True):
+    # functions.response before user-025
+    if function_code in [Const.READ_COILS, Const.READ_DISCRETE_INPUTS]:
+        sectioned_list = [value_list[i:i + 8] for i in range(0, len(value_list), 8)]
+
+        output_value = []
+        for index, byte in enumerate(sectioned_list):
+            output = 0
+            for bit in byte:
+                output = (output << 1) | bit
+            output_value.append(output)
+
+        fmt = 'B' * len(output_value)
+        return struct.pack('>BB' + fmt, function_code, ((len(value_list) - 1) // 8) + 1, *output_value)
+
+    elif function_code in [Const.READ_HOLDING_REGISTERS, Const.READ_INPUT_REGISTER]:
+        quantity = len(value_list)
+
+        if not (0x0001 <= quantity <= 0x007D):
+            raise ValueError('invalid number of registers')
+
+        if signed is True or signed is False:
+            fmt = ('h' if signed else 'H') * quantity
+        else:
+            fmt = ''
+            for s in signed:
+                fmt += 'h' if s else 'H'
+
+        return struct.pack('>BB' + fmt, function_code, quantity * 2, *value_list)
+
+    elif function_code in [Const.WRITE_SINGLE_COIL, Const.WRITE_SINGLE_REGISTER]:
+        return struct.pack('>BHBB', function_code, request_register_addr, *request_data)
+
+    elif function_code in [Const.WRITE_MULTIPLE_COILS, Const.WRITE_MULTIPLE_REGISTERS]:
+        return struct.pack('>BHH', function_code, request_register_addr, request_register_qty)
+
+
+def old_bytes_to_bool(byte_list, bit_qty=1):
+    bool_list = []
+    for index, byte in enumerate(byte_list):
+        this_qty = bit_qty
+        if this_qty >= 8:
+            this_qty = 8
+        fmt = '{:0' + str(this_qty) + 'b}'
+        bool_list.extend([bool(int(x)) for x in fmt.format(byte)])
+        bit_qty -= 8
+    return bool_list
+
+
+def old_to_short(byte_array, signed=True):
+    if len(byte_array) == 1:
+        return int.from_bytes(byte_array, 'big')
+    response_quantity = int(len(byte_array) / 2)
+    fmt = '>' + (('h' if signed else 'H') * response_quantity)
+    return struct.unpack(fmt, byte_array)
+
+
+def into(offset, *args, **kwargs):
+    buffer = bytearray(b'\xee' * (offset + Const.MAX_PDU_LENGTH + 4))
+    length = functions.response_into(buffer, offset, *args, **kwargs)
+    # nothing written before the offset or after the PDU
+    assert buffer[:offset] == b'\xee' * offset
+    assert set(buffer[offset + length:]) <= {0xee}
+    return bytes(buffer[offset:offset + length])
+
+
+@pytest.mark.parametrize('function_code', [Const.READ_COILS, Const.READ_DISCRETE_INPUTS])
+@pytest.mark.parametrize('quantity', [1, 3, 7, 8, 9, 15, 16, 17, 79, 1001, 1999, 2000])
+def test_coils_match_the_old_response(function_code, quantity):
+    rnd = random.Random(quantity)
+    values = [rnd.random() < 0.5 for _ in range(quantity)]
+    expected = old_response(function_code, 0, quantity, [], values)
+    assert into(1, function_code, 0, quantity, [], values) == expected
+    assert functions.response(function_code, 0, quantity, [], values) == expected
+
+
+@pytest.mark.parametrize('function_code', [Const.READ_HOLDING_REGISTERS, Const.READ_INPUT_REGISTER])
+@pytest.mark.parametrize('quantity', [1, 2, 10, 64, 125])
+def test_registers_match_the_old_response(function_code, quantity):
+    rnd = random.Random(quantity)
+    signed_values = [rnd.randrange(-0x8000, 0x8000) for _ in range(quantity)]
+    unsigned_values = [rnd.randrange(0x10000) for _ in range(quantity)]
+    mixed = [i % 3 == 0 for i in range(quantity)]
+    mixed_values = [s if m else u for s, u, m in zip(signed_values, unsigned_values, mixed)]
+    for values, signed in ((signed_values, True), (unsigned_values, False), (mixed_values, mixed)):
+        expected = old_response(function_code, 0, quantity, [], values, signed)
+        assert into(1, function_code, 0, quantity, [], values, signed=signed) == expected
+        assert functions.response(function_code, 0, quantity, [], values, signed) == expected
+
+
+@pytest.mark.parametrize('quantity', [0, 126])
+def test_register_count_limits(quantity):
+    with pytest.raises(ValueError):
+        into(1, Const.READ_HOLDING_REGISTERS, 0, quantity, [], [1] * quantity)
+
+
+@pytest.mark.parametrize('signed', [True, False])
+def test_out_of_range_register_raises_like_before(signed):
+    value = 0x8000 if signed else -1
+    with pytest.raises(struct.error):
+        old_response(Const.READ_HOLDING_REGISTERS, 0, 1, [], [value], signed)
+    with pytest.raises(struct.error):
+        into(1, Const.READ_HOLDING_REGISTERS, 0, 1, [], [value], signed=signed)
+
+
+@pytest.mark.parametrize('function_code, request_data', [
+    (Const.WRITE_SINGLE_COIL, [0xff, 0x00]),
+    (Const.WRITE_SINGLE_REGISTER, [0x12, 0x34]),
+    (Const.WRITE_MULTIPLE_COILS, []),
+    (Const.WRITE_MULTIPLE_REGISTERS, []),
+])
+def test_write_responses_match(function_code, request_data):
+    expected = old_response(function_code, 0x1234, 10, request_data)
+    assert into(3, function_code, 0x1234, 10, request_data) == expected
+
+
+def test_unknown_function_has_no_response():
+    assert into(1, 0x2b, 0, 0, []) == b''
+    assert functions.response(0x2b, 0, 0, []) is None
+
+
+def test_bytes_to_bool_matches_for_every_byte_and_count():
+    for byte in range(256):
+        for bit_qty in range(9):
+            data = bytes((byte,))
+            assert functions.bytes_to_bool(data, bit_qty) == old_bytes_to_bool(data, bit_qty)
+    data = bytes(random.Random(3).randrange(256) for _ in range(250))
+    for bit_qty in (1, 9, 13, 100, 1999, 2000):
+        # as a coil response holds them, one byte per started group of 8
+        n = (bit_qty + 7) // 8
+        assert functions.bytes_to_bool(data[:n], bit_qty) == old_bytes_to_bool(data[:n], bit_qty)
+
+
+@pytest.mark.parametrize('length', [1, 2, 6, 250])
+@pytest.mark.parametrize('signed', [True, False])
+def test_to_short_matches(length, signed):
+    data = bytes(random.Random(length).randrange(256) for _ in range(length))
+    assert functions.to_short(data, signed) == old_to_short(data, signed)
+
+
+class CaptureUart():
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(bytes(data))
+
+
+@pytest.mark.parametrize('quantity', [5, 13])
+def test_serial_sends_the_same_frame(quantity):
+    itf = serial.Serial(baudrate=115200, pins=(0, 1))
+    itf._uart = CaptureUart()
+    values = [i % 3 == 0 for i in range(quantity)]
+    itf.send_response(7, Const.READ_COILS, 0, quantity, [], values)
+    pdu = old_response(Const.READ_COILS, 0, quantity, [], values)
+    frame = bytes((7,)) + pdu
+    assert itf._uart.frames == [frame + crc16_bytes(crc16(frame))]
+
+
+def measure(f, n):
+    t = time.perf_counter()
+    for _ in range(n):
+        f()
+    us = (time.perf_counter() - t) / n * 1e6
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return us, peak
+
+
+def test_allocation_and_speed():
+    buffer = bytearray(Const.MAX_PDU_LENGTH)
+    coils = [i % 5 == 0 for i in range(2000)]
+    registers = list(range(125))
+    results = []
+    for name, function_code, values in (('2000 coils', Const.READ_COILS, coils),
+                                        ('125 registers', Const.READ_HOLDING_REGISTERS, registers)):
+        old_us, old_peak = measure(lambda: old_response(function_code, 0, len(values), [], values), 200)
+        new_us, new_peak = measure(lambda: functions.response_into(buffer, 0, function_code, 0,
+                                                                   len(values), [], values), 200)
+        assert new_peak < old_peak
+        results.append(f'{name}: {old_us:.1f} us, {old_peak} B peak before, '
+                       f'{new_us:.1f} us, {new_peak} B peak into the buffer')
+    print('; '.join(results))
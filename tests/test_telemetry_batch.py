@@ -0,0 +1,180 @@
+# user-018: batch frames carry ages and zigzag varint deltas behind one presence mask,
+# TelemetryBatch keeps its readings in flash across resets, and batching saves airtime
+import struct
+
+import pytest
+
+import ulora
+
+
+def reading(count, **changes):
+    values = {
+        'count': count,
+        'DHT_TEMPERATURE': 24.3,
+        'DHT_HUMIDITY': 61.2,
+        'SOIL_MOISTURE': 43.1,
+        'TDS': 310.42,
+    }
+    values.update(changes)
+    return values
+
+
+@pytest.fixture
+def batch_file(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    return 'batch.bin'
+
+
+@pytest.mark.parametrize('value', [0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 0xffffffff])
+def test_varint_round_trip(value):
+    buf = bytearray()
+    ulora._put_varint(buf, value)
+    assert len(buf) == max(1, (value.bit_length() + 6) // 7)
+    assert ulora._get_varint(buf + b'\xff', 0) == (value, len(buf))
+
+
+def test_layout_of_a_two_reading_batch():
+    readings = [(100, reading(1)), (160, reading(2, DHT_TEMPERATURE=24.1, TDS=310.45))]
+    frame = ulora.encode_telemetry_batch(readings, now=165)
+    first = ulora.encode_telemetry(readings[0][1])
+
+    assert frame[0] == ulora.TELEMETRY_SCHEMA_COMBINED | ulora.TELEMETRY_BATCH
+    assert frame[1:3] == first[1:3]     # the mask of the single frame, shared by both readings
+    assert frame[3] == 2
+    assert frame[4] == 5                # newest reading is 5 s old
+    assert frame[5:5 + len(first) - 3] == first[3:]
+    # 60 s gap, then count +1, temperature -0.2, humidity, moisture unchanged, tds +0.03
+    assert frame[5 + len(first) - 3:] == bytes((60, 2, 39, 0, 0, 6))
+
+
+def test_negative_deltas_stay_one_byte():
+    readings = [(60 * i, reading(i, DHT_TEMPERATURE=round(24.3 - 0.01 * i, 2),
+                                 SOIL_MOISTURE=round(43.1 - 0.3 * i, 2))) for i in range(8)]
+    frame = ulora.encode_telemetry_batch(readings, now=60 * 8)
+    first = len(ulora.encode_telemetry(readings[0][1])) - 3
+    assert len(frame) == 5 + first + 7 * (1 + 5)
+    assert [values for age, values in ulora.decode_telemetry_batch(frame)] == [values for t, values in readings]
+
+
+def test_large_deltas_take_more_bytes():
+    readings = [(0, reading(0, TDS=0.0)), (3600, reading(1, TDS=5000.0))]
+    frame = ulora.encode_telemetry_batch(readings, now=3600)
+    decoded = ulora.decode_telemetry_batch(frame)
+    assert decoded[1][1]['TDS'] == 5000.0
+    assert [age for age, values in decoded] == [3600, 0]
+
+
+def test_only_fields_in_the_mask_are_sent():
+    readings = [(60 * i, {'count': i, 'SOIL_MOISTURE': 40.0 + i}) for i in range(4)]
+    frame = ulora.encode_telemetry_batch(readings, now=180)
+    assert struct.unpack_from('>H', frame, 1)[0] == 0b1000001
+    assert [values for age, values in ulora.decode_telemetry_batch(frame)] == [values for t, values in readings]
+
+
+def test_readings_with_different_fields_raise():
+    readings = [(0, reading(0)), (60, reading(1, TDS=None))]
+    readings[1][1].pop('TDS')
+    with pytest.raises(ValueError):
+        ulora.encode_telemetry_batch(readings, now=60)
+
+
+@pytest.mark.parametrize('count', [0, 256])
+def test_batch_count_limits(count):
+    with pytest.raises(ValueError):
+        ulora.encode_telemetry_batch([(i, reading(i)) for i in range(count)], now=count)
+
+
+def test_clock_stepping_back_gives_zero_gaps():
+    readings = [(500, reading(0)), (400, reading(1))]
+    decoded = ulora.decode_telemetry_batch(ulora.encode_telemetry_batch(readings, now=300))
+    assert [age for age, values in decoded] == [0, 0]
+
+
+def test_batch_and_single_frames_are_told_apart():
+    single = ulora.encode_telemetry(reading(0))
+    batch = ulora.encode_telemetry_batch([(0, reading(0))], now=0)
+    assert ulora.is_telemetry_frame(single) and not ulora.is_telemetry_batch(single)
+    assert ulora.is_telemetry_batch(batch) and not ulora.is_telemetry_frame(batch)
+    assert not ulora.is_telemetry_batch(b'{"c"')
+    assert not ulora.is_telemetry_batch(bytes((0x80 | 0x7f, 0, 1, 1)))    # unknown schema
+
+
+def test_gateway_gets_one_record_per_reading():
+    # on_recv in receive_lora_mqtt.py publishes each decoded reading with its age added
+    readings = [(1000 + 60 * i, reading(i)) for i in range(4)]
+    push_list = []
+    for age, push_dict in ulora.decode_telemetry_batch(ulora.encode_telemetry_batch(readings, now=1200)):
+        push_dict['age'] = age
+        push_list.append(push_dict)
+    assert [push_dict['count'] for push_dict in push_list] == [0, 1, 2, 3]
+    assert [push_dict['age'] for push_dict in push_list] == [200, 140, 80, 20]
+
+
+def test_readings_survive_a_reset(batch_file):
+    batch = ulora.TelemetryBatch(4, file_name=batch_file)
+    for i in range(3):
+        batch.add(60 * i, reading(i))
+    assert not batch.full()
+
+    batch = ulora.TelemetryBatch(4, file_name=batch_file)
+    assert batch.readings == [(60 * i, reading(i)) for i in range(3)]
+    batch.add(180, reading(3))
+    assert batch.full()
+
+
+def test_record_cut_short_by_a_reset_is_dropped(batch_file):
+    batch = ulora.TelemetryBatch(4, file_name=batch_file)
+    for i in range(3):
+        batch.add(60 * i, reading(i))
+    with open(batch_file, 'rb') as f:
+        data = f.read()
+    for cut in (1, 5, 9):
+        with open(batch_file, 'wb') as f:
+            f.write(data[:-cut])
+        assert [t for t, values in ulora.TelemetryBatch(4, file_name=batch_file).readings] == [0, 60]
+
+
+def test_max_len_drops_the_oldest(batch_file):
+    batch = ulora.TelemetryBatch(2, file_name=batch_file, max_len=3)
+    for i in range(5):
+        batch.add(60 * i, reading(i))
+    assert [t for t, values in batch.readings] == [120, 180, 240]
+    assert [t for t, values in ulora.TelemetryBatch(2, file_name=batch_file).readings] == [120, 180, 240]
+
+
+def test_sent_rewrites_the_file(batch_file):
+    batch = ulora.TelemetryBatch(4, file_name=batch_file)
+    for i in range(4):
+        batch.add(60 * i, reading(i))
+    (n, frame), = batch.frames(240)
+    assert n == 4
+    batch.sent(3)
+    assert ulora.TelemetryBatch(4, file_name=batch_file).readings == [(180, reading(3))]
+    batch.sent(1)
+    assert ulora.TelemetryBatch(4, file_name=batch_file).readings == []
+
+
+def test_missing_file_starts_empty(batch_file):
+    assert len(ulora.TelemetryBatch(4, file_name=batch_file)) == 0
+
+
+@pytest.mark.parametrize('modem_config', ['Bw125Cr45Sf128', 'Bw125Cr45Sf2048'])
+def test_airtime_per_reading(modem_config):
+    config = getattr(ulora.ModemConfig, modem_config)
+    readings = [(60 * i, reading(i, DHT_TEMPERATURE=24.3 + 0.1 * (i % 4), SOIL_MOISTURE=43.1 - 0.2 * i))
+                for i in range(16)]
+    single_ms = sum(ulora.time_on_air_ms(config, ulora.HEADER_LEN + len(ulora.encode_telemetry(values)))
+                    for t, values in readings)
+    results = []
+    for size in (1, 2, 4, 8, 16):
+        airtime_ms = 0
+        for i in range(0, len(readings), size):
+            frame = ulora.encode_telemetry_batch(readings[i:i + size], now=60 * (i + size))
+            # every packet waits for its ack
+            airtime_ms += ulora.time_on_air_ms(config, ulora.HEADER_LEN + len(frame))
+            airtime_ms += ulora.time_on_air_ms(config, ulora.ACK_LEN)
+        results.append((size, airtime_ms / len(readings)))
+    assert results[0][1] >= single_ms / len(readings)
+    assert all(later < earlier for (_, earlier), (_, later) in zip(results, results[1:]))
+    assert results[-1][1] < results[0][1] / 3
+    print(f'{modem_config}: ' + ', '.join(f'{size} per batch {ms:.1f} ms' for size, ms in results) + ' per reading')
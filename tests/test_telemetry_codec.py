@@ -0,0 +1,107 @@
+# user-003: binary telemetry frames decode back into the dict the json path gave, at a
+# fraction of the size, and batches of readings shrink further with their deltas
+import json
+import time
+
+import pytest
+
+import ulora
+
+
+def reading(count, **changes):
+    values = {
+        'count': count,
+        'device_id': 'COMBINED',
+        'AMBIENT_LIGHT': 412.5,
+        'DHT_TEMPERATURE': 24.3,
+        'DHT_HUMIDITY': 61.2,
+        'SOIL_TEMPERATURE': 21.75,
+        'SOIL_MOISTURE': 43.1,
+        'TDS': 310.42,
+        'Nitrogen': 37,
+        'Phosphorus': 12,
+        'Potassium': 58,
+        'user_id': 1042,
+        'project_id': 7,
+    }
+    values.update(changes)
+    return values
+
+
+def json_frame(values):
+    return json.dumps(ulora.conex_dict(values, ulora.con_dict)).encode()
+
+
+def test_round_trip_matches_the_json_path():
+    values = reading(5)
+    frame = ulora.encode_telemetry(values)
+    assert ulora.is_telemetry_frame(frame)
+    assert ulora.decode_telemetry(frame) == ulora.conex_dict(json.loads(json_frame(values)), ulora.ex_dict)
+
+
+def test_negative_and_partial_readings_round_trip():
+    values = {'count': 9, 'device_id': 'COMBINED', 'DHT_TEMPERATURE': -4.25}
+    assert ulora.decode_telemetry(ulora.encode_telemetry(values)) == values
+
+
+@pytest.mark.parametrize('values', [
+    {'count': 1, 'unknown': 3},
+    {'count': 1, 'DHT_TEMPERATURE': 400.0},
+    {'count': -1},
+])
+def test_values_outside_the_schema_raise(values):
+    with pytest.raises(ValueError):
+        ulora.encode_telemetry(values)
+
+
+def test_binary_frame_is_several_times_smaller():
+    values = reading(5)
+    binary, text = len(ulora.encode_telemetry(values)), len(json_frame(values))
+    assert binary == 36
+    assert text > 4 * binary
+    print(f'combined reading: {binary} B binary, {text} B json')
+
+
+def test_encode_decode_speed():
+    values = reading(5)
+    frame = ulora.encode_telemetry(values)
+    n = 2000
+    t = time.perf_counter()
+    for _ in range(n):
+        ulora.decode_telemetry(ulora.encode_telemetry(values))
+    binary_us = (time.perf_counter() - t) / n * 1e6
+    t = time.perf_counter()
+    for _ in range(n):
+        ulora.conex_dict(json.loads(json_frame(values)), ulora.ex_dict)
+    json_us = (time.perf_counter() - t) / n * 1e6
+    assert ulora.decode_telemetry(frame)['count'] == 5
+    print(f'round trip on CPython: binary {binary_us:.1f} us, json {json_us:.1f} us')
+
+
+def test_batch_round_trip_keeps_values_and_ages():
+    readings = [(1000 + 60 * i, reading(i, DHT_TEMPERATURE=24.3 - 0.25 * i, TDS=310.42 + i)) for i in range(6)]
+    frame = ulora.encode_telemetry_batch(readings, now=1000 + 60 * 5 + 2)
+    assert ulora.is_telemetry_batch(frame)
+    decoded = ulora.decode_telemetry_batch(frame)
+    assert [values for age, values in decoded] == [values for t, values in readings]
+    assert [age for age, values in decoded] == [302, 242, 182, 122, 62, 2]
+
+
+@pytest.mark.parametrize('count', [2, 4, 8])
+def test_batch_sizes(count):
+    readings = [(60 * i, reading(i, SOIL_MOISTURE=43.1 + 0.1 * (i % 3))) for i in range(count)]
+    batch = len(ulora.encode_telemetry_batch(readings, now=60 * count))
+    single = sum(len(ulora.encode_telemetry(values)) + ulora.HEADER_LEN for t, values in readings)
+    assert batch + ulora.HEADER_LEN <= single
+    print(f'{count} readings: {batch + ulora.HEADER_LEN} B batched, {single} B as single frames')
+
+
+def test_too_many_readings_are_split_into_packets(tmp_path):
+    batch = ulora.TelemetryBatch(200, file_name=str(tmp_path / 'batch.bin'))
+    for i in range(200):
+        # values that change a lot keep the deltas long
+        batch.add(60 * i, reading(i, TDS=float(i * 997 % 5000), AMBIENT_LIGHT=float(i * 613 % 600)))
+    frames = batch.frames(60 * 200)
+    assert len(frames) > 1
+    assert sum(n for n, frame in frames) == 200
+    assert all(len(frame) <= ulora.TELEMETRY_MAX_LEN for n, frame in frames)
@@ -0,0 +1,69 @@
+# user-004: airtime from the modem config registers against the published SX127x figures,
+# and the duty cycle budget deferring and rejecting sends
+import time
+
+import pytest
+
+import ulora
+from fake_radio import FakeRadio
+
+
+@pytest.mark.parametrize('modem_config, payload_len, airtime_ms', [
+    # 8 symbol preamble, explicit header, CRC on. The SF7 rows are the figures of the
+    # Semtech LoRa calculator, the others worked by hand from the SX1276 datasheet formula
+    (ulora.ModemConfig.Bw125Cr45Sf128, 10, 41.22),
+    (ulora.ModemConfig.Bw125Cr45Sf128, 51, 102.66),
+    (ulora.ModemConfig.Bw500Cr45Sf128, 10, 10.30),
+    (ulora.ModemConfig.Bw125Cr45Sf2048, 10, 495.62),
+    (ulora.ModemConfig.Bw125Cr48Sf4096, 10, 1187.84),
+])
+def test_time_on_air(modem_config, payload_len, airtime_ms):
+    assert ulora.time_on_air_ms(modem_config, payload_len) == pytest.approx(airtime_ms, abs=0.01)
+
+
+def test_modem_params_are_read_from_the_registers():
+    assert ulora.modem_params(ulora.ModemConfig.Bw125Cr45Sf128) == (7, 125000, 5, True, False, False)
+    assert ulora.modem_params(ulora.ModemConfig.Bw125Cr48Sf4096) == (12, 125000, 8, True, False, True)
+
+
+class Clock():
+    def __init__(self):
+        self.ms = 0
+
+    def __call__(self):
+        return self.ms
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'ticks_ms', clock)
+    return clock
+
+
+def test_duty_cycle_defers_until_old_sends_leave_the_window(clock):
+    duty_cycle = ulora.DutyCycle(budget=0.01, window_s=100)    # 1000 ms of airtime per 100 s
+    for _ in range(9):
+        assert duty_cycle.wait_ms(100) == 0
+        duty_cycle.record(100)
+        clock.ms += 1000
+    duty_cycle.record(100)
+    assert duty_cycle.used_ms() == 1000
+    # the first send leaves the window 100 s after it was made
+    assert duty_cycle.wait_ms(100) == 100000 - clock.ms
+    clock.ms = 100000
+    assert duty_cycle.wait_ms(100) == 0
+
+
+def test_duty_cycle_rejects_a_send_longer_than_the_budget(clock):
+    assert ulora.DutyCycle(budget=0.001, window_s=10).wait_ms(20) == -1
+
+
+def test_send_over_budget_is_rejected(clock):
+    FakeRadio()
+    lora = ulora.LoRa(ulora.SPIConfig.rp2_0, 24, 1, 5)
+    lora.wait_packet_sent = lambda: True
+    lora.duty_cycle = ulora.DutyCycle(budget=0.001, window_s=60)   # 60 ms per minute
+    assert lora.send(b'x' * 6, 2)
+    assert not lora.send(b'x' * 6, 2)
+    assert lora.duty_cycle.used_ms() == pytest.approx(ulora.time_on_air_ms(ulora.ModemConfig.Bw125Cr45Sf128, 10))
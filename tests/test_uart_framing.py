@@ -0,0 +1,302 @@
+# user-007: the rp2 and the esp agree on a frame size in negotiate_frame_size, and end up on
+# the same framing whichever part of the handshake is lost. Data is then sent in windows
+# of frames, resent from the first one lost
+import random
+import string
+import time
+
+import pytest
+
+import uart_pair
+
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def assert_link_works(link, framed):
+    assert (link.rp2.frame_size is not None) == framed
+    assert wait_until(lambda: (link.esp.frame_size is not None) == framed)
+    received = len(link.esp_loop.received)
+    link.rp2.send_data(link.rp2_uart, 'hello')
+    assert wait_until(lambda: len(link.esp_loop.received) > received)
+    assert link.esp_loop.received[-1] == ['hello', 's']
+
+
+def test_both_sides_switch(link):
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) == link.rp2.agree_frame_size(link.rp2.rx_buffer_size)[0]
+    assert wait_until(lambda: link.esp.frame_size is not None and link.esp.frame_unconfirmed_at is None)
+    assert (link.esp.frame_size, link.esp.window_size) == (link.rp2.frame_size, link.rp2.window_size)
+    assert_link_works(link, True)
+
+
+def test_lost_answer_keeps_both_sides_on_legacy_chunking(link):
+    link.esp_uart.drop = lambda data: b'frame size ' in data
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is None
+    # the esp gave up waiting for the rp2 to confirm its answer
+    assert wait_until(lambda: link.esp_loop.errors)
+    link.esp_uart.drop = None
+    assert_link_works(link, False)
+
+
+def test_lost_confirmation_of_the_answer(link):
+    # the rp2 got the answer and switched, the esp never heard so and did not
+    link.rp2_uart.drop = lambda data: b'received all' in data
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is None
+    link.rp2_uart.drop = None
+    assert wait_until(lambda: link.esp_loop.errors)
+    assert_link_works(link, False)
+
+
+def test_esp_falls_back_when_the_rp2_never_confirms(link, monkeypatch):
+    # the esp switched, but the first frame from the rp2 is lost every time
+    monkeypatch.setattr(link.esp, 'FRAME_CONFIRM_MS', 300)
+    link.rp2_uart.drop = lambda data: data[0] == link.rp2.FRAME_SYNC
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is None
+    link.rp2_uart.drop = None
+    assert_link_works(link, False)
+
+
+def test_renegotiates_after_falling_back(link):
+    link.esp_uart.drop = lambda data: b'frame size ' in data
+    link.serve()
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is None
+    assert wait_until(lambda: link.esp_loop.errors)
+    link.esp_uart.drop = None
+    assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+    assert_link_works(link, True)
+
+
+def text(size, seed=0):
+    rnd = random.Random(seed)
+    return ''.join(rnd.choice(string.ascii_letters + string.digits + ' ,.:{}"') for _ in range(size))
+
+
+def use_frames(link):
+    for module in (link.rp2, link.esp):
+        uart_pair.set_frame_size(module, *link.rp2.agree_frame_size(link.rp2.rx_buffer_size))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_windows_are_resent_under_loss(monkeypatch, seed):
+    # 1% of the uart writes lost: frames, acks and naks alike
+    link = uart_pair.Link(loss=0.01, seed=seed)
+    try:
+        monkeypatch.setattr(link.rp2, 'window_retries', 6)
+        use_frames(link)
+        link.serve()
+        messages = [text(2048, seed * 10 + i) for i in range(5)]
+        for message in messages:
+            assert link.rp2.send_data_framed(link.rp2_uart, message, False, 'string', link.rp2.frame_size,
+                                             timeout_ms=200) == 'received all'
+        # each message once and in order, resent end frames are not handed out again
+        assert wait_until(lambda: len(link.esp_loop.received) == len(messages))
+        assert link.esp_loop.received == [[message, 's'] for message in messages]
+    finally:
+        link.close()
+
+
+def send_time(link, size, **kwargs):
+    message = text(size, size)
+    received = len(link.esp_loop.received)
+    t = time.monotonic()
+    if kwargs:
+        link.rp2.send_data_framed(link.rp2_uart, message, False, 'string', link.rp2.frame_size, **kwargs)
+    else:
+        assert link.rp2.send_data(link.rp2_uart, message) == 'send success'
+    elapsed = time.monotonic() - t
+    assert wait_until(lambda: len(link.esp_loop.received) > received)
+    assert link.esp_loop.received[-1] == [message, 's']
+    return elapsed
+
+
+def test_throughput(monkeypatch):
+    # bytes/s over a 115200 baud link with 1 ms latency each way, for the legacy 12 byte
+    # stop and wait chunks and for negotiated frames with and without 1% of writes lost
+    results = {}
+    link = uart_pair.Link(baud=115200, latency_ms=1)
+    try:
+        link.serve()
+        for size in (1024, 4096):
+            results['legacy', size] = size / send_time(link, size)
+        assert link.rp2.negotiate_frame_size(link.rp2_uart) is not None
+        for size in (1024, 4096, 16384):
+            results['framed', size] = size / send_time(link, size)
+    finally:
+        link.close()
+
+    link = uart_pair.Link(loss=0.01, seed=3, baud=115200, latency_ms=1)
+    try:
+        monkeypatch.setattr(link.rp2, 'window_retries', 6)
+        use_frames(link)
+        link.serve()
+        for size in (1024, 4096, 16384):
+            results['framed, 1% lost', size] = size / send_time(link, size, timeout_ms=200)
+    finally:
+        link.close()
+
+    for (mode, size), rate in results.items():
+        print(f'{mode:>16} {size // 1024:2d} KB: {rate:7.0f} B/s')
+    # 11520 B/s is all 115200 baud carries
+    assert results['framed', 16384] > 11520 / 2
+    assert results['framed', 4096] > 3 * results['legacy', 4096]
+
+
+# user-008: frames carry sync, type, sequence number, length and CRC16, and FrameParser
+# finds them in whatever pieces the uart hands out, skipping anything damaged
+
+class Wire():
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def encode(frames):
+    wire = Wire()
+    for frame_type, seq, payload in frames:
+        uart_pair.uartlib.write_frame(wire, frame_type, seq, payload)
+    return bytes(wire.data)
+
+
+def data_frames(count, seed=0):
+    rnd = random.Random(seed)
+    return [(rnd.choice(b'\x00bs'), i & 0xff, rnd.randbytes(rnd.randrange(0, 59))) for i in range(count)]
+
+
+def frame_len(frame):
+    return uart_pair.uartlib.FRAME_OVERHEAD + len(frame[2])
+
+
+def parse(data, chunks=None, max_payload=58):
+    # feeds data in pieces of the given sizes, a whole frame at most, and collects the frames
+    parser = uart_pair.uartlib.FrameParser()
+    parser.max_payload = max_payload
+    frames = []
+    pos = 0
+    chunks = iter(chunks or [])
+    while pos < len(data):
+        size = min(next(chunks, len(data)), parser.space())
+        parser.feed(data[pos:pos + size])
+        pos += size
+        frame = parser.next_frame()
+        while frame is not None:
+            frames.append((frame[0], frame[1], bytes(frame[2])))
+            frame = parser.next_frame()
+    return frames, parser
+
+
+def test_frames_split_over_reads_and_several_in_one_read():
+    frames = data_frames(50)
+    data = encode(frames)
+    rnd = random.Random(1)
+    assert parse(data)[0] == frames
+    assert parse(data, [1] * len(data))[0] == frames
+    assert parse(data, [rnd.randrange(1, 300) for _ in range(len(data))])[0] == frames
+
+
+def test_noise_is_skipped_up_to_the_next_frame():
+    frames = data_frames(3)
+    noise = bytes([0xa5, 0x00, 0xa5, 0xa5, ord('s'), 200]) + b'sESP: Readyse\r\n'
+    parsed, parser = parse(noise + encode(frames[:1]) + noise + encode(frames[1:]))
+    assert parsed == frames
+    assert parser.skipped >= 2 * len(noise)
+
+
+def test_bad_crc_is_dropped():
+    frames = data_frames(3)
+    data = bytearray(encode(frames))
+    data[frame_len(frames[0]) - 3] ^= 0x10     # last payload byte of the first frame
+    parsed, parser = parse(bytes(data))
+    assert parsed == frames[1:]
+    assert parser.crc_errors == 1
+
+
+def test_truncated_frame_is_skipped():
+    # once the bytes after it reach the length it claims, it fails the CRC
+    frames = [(0, 0, b'x' * 40)] + [(ord('s'), i, b'next one') for i in range(4)]
+    data = encode(frames)
+    parsed, parser = parse(data[:20] + data[frame_len(frames[0]):])
+    assert parsed == frames[1:]
+
+
+def test_truncated_frame_at_the_end_is_given_up_after_a_timeout(link):
+    # its length waits for bytes that never come, until read_frame times out
+    uartlib = link.rp2
+    uart_pair.set_frame_size(uartlib, 58, 4)
+    link.esp_uart.write(encode([(0, 0, b'x' * 40)])[:20])
+    assert uartlib.read_frame(link.rp2_uart, 20) is None
+    link.esp_uart.write(encode([(ord('s'), 1, b'after')]))
+    while True:
+        frame = uartlib.read_frame(link.rp2_uart, 20)
+        if frame is not None:
+            break
+    assert (frame[0], frame[1], bytes(frame[2])) == (ord('s'), 1, b'after')
+
+
+def test_length_over_the_agreed_frame_size_is_not_waited_for():
+    frames = data_frames(2)
+    header = bytes([0xa5, 0, 0, 200])
+    parsed, parser = parse(header + encode(frames))
+    assert parsed == frames
+
+
+def test_fuzz():
+    # damaged frames are never handed out and never take an intact frame with them
+    rnd = random.Random(8)
+    frames = data_frames(2000, 8)
+    data = bytearray()
+    intact = []
+    for frame in frames:
+        encoded = bytearray(encode([frame]))
+        damage = rnd.random()
+        if damage < 0.05:
+            encoded[rnd.randrange(len(encoded))] ^= 1 << rnd.randrange(8)
+        elif damage < 0.1:
+            encoded = encoded[:rnd.randrange(1, len(encoded))]
+        elif damage < 0.15:
+            encoded[0:0] = rnd.randbytes(rnd.randrange(1, 20))
+            intact.append(frame)
+        else:
+            intact.append(frame)
+        data += encoded
+    parsed, parser = parse(bytes(data), [rnd.randrange(1, 128) for _ in range(len(data))])
+    assert parsed == intact
+    print(f'{len(frames) - len(intact)} damaged frames, {parser.crc_errors} crc errors, {parser.skipped} bytes skipped')
+
+
+def test_parser_speed():
+    data = encode(data_frames(2000))
+    t = time.perf_counter()
+    parsed, parser = parse(data, [64] * len(data))
+    elapsed = time.perf_counter() - t
+    assert len(parsed) == 2000
+    print(f'{len(data) / elapsed / 1e6:.1f} MB/s parsed on CPython, 11520 B/s arrive at 115200 baud')
+
+
+def test_sequence_numbers_wrap(monkeypatch):
+    # 12 byte frames make 4 KB over 300 frames, so the 8 bit sequence number wraps mid message
+    link = uart_pair.Link(loss=0.01, seed=5)
+    try:
+        monkeypatch.setattr(link.rp2, 'window_retries', 6)
+        for module in (link.rp2, link.esp):
+            uart_pair.set_frame_size(module, 12, 4)
+        link.serve()
+        messages = [text(4096, i) for i in range(2)]
+        for message in messages:
+            link.rp2.send_data_framed(link.rp2_uart, message, False, 'string', 12, timeout_ms=200)
+        assert wait_until(lambda: len(link.esp_loop.received) == len(messages))
+        assert link.esp_loop.received == [[message, 's'] for message in messages]
+    finally:
+        link.close()
@@ -0,0 +1,212 @@
+# user-021: Serial._uart_read stops as soon as the length the request implies has arrived,
+# otherwise at the first 3.5 character silence, and waits for a response to start only as
+# long as the slave's own timeout. Timed on a simulated clock against a fake UART
+import types
+
+import pytest
+
+from crc16 import crc16, crc16_bytes
+from umodbus import const as Const
+from umodbus import functions
+from umodbus import serial
+
+
+class Clock():
+    # ticks_us, ticks_diff and sleep_us on a simulated clock
+    def __init__(self):
+        self.us = 0
+
+    def ticks_us(self):
+        return self.us
+
+    def ticks_diff(self, new, old):
+        return new - old
+
+    def sleep_us(self, us):
+        self.us += us
+
+
+class FakeUart():
+    # Bytes become readable at the time they have been clocked in. slaves maps a slave
+    # address to (delay in us before it answers, function turning the request into its response)
+    def __init__(self, clock, baudrate):
+        self.clock = clock
+        self.char_us = 11 * 1000000 / baudrate
+        self.arrivals = []  # (time the byte is readable, byte)
+        self.position = 0
+        self.slaves = {}
+
+    def feed(self, data, start_us, gaps=None):
+        # gaps maps a byte index to a pause in characters before it
+        t = start_us
+        for i, byte in enumerate(data):
+            t += self.char_us * (1 + (gaps or {}).get(i, 0))
+            self.arrivals.append((t, byte))
+        return t
+
+    def any(self):
+        n = 0
+        while self.position + n < len(self.arrivals) and self.arrivals[self.position + n][0] <= self.clock.us:
+            n += 1
+        return n
+
+    def readinto(self, buf):
+        n = min(self.any(), len(buf))
+        for i in range(n):
+            buf[i] = self.arrivals[self.position + i][1]
+        self.position += n
+        return n
+
+    def read(self):
+        n = self.any()
+        data = bytes(byte for t, byte in self.arrivals[self.position:self.position + n])
+        self.position += n
+        return data or None
+
+    def write(self, adu):
+        adu = bytes(adu)
+        self.clock.us += self.char_us * len(adu)
+        if adu[0] in self.slaves:
+            delay_us, respond = self.slaves[adu[0]]
+            self.feed(respond(adu), self.clock.us + delay_us)
+
+
+def adu(slave_addr, pdu):
+    frame = bytes((slave_addr,)) + pdu
+    return frame + crc16_bytes(crc16(frame))
+
+
+def registers_response(request):
+    quantity = int.from_bytes(request[4:6], 'big')
+    return adu(request[0], bytes((request[1], 2 * quantity)) + bytes(range(2 * quantity)))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(serial, 'time', types.SimpleNamespace(
+        ticks_us=clock.ticks_us, ticks_diff=clock.ticks_diff, sleep_us=clock.sleep_us))
+    return clock
+
+
+def make_serial(clock, baudrate=9600):
+    itf = serial.Serial(baudrate=baudrate, pins=(0, 1))
+    itf._uart = FakeUart(clock, baudrate)
+    return itf
+
+
+def test_expected_length_from_the_request():
+    itf = serial.Serial(pins=(0, 1))
+    assert itf._expected_response_len(functions.read_coils(0, 10)) == 3 + 2 + 2
+    assert itf._expected_response_len(functions.read_discrete_inputs(0, 8)) == 3 + 1 + 2
+    assert itf._expected_response_len(functions.read_holding_registers(0, 3)) == 3 + 6 + 2
+    assert itf._expected_response_len(functions.read_input_registers(0, 125)) == 3 + 250 + 2
+    assert itf._expected_response_len(functions.write_single_register(0, 1)) == Const.FIXED_RESP_LEN
+    assert itf._expected_response_len(bytes((0x2b, 0x0e, 0x01, 0x00))) is None
+
+
+def test_returns_once_the_expected_length_arrived(clock):
+    itf = make_serial(clock)
+    response = adu(1, bytes((3, 6)) + bytes(6))
+    last_us = itf._uart.feed(response + b'\x00\x00\x00', 0, gaps={len(response): 10})
+    assert itf._uart_read(expected_len=len(response)) == response
+    # no silence to wait for, only the poll interval
+    assert clock.us - (last_us - 11 * itf._uart.char_us) <= itf._t1char
+
+
+def test_short_response_ends_at_the_silence(clock):
+    itf = make_serial(clock)
+    response = adu(1, bytes((3, 6)) + bytes(4))     # 2 bytes short of what was asked for
+    last_us = itf._uart.feed(response, 0, gaps={4: 2})    # a 2 character pause inside the frame
+    assert itf._uart_read(expected_len=11) == response
+    # the silence is counted from the poll that saw the last byte
+    assert itf._inter_frame_delay < clock.us - last_us <= itf._inter_frame_delay + 2 * itf._t1char
+
+
+def test_exception_response_ends_the_read(clock):
+    itf = make_serial(clock)
+    response = adu(1, bytes((3 | Const.ERROR_BIAS, 2)))
+    last_us = itf._uart.feed(response, 0)
+    assert itf._uart_read(expected_len=11) == response
+    assert clock.us - last_us <= itf._t1char
+
+
+def test_length_from_the_header_without_expected_len(clock):
+    itf = make_serial(clock)
+    response = adu(1, bytes((3, 4)) + bytes(4))
+    last_us = itf._uart.feed(response, 0)
+    assert itf._uart_read() == response
+    assert clock.us - last_us <= itf._t1char
+
+
+def test_nothing_received_waits_for_the_timeout(clock):
+    itf = make_serial(clock)
+    assert itf._uart_read(timeout=50) == b''
+    assert 50000 < clock.us <= 50000 + itf._t1char
+
+
+def test_per_slave_response_timeout(clock):
+    itf = make_serial(clock)
+    itf._uart.slaves[1] = (30000, registers_response)
+    itf.set_response_timeout(20, slave_addr=4)
+    assert itf.read_holding_registers(1, 0, 3, signed=False) == (0x0001, 0x0203, 0x0405)
+
+    send_us = 8 * itf._uart.char_us + 100   # the request on the wire, then _send_buffer's margin
+    clock.us = 0
+    with pytest.raises(OSError):
+        itf.read_holding_registers(4, 0, 3)
+    assert 20000 < clock.us - send_us <= 20000 + itf._t1char
+
+    clock.us = 0
+    with pytest.raises(OSError):
+        itf.read_holding_registers(5, 0, 3)     # no timeout of its own, the default 1000 ms
+    assert 1000000 < clock.us - send_us <= 1000000 + itf._t1char
+
+
+def old_uart_read(itf):
+    # _uart_read before user-021: polls every 3.5 characters for up to 119 polls and only
+    # knows the response is complete from its header
+    response = bytearray()
+    for x in range(1, 120):
+        if itf._uart.any():
+            response.extend(itf._uart.read())
+            if itf._exit_read(response):
+                break
+        serial.time.sleep_us(itf._inter_frame_delay)
+    return response
+
+
+@pytest.mark.parametrize('read', ['new', 'old'])
+def test_slow_slave_is_not_cut_off(clock, read):
+    # the old loop gives up after 119 polls, 0.5 s at 9600 baud however long the slave needs
+    itf = make_serial(clock)
+    response = adu(1, bytes((3, 2, 0, 1)))
+    itf._uart.feed(response, 600000)
+    received = itf._uart_read(expected_len=len(response)) if read == 'new' else old_uart_read(itf)
+    assert (received == response) == (read == 'new')
+
+
+def test_latency_after_the_last_byte(monkeypatch):
+    # worst case over responses starting at different points of the poll interval
+    results = []
+    for baudrate in (4800, 9600, 19200, 38400, 115200):
+        latency = {'new': [], 'old': []}
+        for read in ('new', 'old'):
+            for start_us in range(5000, 9000, 200):
+                clock = Clock()
+                monkeypatch.setattr(serial, 'time', types.SimpleNamespace(
+                    ticks_us=clock.ticks_us, ticks_diff=clock.ticks_diff, sleep_us=clock.sleep_us))
+                itf = make_serial(clock, baudrate)
+                response = registers_response(adu(1, functions.read_holding_registers(0, 10)))
+                last_us = itf._uart.feed(response, start_us)
+                if read == 'new':
+                    assert itf._uart_read(expected_len=len(response)) == response
+                else:
+                    assert old_uart_read(itf) == response
+                latency[read].append(clock.us - last_us)
+        new, old = max(latency['new']), max(latency['old'])
+        assert new <= itf._t1char
+        assert new < old
+        results.append((baudrate, new, old))
+    print('worst us from the last byte to the return: ' +
+          ', '.join(f'{baudrate} baud {new:.0f} (was {old:.0f})' for baudrate, new, old in results))
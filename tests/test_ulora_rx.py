@@ -0,0 +1,108 @@
+# user-001: the irq handler only copies packets into the ring buffer, everything else runs
+# from micropython.schedule, and recv()/recv_nowait() hand the payloads out in order
+import time
+
+import machine
+import micropython
+import pytest
+
+import ulora
+from fake_radio import FakeRadio
+
+IRQ_PIN = 24
+ADDRESS = 1
+
+
+@pytest.fixture
+def radio():
+    return FakeRadio()
+
+
+def make_lora(radio, **kwargs):
+    lora = ulora.LoRa(ulora.SPIConfig.rp2_0, IRQ_PIN, ADDRESS, 5, **kwargs)
+    lora.set_mode_rx()
+    return lora
+
+
+def packet(i, header_to=ADDRESS):
+    return bytes((header_to, 2, i, 0)) + b'reading %d' % i
+
+
+def burst(radio, count):
+    irq = machine.Pin.instances[IRQ_PIN].handler
+    for i in range(count):
+        radio.receive(packet(i))
+        irq(IRQ_PIN)
+
+
+def test_payloads_come_out_in_order(radio):
+    lora = make_lora(radio)
+    burst(radio, 5)
+    assert lora.recv_nowait() is None   # nothing is handled until the scheduled call runs
+    micropython.run_scheduled()
+    messages = [lora.recv_nowait().message for _ in range(5)]
+    assert messages == [b'reading %d' % i for i in range(5)]
+    assert lora.recv_nowait() is None
+    assert lora.rx_dropped == 0
+
+
+def test_one_scheduled_call_per_burst(radio):
+    make_lora(radio)
+    burst(radio, 6)
+    assert len(micropython.pending) == 1
+    micropython.run_scheduled()
+
+
+def test_burst_beyond_the_ring_buffer_is_counted(radio):
+    lora = make_lora(radio, rx_queue_size=8)
+    burst(radio, 10)
+    micropython.run_scheduled()
+    assert lora.rx_dropped == 2
+    assert [lora.recv_nowait().message for _ in range(8)] == [b'reading %d' % i for i in range(8)]
+
+
+def test_packets_for_other_addresses_are_skipped(radio):
+    lora = make_lora(radio)
+    irq = machine.Pin.instances[IRQ_PIN].handler
+    radio.receive(packet(0, header_to=9))
+    irq(IRQ_PIN)
+    radio.receive(packet(1))
+    irq(IRQ_PIN)
+    micropython.run_scheduled()
+    assert lora.recv_nowait().message == b'reading 1'
+    assert lora.recv_nowait() is None
+
+
+def test_slow_callback_does_not_drop_rx_done(radio):
+    # the gateway's on_recv parses json and publishes, which must not hold up the irq
+    lora = make_lora(radio)
+    handled = []
+    lora.on_recv = lambda payload: (time.sleep(0.002), handled.append(payload.message))
+    irq = machine.Pin.instances[IRQ_PIN].handler
+
+    irq_us = []
+    for i in range(8):
+        radio.receive(packet(i))
+        t = time.perf_counter()
+        irq(IRQ_PIN)
+        irq_us.append((time.perf_counter() - t) * 1e6)
+    micropython.run_scheduled()
+
+    assert len(handled) == 8 and lora.rx_dropped == 0
+    print(f'irq handler {sum(irq_us) / len(irq_us):.1f} us per packet on CPython')
+
+
+def test_full_schedule_queue_does_not_stall_rx(radio, monkeypatch):
+    lora = make_lora(radio)
+    schedule = micropython.schedule
+
+    def full(f, arg):
+        raise RuntimeError('schedule queue full')
+    monkeypatch.setattr(micropython, 'schedule', full)
+    burst(radio, 1)
+    monkeypatch.setattr(micropython, 'schedule', schedule)
+    irq = machine.Pin.instances[IRQ_PIN].handler
+    radio.receive(packet(1))
+    irq(IRQ_PIN)
+    micropython.run_scheduled()
+    assert [lora.recv_nowait().message for _ in range(2)] == [b'reading 0', b'reading 1']
@@ -0,0 +1,101 @@
+# user-002: register access reuses preallocated buffers, contiguous registers are written
+# in one burst and a send puts header and payload into the FIFO in one transaction
+import machine
+import pytest
+
+import ulora
+from fake_radio import FakeRadio, REG_FIFO
+
+IRQ_PIN = 24
+
+
+@pytest.fixture
+def radio():
+    return FakeRadio()
+
+
+@pytest.fixture
+def lora(radio):
+    lora = ulora.LoRa(ulora.SPIConfig.rp2_0, IRQ_PIN, 1, 5)
+    lora.wait_packet_sent = lambda: True    # the fake radio never raises TxDone
+    return lora
+
+
+def test_burst_registers_hold_the_config(radio, lora):
+    frf = int(868.0 * 1000000.0 / ulora.FSTEP)
+    assert bytes(radio.regs[0x06:0x09]) == bytes((frf >> 16, (frf >> 8) & 0xff, frf & 0xff))
+    assert bytes(radio.regs[0x1d:0x1f]) == bytes(ulora.ModemConfig.Bw125Cr45Sf128[0:2])
+    assert radio.regs[0x26] == ulora.ModemConfig.Bw125Cr45Sf128[2]
+    assert bytes(radio.regs[0x20:0x22]) == b'\x00\x08'
+
+
+def test_send_writes_header_and_payload_in_one_transaction(radio, lora):
+    fifo_writes = []
+    transfer = radio.transfer
+
+    def logged(write_buf, read_buf=None):
+        if radio.register is None and write_buf[0] == REG_FIFO | 0x80:
+            fifo_writes.append(radio.transactions)
+        transfer(write_buf, read_buf)
+    radio.transfer = logged
+
+    radio.transactions = 0
+    lora.send(b'hello', 2, header_id=7)
+    assert bytes(radio.fifo[:9]) == bytes((2, 1, 7, 0)) + b'hello'
+    assert radio.regs[0x22] == 9
+    assert len(fifo_writes) == 1
+    print(f'{radio.transactions} spi transactions per send')
+
+
+def test_register_access_reuses_its_buffers(radio, lora):
+    buffers = set()
+    spi = lora.spi
+    write, write_readinto = spi.write, spi.write_readinto
+
+    def logged_write(buf):
+        buffers.add(id(buf))
+        write(buf)
+
+    def logged_write_readinto(write_buf, read_buf):
+        buffers.update((id(write_buf), id(read_buf)))
+        write_readinto(write_buf, read_buf)
+    spi.write, spi.write_readinto = logged_write, logged_write_readinto
+
+    for i in range(100):
+        lora._spi_write(0x40, i)
+        assert lora._spi_read(0x40) == i
+    # every access went through the one preallocated register buffer
+    assert buffers == {id(lora._reg_buf)}
+
+
+def test_fifo_drain_reads_into_the_ring_buffer_slot(radio, lora):
+    lora.set_mode_rx()
+    radio.receive(bytes((1, 2, 3, 0)) + b'x' * 40)
+    slot = lora._rx_slots[0]
+    machine.Pin.instances[IRQ_PIN].handler(IRQ_PIN)
+    assert lora._rx_slots[0] is slot
+    assert bytes(slot[:44]) == bytes((1, 2, 3, 0)) + b'x' * 40
+
+
+class WaitingDutyCycle():
+    def wait_ms(self, airtime_ms):
+        return 10
+
+    def record(self, airtime_ms):
+        pass
+
+
+def test_ack_sent_while_send_waits_keeps_the_send_header(radio, lora, monkeypatch):
+    # acks go out from _service_rx, which MicroPython can run while send() sleeps
+    lora.duty_cycle = WaitingDutyCycle()
+    lora.duty_cycle_max_wait = 1
+    acks = []
+
+    def sleep_ms(ms):
+        if not acks:
+            acks.append(ms)
+            lora.send_ack(9, 42)
+    monkeypatch.setattr(ulora.time, 'sleep_ms', sleep_ms)
+    lora.send(b'hello', 2, header_id=7)
+    assert acks
+    assert bytes(radio.fifo[:9]) == bytes((2, 1, 7, 0)) + b'hello'
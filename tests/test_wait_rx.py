@@ -0,0 +1,96 @@
+# user-009: waiting for the esp parks the core on a uselect poller until bytes arrive instead
+# of spinning on uart.any(). Busy fraction and wake latency against the old spin loop
+import threading
+import time
+
+import pytest
+
+import uart_pair
+import uartlib
+
+
+@pytest.fixture
+def uarts():
+    uart_pair.reset(uartlib)
+    yield uart_pair.pair()
+    uart_pair.reset(uartlib)
+
+
+def answer_after(uart, delay, data=b'sESP: Readyse'):
+    sent = []
+
+    def send():
+        time.sleep(delay)
+        sent.append(time.monotonic())
+        uart.write(data)
+    threading.Thread(target=send, daemon=True).start()
+    return sent
+
+
+def spin_wait(uart_obj, timeout_ms):
+    # the loop wait_rx replaced
+    t = time.monotonic()
+    while uart_obj.any() == 0:
+        if (time.monotonic() - t) * 1000 > timeout_ms:
+            return False
+        time.sleep(0.0001)
+    return True
+
+
+def measure(wait, uarts, delay=0.3):
+    rp2, esp = uarts
+    sent = answer_after(esp, delay)
+    t, cpu = time.monotonic(), time.thread_time()
+    assert wait(rp2, 2000)
+    woke = time.monotonic()
+    busy = (time.thread_time() - cpu) / (woke - t)
+    rp2.read()
+    return busy, (woke - sent[0]) * 1000
+
+
+def test_returns_straight_away_when_bytes_are_waiting(uarts):
+    rp2, esp = uarts
+    esp.write(b'x')
+    assert uartlib.wait_rx(rp2, 1000)
+    assert id(rp2) not in uartlib.rx_pollers
+
+
+def test_times_out(uarts):
+    rp2, esp = uarts
+    waited = uartlib.link_stats['wait_ms']
+    t = time.monotonic()
+    assert not uartlib.wait_rx(rp2, 100)
+    assert 0.09 < time.monotonic() - t < 0.5
+    assert uartlib.link_stats['wait_ms'] - waited >= 90
+
+
+def test_one_poller_per_uart(uarts):
+    rp2, esp = uarts
+    uartlib.wait_rx(rp2, 1)
+    poller = uartlib.rx_pollers[id(rp2)]
+    uartlib.wait_rx(rp2, 1)
+    assert uartlib.rx_pollers[id(rp2)] is poller
+
+
+def test_busy_fraction_and_wake_latency(uarts):
+    spin_busy, spin_latency = measure(spin_wait, uarts)
+    busy, latency = measure(uartlib.wait_rx, uarts)
+    print(f'spinning: {spin_busy:.2f} busy, woke {spin_latency:.2f} ms after the bytes arrived')
+    print(f'wait_rx:  {busy:.2f} busy, woke {latency:.2f} ms after the bytes arrived')
+    assert busy < 0.05
+    assert latency < 50
+
+
+def test_receive_responses_times_out_per_request(uarts):
+    rp2, esp = uarts
+    t = time.monotonic()
+    with pytest.raises(Exception, match='Waiting for response timed out'):
+        for rxData in uartlib.receive_responses(rp2, 200):
+            pass
+    assert 0.19 < time.monotonic() - t < 1
+
+
+def test_receive_responses_yields_what_arrives(link):
+    answer_after(link.esp_uart, 0.1, b'sfirstoe')
+    responses = uartlib.receive_responses(link.rp2_uart, 2000)
+    assert next(responses) == ['first', 'o']
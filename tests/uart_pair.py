@@ -0,0 +1,227 @@
+# Two uarts wired to each other, so uartlib can run on both ends of the bridge on CPython.
+# The rp2 end uses the uartlib the tests import, the esp end gets its own copy of the
+# module, since uartlib keeps the link state in module globals
+import collections
+import importlib.util
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+import uartlib
+import uselect
+
+
+class UartEnd():
+    # drop(data) -> True loses that write on the wire. loss drops writes at random instead.
+    # With a baud rate the bytes take 10 bits each on the wire, and arrive latency_ms later
+    def __init__(self, loss=0.0, seed=0, baud=None, latency_ms=0):
+        self.buf = bytearray()
+        self.lock = threading.Lock()
+        self.peer = None
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.drop = None
+        self.written = 0
+        self.baud = baud
+        self.latency = latency_ms / 1000
+        self.wire_free = 0.0
+        self.in_flight = collections.deque()
+        self.delivery = None
+
+    def write(self, data):
+        data = bytes(data)
+        self.written += len(data)
+        arrival = None
+        if self.baud is not None or self.latency:
+            now = time.monotonic()
+            self.wire_free = max(self.wire_free, now) + (len(data) * 10 / self.baud if self.baud else 0)
+            arrival = self.wire_free + self.latency
+        if self.drop is not None and self.drop(data):
+            return len(data)
+        if self.loss and self.random.random() < self.loss:
+            return len(data)
+        if arrival is None:
+            self.peer.arrive(data)
+        else:
+            self.deliver_at(arrival, data)
+        return len(data)
+
+    def arrive(self, data):
+        with self.lock:
+            self.buf += data
+        uselect.notify()
+
+    def deliver_at(self, arrival, data):
+        # one thread per end hands the writes to the peer in order once they are due
+        with self.lock:
+            self.in_flight.append((arrival, data))
+            if self.delivery is None:
+                self.delivery = threading.Thread(target=self.deliver, daemon=True)
+                self.delivery.start()
+
+    def deliver(self):
+        while True:
+            with self.lock:
+                if not self.in_flight:
+                    self.delivery = None
+                    return
+                arrival, data = self.in_flight[0]
+            delay = arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                self.in_flight.popleft()
+            self.peer.arrive(data)
+
+    def any(self):
+        with self.lock:
+            return len(self.buf)
+
+    def read(self, nbytes=None):
+        with self.lock:
+            if not self.buf:
+                return None
+            nbytes = len(self.buf) if nbytes is None else min(nbytes, len(self.buf))
+            data = MpBytes(self.buf[:nbytes])
+            del self.buf[:nbytes]
+            return data
+
+    def readinto(self, buf, nbytes=None):
+        data = self.read(len(buf) if nbytes is None else nbytes)
+        if not data:
+            return 0
+        buf[:len(data)] = data
+        return len(data)
+
+
+class MpBytes(bytes):
+    # MicroPython finds a str in bytes, CPython raises TypeError
+    def __getitem__(self, key):
+        item = bytes.__getitem__(self, key)
+        return MpBytes(item) if isinstance(key, slice) else item
+
+    def __contains__(self, sub):
+        return bytes.__contains__(self, sub.encode() if isinstance(sub, str) else sub)
+
+
+def pair(loss=0.0, seed=0, baud=None, latency_ms=0):
+    rp2 = UartEnd(loss, seed, baud, latency_ms)
+    esp = UartEnd(loss, seed + 1, baud, latency_ms)
+    rp2.peer, esp.peer = esp, rp2
+    return rp2, esp
+
+
+def mp_process_txData(module):
+    # MicroPython adds a str to bytes, CPython needs the legacy framing built as a str, and
+    # the str packet end of a chunk of bytes as bytes
+    process_txData = module.process_txData
+
+    def wrapper(txData, retain_bytes, end_format, packet_end):
+        if retain_bytes:
+            return process_txData(bytes(txData), retain_bytes, end_format, bytes(packet_end, 'utf-8') if type(packet_end) is str else packet_end)
+        return 's' + txData + module.format_chars.get(end_format, 's') + packet_end
+    module.process_txData = wrapper
+    return module
+
+
+mp_process_txData(uartlib)
+
+
+def load_esp_uartlib():
+    spec = importlib.util.spec_from_file_location('uartlib_esp', uartlib.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.os = types.SimpleNamespace(uname=lambda: types.SimpleNamespace(sysname='esp8266'),
+                                      listdir=os.listdir, remove=os.remove)
+    return mp_process_txData(module)
+
+
+def load_esp_cmdlib(esp_uartlib):
+    # cmdlib as the esp runs it, sending through the esp end's uartlib
+    uartlib_module = sys.modules['uartlib']
+    sys.modules['uartlib'] = esp_uartlib
+    try:
+        spec = importlib.util.spec_from_file_location('cmdlib_esp', os.path.join(os.path.dirname(uartlib.__file__), 'cmdlib.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.modules['uartlib'] = uartlib_module
+    return module
+
+
+class Link():
+    # both ends of a fresh bridge: rp2 and esp are the uartlib of each end
+    def __init__(self, loss=0.0, seed=0, baud=None, latency_ms=0):
+        reset(uartlib)
+        self.rp2 = uartlib
+        self.esp = load_esp_uartlib()
+        self.rp2_uart, self.esp_uart = pair(loss, seed, baud, latency_ms)
+        self.esp_loop = None
+
+    def serve(self, handler=None, idle=None):
+        self.esp_loop = EspLoop(self.esp, self.esp_uart, handler, idle)
+        return self.esp_loop
+
+    def close(self):
+        if self.esp_loop is not None:
+            self.esp_loop.stop()
+        reset(uartlib)
+
+
+def set_frame_size(module, frame_size, window_size):
+    module.frame_size = frame_size
+    module.window_size = window_size
+    module.frame_parser.reset()
+    module.frame_parser.max_payload = frame_size
+
+
+def reset(module):
+    # a fresh link, as after a reset of the device
+    set_frame_size(module, uartlib.MAX_FRAME_SIZE, 1)
+    module.frame_size = None
+    module.frame_unconfirmed_at = None
+    module.compact_commands = False
+    del module.pending_frames[:]
+    module.rx_expected = 0
+    module.rx_last = None
+    module.rx_pollers.clear()
+
+
+class EspLoop():
+    # Runs the esp end in a thread: handler(rxData) is called with each message received and
+    # sends any answer itself, idle() whenever nothing arrived for a moment
+    def __init__(self, esp_uartlib, uart, handler=None, idle=None):
+        self.uartlib = esp_uartlib
+        self.uart = uart
+        self.handler = handler
+        self.idle = idle
+        self.received = []
+        self.errors = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                rxData = self.uartlib.receive_data(self.uart, wait_ms=20)
+            except Exception as e:
+                self.errors.append(str(e))
+                continue
+            try:
+                if rxData is None:
+                    if self.idle is not None:
+                        self.idle()
+                    continue
+                self.received.append(rxData)
+                if self.handler is not None:
+                    self.handler(rxData)
+            except Exception as e:
+                self.errors.append(str(e))
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1)